@@ -0,0 +1,80 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the FAIR Noncommercial Research License
+# found in the LICENSE file in the root directory of this source tree.
+
+"""
+Micro-benchmark of `units_to_string` on hour-long expressive units,
+against the former implementation sorting the (token, position) pairs.
+
+Usage:
+    python examples/speech_tokenizer/benchmark_units_to_string.py --hours 1
+"""
+
+import argparse
+import timeit
+
+import numpy as np
+from spiritlm.speech_tokenizer.spiritlm_tokenizer import units_to_string
+
+RATES = {"hubert": 24.99, "pitch": 12.5, "style": 1}
+DEDUPS = {"hubert": True, "pitch": True, "style": False}
+TOK_TYPES = {"hubert": "Hu", "pitch": "Pi", "style": "St"}
+
+
+def sorted_units_to_string(units):
+    combine_toks = []
+    for key in ["style", "pitch", "hubert"]:
+        prev_tok = None
+        for i, tok in enumerate(units[key].split()):
+            if not DEDUPS[key] or tok != prev_tok:
+                combine_toks.append((f"[{TOK_TYPES[key]}{tok}]", i / RATES[key]))
+            prev_tok = tok
+    return "".join(tok for tok, _ in sorted(combine_toks, key=lambda x: x[1]))
+
+
+def random_units(seconds, seed=0):
+    rng = np.random.default_rng(seed)
+    num_units = {"hubert": 501, "pitch": 64, "style": 100}
+    units = {}
+    for key, rate in RATES.items():
+        length = int(seconds * rate)
+        # runs of repeated units, as in the extracted units
+        run_units = rng.integers(0, num_units[key], length)
+        run_lengths = rng.integers(1, 4, length)
+        units[key] = np.repeat(run_units, run_lengths)[:length]
+    return units
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--hours", type=float, default=1.0)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    arrays = random_units(args.hours * 3600)
+    strings = {key: " ".join(map(str, units.tolist())) for key, units in arrays.items()}
+    print(f"{len(arrays['hubert'])} hubert units ({args.hours} hour(s) of audio)")
+
+    expected = sorted_units_to_string(strings)
+    assert units_to_string(strings, has_pitch=True, has_style=True) == expected
+    assert units_to_string(arrays, has_pitch=True, has_style=True) == expected
+
+    for name, fn in [
+        ("sorted pairs (strings)", lambda: sorted_units_to_string(strings)),
+        (
+            "units_to_string (strings)",
+            lambda: units_to_string(strings, has_pitch=True, has_style=True),
+        ),
+        (
+            "units_to_string (arrays)",
+            lambda: units_to_string(arrays, has_pitch=True, has_style=True),
+        ),
+    ]:
+        seconds = min(timeit.repeat(fn, number=1, repeat=args.repeat))
+        print(f"{name:>28}: {seconds * 1000:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
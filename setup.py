@@ -57,4 +57,9 @@ setup(
         "dev": ["pytest"],
         "eval": ["pandas"],
     },
+    entry_points={
+        "console_scripts": [
+            "spiritlm-tokenize=spiritlm.tokenize_manifest:main",
+        ],
+    },
 )
@@ -0,0 +1,536 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the FAIR Noncommercial Research License
+# found in the LICENSE file in the root directory of this source tree.
+
+# Iteration-level (continuous) batching engine for the SPIRIT-LM Llama model:
+# new requests are admitted at every decode step and finished requests are evicted
+# right away, so short text generations don't wait for long speech generations.
+
+import itertools
+import logging
+from collections import deque
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Union
+
+import torch
+from spiritlm.model.utils import build_kv_cache, get_kv_cache_tensors
+from transformers import GenerationConfig, LlamaForCausalLM
+
+_logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Request:
+    request_id: int
+    input_ids: torch.Tensor  # (1, T)
+    max_new_tokens: int
+    do_sample: bool
+    eos_token_ids: List[int]
+    repetition_penalty: float = 1.0
+    temperature: float = 1.0
+    top_k: int = 0  # 0 to disable
+    top_p: float = 1.0
+    forbidden_tokens_mask: Optional[torch.Tensor] = None  # (V,) boolean
+    num_generated: int = 0  # number of sampled tokens
+    output_ids: Optional[List[int]] = None  # set when the request is finished
+    finished: bool = False
+
+
+def _get_sampling_params(generation_config: GenerationConfig) -> dict:
+    """Get the sampling parameters of a request, HF `generate` defaults are used for unset values"""
+    params = {}
+    repetition_penalty = generation_config.repetition_penalty
+    if repetition_penalty is not None and repetition_penalty != 1.0:
+        params["repetition_penalty"] = repetition_penalty
+    if generation_config.do_sample:
+        temperature = generation_config.temperature
+        if temperature is not None and temperature != 1.0:
+            params["temperature"] = temperature
+        params["top_k"] = (
+            generation_config.top_k if generation_config.top_k is not None else 50
+        )
+        top_p = generation_config.top_p
+        if top_p is not None and top_p < 1.0:
+            params["top_p"] = top_p
+    return params
+
+
+@dataclass
+class _BatchSamplingParams:
+    """
+    The sampling parameters of a batch of requests stacked as tensors of one row per request,
+    so that the logits of all the running requests are processed and sampled at once.
+    """
+
+    do_sample: torch.Tensor  # (B,) boolean
+    repetition_penalty: torch.Tensor  # (B, 1)
+    temperature: torch.Tensor  # (B, 1)
+    top_k: torch.Tensor  # (B, 1), the vocabulary size when disabled
+    top_p: torch.Tensor  # (B, 1)
+    eos_token_ids: torch.Tensor  # (B, E), padded with -1
+    forbidden_tokens_mask: Optional[torch.Tensor]  # (B, V) boolean
+    # whether some requests use the processors, known without device synchronization
+    has_repetition_penalty: bool
+    has_sampling: bool
+
+    @classmethod
+    def from_requests(
+        cls, requests: List[_Request], vocab_size: int, device
+    ) -> "_BatchSamplingParams":
+        def _column(values, dtype):
+            return torch.tensor(values, dtype=dtype, device=device).view(-1, 1)
+
+        max_num_eos = max(1, max(len(request.eos_token_ids) for request in requests))
+        eos_token_ids = torch.tensor(
+            [
+                request.eos_token_ids
+                + [-1] * (max_num_eos - len(request.eos_token_ids))
+                for request in requests
+            ],
+            dtype=torch.long,
+            device=device,
+        )
+        forbidden_tokens_mask = None
+        if any(request.forbidden_tokens_mask is not None for request in requests):
+            forbidden_tokens_mask = torch.zeros(
+                (len(requests), vocab_size), dtype=torch.bool, device=device
+            )
+            for row, request in enumerate(requests):
+                if request.forbidden_tokens_mask is not None:
+                    mask = request.forbidden_tokens_mask[:vocab_size]
+                    forbidden_tokens_mask[row, : mask.size(0)] = mask
+        return cls(
+            do_sample=torch.tensor(
+                [request.do_sample for request in requests], device=device
+            ),
+            repetition_penalty=_column(
+                [request.repetition_penalty for request in requests], torch.float
+            ),
+            temperature=_column(
+                [request.temperature for request in requests], torch.float
+            ),
+            top_k=_column(
+                [
+                    min(request.top_k, vocab_size) if request.top_k > 0 else vocab_size
+                    for request in requests
+                ],
+                torch.long,
+            ),
+            top_p=_column([request.top_p for request in requests], torch.float),
+            eos_token_ids=eos_token_ids,
+            forbidden_tokens_mask=forbidden_tokens_mask,
+            has_repetition_penalty=any(
+                request.repetition_penalty != 1.0 for request in requests
+            ),
+            has_sampling=any(request.do_sample for request in requests),
+        )
+
+
+def _process_logits(
+    scores: torch.Tensor,
+    token_ids: torch.Tensor,
+    attention_mask: torch.Tensor,
+    params: _BatchSamplingParams,
+) -> torch.Tensor:
+    """
+    Apply the processors of HF `generate` to the (B, V) scores of a batch of requests,
+    in the same order: repetition penalty, forbidden tokens, temperature, top-k and top-p.
+    `token_ids` are the left-padded sequences of the requests, and `attention_mask` their padding mask.
+    """
+    if params.has_repetition_penalty:
+        # the tokens seen in the sequence, padding excluded
+        seen = (
+            torch.zeros_like(scores).scatter_add_(
+                1, token_ids, attention_mask.to(scores.dtype)
+            )
+            > 0
+        )
+        penalty = params.repetition_penalty
+        penalized = torch.where(scores < 0, scores * penalty, scores / penalty)
+        scores = torch.where(seen, penalized, scores)
+    if params.forbidden_tokens_mask is not None:
+        scores = scores.masked_fill(
+            params.forbidden_tokens_mask[:, : scores.size(-1)], -float("inf")
+        )
+    if params.has_sampling:
+        scores = scores / params.temperature
+        # top-k: keep the scores greater or equal to the k-th greatest one
+        sorted_scores = torch.sort(scores, dim=-1, descending=True).values
+        kth_scores = sorted_scores.gather(1, params.top_k - 1)
+        scores = scores.masked_fill(scores < kth_scores, -float("inf"))
+        # top-p: remove the least probable tokens whose cumulative probability is below 1 - top_p,
+        # at least the most probable token is kept
+        sorted_scores, sorted_indices = torch.sort(scores, dim=-1, descending=False)
+        cumulative_probs = sorted_scores.softmax(dim=-1).cumsum(dim=-1)
+        sorted_to_remove = (cumulative_probs <= 1 - params.top_p) & (params.top_p < 1)
+        sorted_to_remove[:, -1] = False
+        to_remove = sorted_to_remove.scatter(1, sorted_indices, sorted_to_remove)
+        scores = scores.masked_fill(to_remove, -float("inf"))
+    return scores
+
+
+def _sample(scores: torch.Tensor, params: _BatchSamplingParams) -> torch.Tensor:
+    """Sample the (B,) next tokens from the processed (B, V) scores, greedily for the rows not sampling"""
+    next_tokens = torch.argmax(scores, dim=-1)
+    if params.has_sampling:
+        probs = torch.nn.functional.softmax(scores, dim=-1)
+        sampled_tokens = torch.multinomial(probs, num_samples=1).view(-1)
+        next_tokens = torch.where(params.do_sample, sampled_tokens, next_tokens)
+    return next_tokens
+
+
+class ContinuousBatchingEngine:
+    """
+    Continuous batching engine owning the KV cache of the running requests.
+
+    The KV cache of the running requests is kept left-padded in a single batch,
+    along with their token ids. At every `step`, waiting requests are prefilled and merged
+    into the batch, one token is decoded and sampled for all the running requests at once,
+    and the finished requests are evicted from the batch.
+
+    Example:
+        engine = ContinuousBatchingEngine(model)
+        request_id = engine.submit(input_ids, max_new_tokens=50)
+        while (output_ids := engine.poll(request_id)) is None:
+            engine.step()
+    """
+
+    def __init__(
+        self,
+        model: LlamaForCausalLM,
+        max_batch_size: int = 8,
+        eos_token_id: Optional[Union[int, List[int]]] = None,
+    ):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        if eos_token_id is None:
+            eos_token_id = model.generation_config.eos_token_id
+        self.eos_token_id = eos_token_id
+
+        self._request_counter = itertools.count()
+        self._waiting: deque = deque()
+        self._finished: Dict[int, _Request] = {}
+
+        # running batch
+        self._running: List[_Request] = []
+        self._kv_cache = None  # list of (key, value) of shape (B, H, L, D)
+        self._attention_mask = None  # (B, L)
+        self._token_ids = None  # (B, L) the token ids fed to the model, left-padded
+        self._next_tokens = None  # (B,) the last sampled tokens, not fed yet
+        self._sampling_params = None  # _BatchSamplingParams of the running requests
+
+    @property
+    def device(self):
+        return self.model.device
+
+    @property
+    def vocab_size(self) -> int:
+        return self.model.config.vocab_size
+
+    @property
+    def num_running(self) -> int:
+        return len(self._running)
+
+    @property
+    def num_waiting(self) -> int:
+        return len(self._waiting)
+
+    def has_unfinished_requests(self) -> bool:
+        return len(self._waiting) > 0 or len(self._running) > 0
+
+    def submit(
+        self,
+        input_ids: Union[List[int], torch.Tensor],
+        generation_config: Optional[GenerationConfig] = None,
+        forbidden_tokens_mask: Optional[torch.Tensor] = None,
+        **kwargs,  # GenerationConfig args can be passing here
+    ) -> int:
+        """
+        Submit a request and return its id. The request will be admitted at the next `step`.
+        `forbidden_tokens_mask` is an optional boolean mask of shape (vocab_size,)
+        of the tokens that can't be generated.
+        """
+        if generation_config is None:
+            generation_config = GenerationConfig()
+        for attr_name, attr_value in kwargs.items():
+            assert hasattr(
+                generation_config, attr_name
+            ), f"attribute '{attr_name}' not found in transformers.GenerationConfig"
+            setattr(generation_config, attr_name, attr_value)
+
+        input_ids = torch.as_tensor(input_ids, dtype=torch.long).view(1, -1)
+        assert input_ids.size(1) > 0, "expects a non-empty prompt"
+
+        max_new_tokens = generation_config.max_new_tokens
+        if max_new_tokens is None:
+            max_length = (
+                generation_config.max_length
+                if generation_config.max_length is not None
+                else 20
+            )
+            max_new_tokens = max_length - input_ids.size(1)
+
+        eos_token_id = (
+            generation_config.eos_token_id
+            if generation_config.eos_token_id is not None
+            else self.eos_token_id
+        )
+        if eos_token_id is None:
+            eos_token_ids = []
+        elif isinstance(eos_token_id, int):
+            eos_token_ids = [eos_token_id]
+        else:
+            eos_token_ids = list(eos_token_id)
+
+        request = _Request(
+            request_id=next(self._request_counter),
+            input_ids=input_ids,
+            max_new_tokens=max_new_tokens,
+            do_sample=bool(generation_config.do_sample),
+            eos_token_ids=eos_token_ids,
+            forbidden_tokens_mask=forbidden_tokens_mask,
+            **_get_sampling_params(generation_config),
+        )
+        if request.max_new_tokens <= 0:
+            request.finished = True
+            request.output_ids = []
+            self._finished[request.request_id] = request
+        else:
+            self._waiting.append(request)
+        return request.request_id
+
+    def poll(self, request_id: int) -> Optional[List[int]]:
+        """
+        Return the generated token ids (without the prompt) if the request is finished, None otherwise.
+        The finished request is released after being polled.
+        """
+        request = self._finished.pop(request_id, None)
+        if request is None:
+            return None
+        return request.output_ids
+
+    def abort(self, request_id: int):
+        """Drop a request wherever it is (waiting, running or finished)."""
+        self._finished.pop(request_id, None)
+        self._waiting = deque(
+            request for request in self._waiting if request.request_id != request_id
+        )
+        for row, request in enumerate(self._running):
+            if request.request_id == request_id:
+                self._evict([row])
+                break
+
+    @torch.inference_mode()
+    def step(self) -> List[int]:
+        """
+        Run one iteration: admit the waiting requests that fit in the batch,
+        decode one token for every running request and evict the finished ones.
+        Return the ids of the requests finished during this step.
+        """
+        finished_ids = []
+
+        # Admit new requests
+        num_running = len(self._running)
+        while self._waiting and len(self._running) < self.max_batch_size:
+            request = self._waiting.popleft()
+            if self._prefill(request):
+                finished_ids.append(request.request_id)
+        if len(self._running) != num_running:
+            self._update_sampling_params()
+
+        if not self._running:
+            return finished_ids
+
+        # Decode one token for all the running requests
+        batch_size, past_length = self._attention_mask.shape
+        attention_mask = torch.cat(
+            [
+                self._attention_mask,
+                self._attention_mask.new_ones((batch_size, 1)),
+            ],
+            dim=1,
+        )
+        position_ids = self._attention_mask.sum(dim=1, keepdim=True)
+        outputs = self.model(
+            input_ids=self._next_tokens.view(-1, 1),
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=build_kv_cache(self._kv_cache),
+            use_cache=True,
+        )
+        self._kv_cache = get_kv_cache_tensors(outputs.past_key_values)
+        self._attention_mask = attention_mask
+        self._token_ids = torch.cat(
+            [self._token_ids, self._next_tokens.view(-1, 1)], dim=1
+        )
+
+        scores = _process_logits(
+            outputs.logits[:, -1, :].float(),
+            self._token_ids,
+            self._attention_mask,
+            self._sampling_params,
+        )
+        self._next_tokens = _sample(scores, self._sampling_params)
+        for request in self._running:
+            request.num_generated += 1
+
+        # a single device synchronization to get the finished rows
+        finished_rows = self._get_finished_rows(
+            self._running, self._next_tokens, self._sampling_params
+        )
+        for row in finished_rows:
+            request = self._running[row]
+            self._finish(
+                request,
+                torch.cat(
+                    [
+                        self._token_ids[row, -(request.num_generated - 1) :]
+                        if request.num_generated > 1
+                        else self._token_ids.new_zeros(0),
+                        self._next_tokens[row : row + 1],
+                    ]
+                ).tolist(),
+            )
+            finished_ids.append(request.request_id)
+
+        self._evict(finished_rows)
+        return finished_ids
+
+    def run_until_complete(self):
+        """Step until all the submitted requests are finished."""
+        while self.has_unfinished_requests():
+            self.step()
+
+    def _get_finished_rows(
+        self,
+        requests: List[_Request],
+        next_tokens: torch.Tensor,
+        params: _BatchSamplingParams,
+    ) -> List[int]:
+        """Get the rows of the requests finished after sampling `next_tokens`"""
+        is_finished = (next_tokens.view(-1, 1) == params.eos_token_ids).any(dim=1)
+        is_finished |= torch.tensor(
+            [request.num_generated >= request.max_new_tokens for request in requests],
+            device=next_tokens.device,
+        )
+        return is_finished.nonzero().view(-1).tolist()
+
+    def _finish(self, request: _Request, output_ids: List[int]):
+        request.output_ids = output_ids
+        request.finished = True
+        self._finished[request.request_id] = request
+
+    def _update_sampling_params(self):
+        self._sampling_params = (
+            _BatchSamplingParams.from_requests(
+                self._running, self.vocab_size, self.device
+            )
+            if self._running
+            else None
+        )
+
+    def _prefill(self, request: _Request) -> bool:
+        """
+        Prefill the prompt of a request, sample its first token and merge its KV cache into the batch.
+        Return True if the request is already finished after its first token.
+        """
+        input_ids = request.input_ids.to(self.device)
+        outputs = self.model(input_ids=input_ids, use_cache=True)
+        attention_mask = torch.ones_like(input_ids)
+        params = _BatchSamplingParams.from_requests(
+            [request], self.vocab_size, self.device
+        )
+        next_tokens = _sample(
+            _process_logits(
+                outputs.logits[:, -1, :].float(), input_ids, attention_mask, params
+            ),
+            params,
+        )
+        request.num_generated = 1
+        if self._get_finished_rows([request], next_tokens, params):
+            self._finish(request, next_tokens.tolist())
+            return True
+
+        kv_cache = get_kv_cache_tensors(outputs.past_key_values)
+        token_ids = input_ids
+        if self._running:
+            kv_cache, attention_mask, token_ids = _merge_left_padded(
+                self._kv_cache,
+                self._attention_mask,
+                self._token_ids,
+                kv_cache,
+                attention_mask,
+                token_ids,
+            )
+            next_tokens = torch.cat([self._next_tokens, next_tokens])
+        self._kv_cache = kv_cache
+        self._attention_mask = attention_mask
+        self._token_ids = token_ids
+        self._next_tokens = next_tokens
+        self._running.append(request)
+        return False
+
+    def _evict(self, rows: List[int]):
+        """Remove the given rows from the running batch"""
+        if not rows:
+            return
+        keep = [row for row in range(len(self._running)) if row not in rows]
+        self._running = [self._running[row] for row in keep]
+        self._update_sampling_params()
+        if not keep:
+            self._kv_cache, self._attention_mask = None, None
+            self._token_ids, self._next_tokens = None, None
+            return
+        keep = torch.tensor(keep, device=self._attention_mask.device)
+        attention_mask = self._attention_mask.index_select(0, keep)
+        # drop the leading columns that are only padding for the remaining requests
+        first_column = int((attention_mask.sum(dim=0) > 0).nonzero()[0])
+        self._attention_mask = attention_mask[:, first_column:]
+        self._token_ids = self._token_ids.index_select(0, keep)[:, first_column:]
+        self._kv_cache = [
+            (
+                key.index_select(0, keep)[:, :, first_column:],
+                value.index_select(0, keep)[:, :, first_column:],
+            )
+            for key, value in self._kv_cache
+        ]
+        self._next_tokens = self._next_tokens.index_select(0, keep)
+
+
+def _left_pad_kv(kv_cache, attention_mask, token_ids, length: int):
+    """Left-pad the KV cache, attention mask and token ids along the sequence dimension to `length`"""
+    pad = length - attention_mask.size(1)
+    if pad == 0:
+        return kv_cache, attention_mask, token_ids
+    kv_cache = [
+        (
+            torch.nn.functional.pad(key, (0, 0, pad, 0)),
+            torch.nn.functional.pad(value, (0, 0, pad, 0)),
+        )
+        for key, value in kv_cache
+    ]
+    attention_mask = torch.nn.functional.pad(attention_mask, (pad, 0))
+    token_ids = torch.nn.functional.pad(token_ids, (pad, 0))
+    return kv_cache, attention_mask, token_ids
+
+
+def _merge_left_padded(
+    kv_cache_a, attention_mask_a, token_ids_a, kv_cache_b, attention_mask_b, token_ids_b
+):
+    """Concatenate two left-padded batches of KV cache and token ids along the batch dimension"""
+    length = max(attention_mask_a.size(1), attention_mask_b.size(1))
+    kv_cache_a, attention_mask_a, token_ids_a = _left_pad_kv(
+        kv_cache_a, attention_mask_a, token_ids_a, length
+    )
+    kv_cache_b, attention_mask_b, token_ids_b = _left_pad_kv(
+        kv_cache_b, attention_mask_b, token_ids_b, length
+    )
+    kv_cache = [
+        (torch.cat([key_a, key_b]), torch.cat([value_a, value_b]))
+        for (key_a, value_a), (key_b, value_b) in zip(kv_cache_a, kv_cache_b)
+    ]
+    attention_mask = torch.cat([attention_mask_a, attention_mask_b])
+    token_ids = torch.cat([token_ids_a, token_ids_b])
+    return kv_cache, attention_mask, token_ids
@@ -0,0 +1,188 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the FAIR Noncommercial Research License
+# found in the LICENSE file in the root directory of this source tree.
+
+# Prefix KV cache for the SPIRIT-LM Llama model: the KV tensors of the prompts are stored
+# in a radix tree keyed on token ids, so that a prompt sharing a prefix with a previous one
+# (e.g. the few-shot prompt of STSP) only needs to prefill its unmatched suffix.
+
+import itertools
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import torch
+
+_logger = logging.getLogger(__name__)
+
+# per layer (key, value) tensors of shape (1, H, L, D)
+KVTensors = List[Tuple[torch.Tensor, torch.Tensor]]
+
+
+class _Node:
+    def __init__(
+        self,
+        token_ids: Tuple[int, ...],
+        kv_tensors: Optional[KVTensors],
+        parent: Optional["_Node"],
+    ):
+        self.token_ids = token_ids  # edge label, from the parent node to this node
+        self.kv_tensors = kv_tensors  # KV tensors of the edge tokens
+        self.parent = parent
+        self.children: Dict[int, "_Node"] = {}  # indexed by the first token of the edge
+        self.last_access = 0
+
+    @property
+    def nbytes(self) -> int:
+        if self.kv_tensors is None:
+            return 0
+        return sum(key.nbytes + value.nbytes for key, value in self.kv_tensors)
+
+
+def _slice_kv(kv_tensors: KVTensors, start: int, end: Optional[int] = None) -> KVTensors:
+    """Copy the KV tensors of the positions [start, end) out of the storage of the full tensors"""
+    return [
+        (key[:, :, start:end].clone(), value[:, :, start:end].clone())
+        for key, value in kv_tensors
+    ]
+
+
+def _common_prefix_length(a: Sequence[int], b: Sequence[int]) -> int:
+    length = min(len(a), len(b))
+    for i in range(length):
+        if a[i] != b[i]:
+            return i
+    return length
+
+
+class PrefixCache:
+    """
+    Radix tree of the prompt KV tensors keyed on token ids, with LRU eviction under a memory cap.
+
+    Each edge of the tree holds the KV tensors of its tokens. When the total size of the KV tensors
+    exceeds `max_bytes`, the least recently used leaves are evicted.
+
+    Example:
+        prefix_cache = PrefixCache(max_bytes=2 * 1024**3)
+        num_cached_tokens, kv_tensors = prefix_cache.match(prompt_ids)
+        ... # prefill prompt_ids[num_cached_tokens:] on top of kv_tensors
+        prefix_cache.insert(prompt_ids, prompt_kv_tensors)
+    """
+
+    def __init__(self, max_bytes: int):
+        assert max_bytes > 0, f"max_bytes should be positive, found {max_bytes}"
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._root = _Node(token_ids=(), kv_tensors=None, parent=None)
+        self._clock = itertools.count(1)
+
+    def __len__(self) -> int:
+        """Number of cached tokens"""
+        return sum(len(node.token_ids) for node in self._iter_nodes())
+
+    def _iter_nodes(self):
+        stack = list(self._root.children.values())
+        while stack:
+            node = stack.pop()
+            yield node
+            stack.extend(node.children.values())
+
+    def match(self, token_ids: Sequence[int]) -> Tuple[int, Optional[KVTensors]]:
+        """
+        Return the length of the longest cached prefix of the token ids and its KV tensors
+        (None if no prefix is cached).
+        """
+        token_ids = tuple(token_ids)
+        node = self._root
+        pos = 0
+        kv_chunks: List[KVTensors] = []
+        timestamp = next(self._clock)
+        while pos < len(token_ids) and token_ids[pos] in node.children:
+            child = node.children[token_ids[pos]]
+            length = _common_prefix_length(child.token_ids, token_ids[pos:])
+            child.last_access = timestamp
+            if length < len(child.token_ids):
+                kv_chunks.append(
+                    [
+                        (key[:, :, :length], value[:, :, :length])
+                        for key, value in child.kv_tensors
+                    ]
+                )
+                pos += length
+                break
+            kv_chunks.append(child.kv_tensors)
+            pos += length
+            node = child
+        if pos == 0:
+            return 0, None
+        if len(kv_chunks) == 1:
+            return pos, kv_chunks[0]
+        kv_tensors = [
+            (
+                torch.cat([chunk[layer_idx][0] for chunk in kv_chunks], dim=2),
+                torch.cat([chunk[layer_idx][1] for chunk in kv_chunks], dim=2),
+            )
+            for layer_idx in range(len(kv_chunks[0]))
+        ]
+        return pos, kv_tensors
+
+    def insert(self, token_ids: Sequence[int], kv_tensors: KVTensors):
+        """
+        Insert the KV tensors of the token ids, only the part not cached yet is copied.
+        `kv_tensors` is a list of per-layer (key, value) of shape (1, H, L, D),
+        with L >= len(token_ids).
+        """
+        token_ids = tuple(token_ids)
+        node = self._root
+        pos = 0
+        timestamp = next(self._clock)
+        while pos < len(token_ids):
+            child = node.children.get(token_ids[pos])
+            if child is None:
+                new_node = _Node(
+                    token_ids=token_ids[pos:],
+                    kv_tensors=_slice_kv(kv_tensors, pos, len(token_ids)),
+                    parent=node,
+                )
+                new_node.last_access = timestamp
+                node.children[token_ids[pos]] = new_node
+                self.nbytes += new_node.nbytes
+                break
+            length = _common_prefix_length(child.token_ids, token_ids[pos:])
+            if length < len(child.token_ids):
+                child = self._split(child, length)
+            child.last_access = timestamp
+            pos += length
+            node = child
+        self._evict()
+
+    def _split(self, node: _Node, length: int) -> _Node:
+        """Split the edge of the node after `length` tokens and return the new intermediate node"""
+        parent = node.parent
+        prefix_node = _Node(
+            token_ids=node.token_ids[:length],
+            kv_tensors=_slice_kv(node.kv_tensors, 0, length),
+            parent=parent,
+        )
+        prefix_node.last_access = node.last_access
+        parent.children[node.token_ids[0]] = prefix_node
+        node.token_ids = node.token_ids[length:]
+        node.kv_tensors = _slice_kv(node.kv_tensors, length)
+        node.parent = prefix_node
+        prefix_node.children[node.token_ids[0]] = node
+        return prefix_node
+
+    def _evict(self):
+        while self.nbytes > self.max_bytes:
+            leaves = [node for node in self._iter_nodes() if not node.children]
+            if not leaves:
+                break
+            leaf = min(leaves, key=lambda node: node.last_access)
+            del leaf.parent.children[leaf.token_ids[0]]
+            self.nbytes -= leaf.nbytes
+            _logger.debug(f"Evicted {len(leaf.token_ids)} tokens from the prefix cache")
+
+    def clear(self):
+        self._root.children.clear()
+        self.nbytes = 0
@@ -11,20 +11,39 @@ from dataclasses import dataclass
 from enum import Enum, auto
 from functools import cache
 from pathlib import Path
-from typing import List, Optional, Tuple, Union
+from threading import Event, Thread
+from typing import Dict, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
 import torchaudio
+from spiritlm.model.engine import ContinuousBatchingEngine
+from spiritlm.model.prefix_cache import PrefixCache
+from spiritlm.model.streaming import (
+    EventStoppingCriteria,
+    IncrementalSpeechTextParser,
+    TokenIdsIteratorStreamer,
+)
 from spiritlm.model.utils import (
+    ForbiddenTokensLogitsProcessor,
+    RestrictedLMHead,
+    build_kv_cache,
     convert_to_wav_tensor,
-    does_end_with_speech_token,
-    does_start_with_speech_token,
-    find_prompt_last_speech_start_position,
     get_forbidden_tokens,
+    get_kv_cache_tensors,
+    with_lm_head,
 )
 from spiritlm.speech_tokenizer import spiritlm_base, spiritlm_expressive
-from transformers import GenerationConfig, LlamaForCausalLM, LlamaTokenizer, set_seed
+from spiritlm.speech_tokenizer.units import Units
+from transformers import (
+    GenerationConfig,
+    LlamaForCausalLM,
+    LlamaTokenizer,
+    LogitsProcessorList,
+    StoppingCriteriaList,
+    set_seed,
+)
+from transformers.generation.streamers import BaseStreamer
 
 _logger = logging.getLogger(__name__)
 
@@ -72,6 +91,27 @@ class GenerationOuput:
     content_type: ContentType
 
 
+@dataclass
+class TextDelta:
+    """Text generated since the previous event, streamed by `Spiritlm.generate_stream`"""
+
+    content: str
+    content_type: ContentType = ContentType.TEXT
+
+
+@dataclass
+class SpeechChunk:
+    """
+    Chunk of generated speech streamed by `Spiritlm.generate_stream`,
+    `is_last` is True for the last chunk of a speech span.
+    """
+
+    units: Units
+    content: Optional[np.ndarray] = None  # the waveform synthesized since the previous chunk
+    is_last: bool = False
+    content_type: ContentType = ContentType.SPEECH
+
+
 InterleavedInputs = List[GenerationInput]
 InterleavedOutputs = List[GenerationOuput]
 
@@ -149,6 +189,20 @@ def _overwrite_generation_config(generation_config, kwargs):
     return generation_config
 
 
+def _left_pad(
+    sequences: List[List[int]], pad_token_id: int
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Left-pad a list of token id sequences, return the input ids and the attention mask"""
+    max_length = max(len(seq) for seq in sequences)
+    input_ids = torch.full((len(sequences), max_length), pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(sequences), max_length), dtype=torch.long)
+    for i, seq in enumerate(sequences):
+        if len(seq) > 0:
+            input_ids[i, -len(seq) :] = torch.as_tensor(seq, dtype=torch.long)
+            attention_mask[i, -len(seq) :] = 1
+    return input_ids, attention_mask
+
+
 class Spiritlm:
     TEXT_PROMPT_PREFIX = "[Text]"
     SPEECH_PROMPT_PREFIX = "[Speech]"
@@ -178,42 +232,152 @@ class Spiritlm:
             self.speech_tokenizer = spiritlm_expressive(**speech_tokenizer_kwargs)
             self.is_expressive_model = True
         _logger.info("SPIRIT-LM speech tokenizers are loaded.")
+        self._engine = None
+        self._engine_requests = {}
+        self._prefix_cache = None
+
+    def enable_prefix_cache(self, max_bytes: int = 2 * 1024**3):
+        """
+        Enable the prefix KV cache of `generate`: the KV tensors of the prompts are cached
+        (up to `max_bytes`, least recently used prefixes are evicted first)
+        and only the part of a prompt after its longest cached prefix is prefilled.
+        """
+        self._prefix_cache = PrefixCache(max_bytes=max_bytes)
+
+    def disable_prefix_cache(self):
+        self._prefix_cache = None
+
+    @property
+    def engine(self) -> ContinuousBatchingEngine:
+        """
+        The continuous batching engine used by `submit` and `poll`, created on first use.
+        """
+        if self._engine is None:
+            self._engine = ContinuousBatchingEngine(self.model)
+        return self._engine
 
-    def _build_prompt(
+    @cache
+    def _get_speech_token_offsets(self) -> Dict[str, int]:
+        """
+        Return the token id of the unit 0 of each speech token type,
+        the token id of a unit is the offset of its type plus the unit.
+        """
+        return {
+            tok_type: self.tokenizer.convert_tokens_to_ids(f"[{tok_type}0]")
+            for tok_type in ["Hu", "Pi", "St"]
+        }
+
+    def _build_prompt_ids(
         self,
         generation_inputs: List[GenerationInput],
         output_modality: OutputModality,
-    ) -> str:
+    ) -> List[int]:
         """
-        Build the prompt according the input content and the output modality.
+        Build the prompt token ids according the input content and the output modality.
+
+        The speech units are mapped to their token ids directly, only the text segments
+        are tokenized by the text tokenizer. The ids are the same as the tokenization of the
+        prompt string joining the modality prefixes, the speech tokens and the texts.
         """
         if not isinstance(output_modality, OutputModality):
             raise ValueError(f"Unknown output_modality: {output_modality}")
-        prompts = []
+        speech_token_offsets = self._get_speech_token_offsets()
+        text_prompt_prefix_id, speech_prompt_prefix_id = (
+            self.tokenizer.convert_tokens_to_ids(
+                [Spiritlm.TEXT_PROMPT_PREFIX, Spiritlm.SPEECH_PROMPT_PREFIX]
+            )
+        )
+        # the special tokens added to the prompt string by the tokenizer (BOS)
+        prompt_ids = list(self.tokenizer("").input_ids)
+        texts = []
+
+        def _flush_texts(is_last: bool):
+            # consecutive texts are tokenized together, as in the joined prompt string,
+            # where they come after the [Text] prefix and before the [Speech] prefix (if not last),
+            # which change how the text at their boundaries is tokenized (e.g. the "▁" prefix)
+            if not texts:
+                return
+            text = Spiritlm.TEXT_PROMPT_PREFIX + "".join(texts)
+            if not is_last:
+                text += Spiritlm.SPEECH_PROMPT_PREFIX
+            text_ids = self.tokenizer(text, add_special_tokens=False).input_ids
+            assert text_ids[0] == text_prompt_prefix_id, text_ids
+            if not is_last:
+                assert text_ids[-1] == speech_prompt_prefix_id, text_ids
+                text_ids = text_ids[:-1]
+            # the [Text] prefix is already in the prompt ids
+            prompt_ids.extend(text_ids[1:])
+            texts.clear()
+
         prev_modality = None
         for gen_input in generation_inputs:
             if gen_input.content_type.value == ContentType.SPEECH.value:
                 gen_input.content = convert_to_wav_tensor(gen_input.content)
+                _flush_texts(is_last=False)
                 if prev_modality != "s":
-                    prompts.append(Spiritlm.SPEECH_PROMPT_PREFIX)
-                prompts.append(self.speech_tokenizer(gen_input.content))
+                    prompt_ids.append(speech_prompt_prefix_id)
+                prompt_ids.extend(
+                    speech_token_offsets[tok_type] + unit
+                    for tok_type, unit in self.speech_tokenizer.encode_tokens(
+                        gen_input.content
+                    )
+                )
                 prev_modality = "s"  # speech
             elif gen_input.content_type.value == ContentType.TEXT.value:
                 if prev_modality != "t":
-                    prompts.append(Spiritlm.TEXT_PROMPT_PREFIX)
-                prompts.append(gen_input.content)
+                    prompt_ids.append(text_prompt_prefix_id)
+                texts.append(gen_input.content)
                 prev_modality = "t"  # text
             else:
                 raise ValueError(
                     f"Unknown content type: {gen_input.content_type.value}"
                 )
+        _flush_texts(is_last=output_modality != OutputModality.SPEECH)
         if output_modality == OutputModality.TEXT:
             if prev_modality != "t":
-                prompts.append(Spiritlm.TEXT_PROMPT_PREFIX)
+                prompt_ids.append(text_prompt_prefix_id)
         elif output_modality == OutputModality.SPEECH:
             if prev_modality != "s":
-                prompts.append(Spiritlm.SPEECH_PROMPT_PREFIX)
-        return "".join(prompts)
+                prompt_ids.append(speech_prompt_prefix_id)
+        return prompt_ids
+
+    def _get_prompt_ids(
+        self,
+        interleaved_inputs: Optional[List[Union[GenerationInput, tuple]]],
+        prompt: Optional[str],
+        output_modality: OutputModality,
+    ) -> List[int]:
+        """
+        Return the token ids of the prompt if it is given, otherwise build them from the interleaved inputs.
+        """
+        assert not (
+            interleaved_inputs is None and prompt is None
+        ), "interleaved_inputs and prompt can not both be None"
+        if (
+            prompt is not None
+            and interleaved_inputs is not None
+            and len(interleaved_inputs) > 0
+        ):
+            _logger.warning(
+                "When prompt is specified, interleaved_inputs will not be used."
+            )
+        if prompt is not None:
+            return self.tokenizer(prompt).input_ids
+        if not isinstance(interleaved_inputs, list):
+            interleaved_inputs = [interleaved_inputs]
+        interleaved_inputs = _get_generation_inputs(interleaved_inputs)
+        return self._build_prompt_ids(
+            interleaved_inputs,
+            output_modality,
+        )
+
+    def _decode_ids(self, token_ids: List[int]) -> str:
+        """
+        Decode the prompt or generated token ids to the tokens string.
+        """
+        return self.tokenizer.decode(
+            token_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False
+        )
 
     @cache
     def _build_forbidden_tokens(
@@ -243,195 +407,338 @@ class Spiritlm:
             raise ValueError(f"Unknown output_modality: {output_modality}")
         return forbidden_tokens
 
-    def _parse_speech_and_text(
+    @cache
+    def _build_forbidden_tokens_mask(
         self,
-        generated_content: str,
-    ):
-        # TODO: clean this function, it is too long!
-        splits = []
-        i = 0
-        last_pos = len(generated_content)
-        char_and_types = []
-        is_speech_token = False
-        is_text_token = False
-        text_prefix_length = len(Spiritlm.TEXT_PROMPT_PREFIX)
-        speech_prefix_length = len(Spiritlm.SPEECH_PROMPT_PREFIX)
-        while i < last_pos:
-            ch = generated_content[i]
-            j = i
-            if ch == "[":
-                if (
-                    j + text_prefix_length - 1 < last_pos
-                    and generated_content[j : j + text_prefix_length]
-                    == Spiritlm.TEXT_PROMPT_PREFIX
-                ):  # text prefix token
-                    j += text_prefix_length  # skip "[Text]
-                elif (
-                    j + speech_prefix_length - 1 < last_pos
-                    and generated_content[j : j + speech_prefix_length]
-                    == Spiritlm.SPEECH_PROMPT_PREFIX
-                ):  # speech prefix token
-                    j += speech_prefix_length  # skip "[Speech]"
-                elif j + 2 < last_pos and generated_content[j + 1 : j + 3] in (
-                    "Hu",
-                    "Pi",
-                    "St",
-                ):
-                    j += 3  # skip "["" and Hu/Pi/St
-                    while j < last_pos and generated_content[j] != "]":
-                        j += 1
-                    j += 1  # skip "]"
-                    is_speech_token = True
-                else:  # other texts starting with "[" e.g., "[abc"
-                    is_text_token = True
-                    j += 1
-            else:
-                is_text_token = True
-                while j < last_pos and generated_content[j] != "[":
-                    j += 1
-
-            cur_content = generated_content[i:j]
-            if is_speech_token:
-                if len(char_and_types) and char_and_types[-1][1] == "t":
-                    splits.append(
-                        (
-                            "".join(
-                                (
-                                    content_and_type[0]
-                                    for content_and_type in char_and_types
-                                )
-                            ),
-                            "t",
-                        )
-                    )
-                    char_and_types = []
-                char_and_types.append((cur_content, "s"))  # speech
-            elif is_text_token:
-                if len(char_and_types) and char_and_types[-1][1] == "s":
-                    splits.append(
-                        (
-                            "".join(
-                                (
-                                    content_and_type[0]
-                                    for content_and_type in char_and_types
-                                )
-                            ),
-                            "s",
-                        )
-                    )
-                    char_and_types = []
-                char_and_types.append((cur_content, "t"))  # text
-            is_speech_token, is_text_token = False, False
-            i = j
-        if len(char_and_types):
-            if char_and_types[-1][1] == "t":
-                splits.append(
-                    (
-                        "".join(
-                            (content_and_type[0] for content_and_type in char_and_types)
-                        ),
-                        "t",
-                    )
-                )
-            else:
-                splits.append(
-                    (
-                        "".join(
-                            (content_and_type[0] for content_and_type in char_and_types)
-                        ),
-                        "s",
-                    )
-                )
-        return splits
+        output_modality: OutputModality,
+    ) -> Optional[torch.Tensor]:
+        """
+        Build the boolean mask over the vocabulary of the tokens that we don't want to generate
+        according the modality direction (see `_build_forbidden_tokens`).
+        The mask is built once per output modality and kept on the model device.
+        Return None if there is no forbidden token.
+        """
+        forbidden_tokens = self._build_forbidden_tokens(output_modality)
+        if len(forbidden_tokens) == 0:
+            return None
+        vocab_size = self.model.config.vocab_size
+        mask = torch.zeros(vocab_size, dtype=torch.bool)
+        mask[[tok_id for tok_id in forbidden_tokens if tok_id < vocab_size]] = True
+        return mask.to(self.device)
+
+    @cache
+    def _get_restricted_token_range(
+        self,
+        output_modality: OutputModality,
+    ) -> Optional[Tuple[int, int]]:
+        """
+        Return the range [start, end) of the token ids allowed for the output modality,
+        if they are contiguous (the speech tokens of SPEECH), None otherwise.
+        """
+        if output_modality != OutputModality.SPEECH:
+            return None
+        forbidden_tokens_mask = self._build_forbidden_tokens_mask(output_modality)
+        allowed_token_ids = (~forbidden_tokens_mask).nonzero().view(-1).tolist()
+        start, end = allowed_token_ids[0], allowed_token_ids[-1] + 1
+        if end - start != len(allowed_token_ids):
+            return None
+        return start, end
 
-    def _decode_from_generated_output(
+    def _get_generation_model(
+        self,
+        restricted_modality: Optional[OutputModality],
+    ) -> LlamaForCausalLM:
+        """
+        Return the model to generate with, whose LM head is restricted to the tokens
+        of `restricted_modality` if it is given.
+
+        The restricted model is a shallow copy of the model built for a single generation,
+        which shares all the weights (see `with_lm_head`), the model itself is never modified.
+        """
+        if restricted_modality is None:
+            return self.model
+        start, end = self._get_restricted_token_range(restricted_modality)
+        return with_lm_head(self.model, RestrictedLMHead(self.model.lm_head, start, end))
+
+    @cache
+    def _get_speech_token_ranges(self) -> Dict[str, Tuple[int, int]]:
+        """
+        Return the token id range [start, end) of each speech token type.
+        """
+        offsets = sorted(
+            self._get_speech_token_offsets().items(), key=lambda item: item[1]
+        )
+        ends = [offset for _, offset in offsets[1:]] + [len(self.tokenizer)]
+        return {
+            tok_type: (offset, end) for (tok_type, offset), end in zip(offsets, ends)
+        }
+
+    def _is_speech_token(self, token_ids: np.ndarray) -> np.ndarray:
+        ranges = self._get_speech_token_ranges().values()
+        start = min(start for start, _ in ranges)
+        end = max(end for _, end in ranges)
+        return (token_ids >= start) & (token_ids < end)
+
+    def _is_hubert_token(self, token_ids: np.ndarray) -> np.ndarray:
+        start, end = self._get_speech_token_ranges()["Hu"]
+        return (token_ids >= start) & (token_ids < end)
+
+    def _count_hubert_tokens(self, token_ids: np.ndarray) -> int:
+        return int(np.count_nonzero(self._is_hubert_token(token_ids)))
+
+    def _get_dropped_token_ids(self) -> List[int]:
+        """The modality prefix tokens and the special tokens, dropped from the generated tokens"""
+        return self.tokenizer.convert_tokens_to_ids(
+            [Spiritlm.TEXT_PROMPT_PREFIX, Spiritlm.SPEECH_PROMPT_PREFIX]
+        ) + list(self.tokenizer.all_special_ids)
+
+    def _split_speech_and_text_ids(
+        self,
+        token_ids: np.ndarray,
+    ) -> List[Tuple[np.ndarray, str]]:
+        """
+        Split the token ids into the speech ("s") and text ("t") spans by token id range.
+        The modality prefix tokens and the special tokens are dropped,
+        so that the spans of the same modality around them are merged.
+        """
+        token_ids = token_ids[~np.isin(token_ids, self._get_dropped_token_ids())]
+        is_speech = self._is_speech_token(token_ids)
+        boundaries = np.flatnonzero(is_speech[1:] != is_speech[:-1]) + 1
+        return [
+            (span_ids, "s" if is_speech[span_start] else "t")
+            for span_ids, span_start in zip(
+                np.split(token_ids, boundaries),
+                np.concatenate([[0], boundaries]),
+            )
+            if len(span_ids)
+        ]
+
+    def _speech_ids_to_units(self, token_ids: np.ndarray) -> Units:
+        """
+        Convert the speech token ids to the units expected by the vocoder,
+        other token ids are ignored.
+        """
+        token_ids = token_ids[self._is_speech_token(token_ids)]
+        tok_types, starts = zip(*self._get_speech_token_ranges().items())
+        tok_types, starts = np.array(tok_types), np.array([s for s, _ in starts])
+        order = np.argsort(starts)
+        type_indices = order[np.searchsorted(starts[order], token_ids, side="right") - 1]
+        return self.speech_tokenizer.tokens2units(
+            tok_types[type_indices], token_ids - starts[type_indices]
+        )
+
+    def _decode_from_generated_ids(
         self,
         output_modality: OutputModality,
-        generated_content: str,
-        prompt: str,
+        generated_ids: Union[List[int], torch.Tensor],
+        prompt_ids: List[int],
         speaker_id: int = 2,
     ) -> InterleavedOutputs:
         """
-        Decode the generated tokens according the modality direction.
+        Decode the generated token ids according the modality direction.
 
-        If the output is text, we return what it is.
-        If the output is speech, we decode speech tokens by the speech tokenizer.
-        If the output is arbitrary, we decode the generated content according to the its modality.
+        If the output is text, we detokenize the generated ids.
+        If the output is speech, we decode speech units by the speech tokenizer.
+        If the output is arbitrary, we split the generated ids into speech and text spans
+        by token id range and decode each span according to its modality.
         """
+        return self._decode_output_spans(
+            [self._get_output_spans(output_modality, generated_ids, prompt_ids)],
+            speaker_id=speaker_id,
+        )[0]
 
-        def _decode(
-            modality: OutputModality,
-            gen: str,
-        ) -> InterleavedOutputs:
-            if modality == OutputModality.TEXT:
-                return [
-                    GenerationOuput(
-                        content=gen,
-                        content_type=ContentType.TEXT,
-                    )
-                ]
-            elif modality == OutputModality.SPEECH:
-                return [
-                    GenerationOuput(
-                        content=self.speech_tokenizer.decode(
-                            gen, speaker_id=speaker_id
-                        ),
-                        content_type=ContentType.SPEECH,
-                    )
-                ]
-            elif modality == OutputModality.ARBITRARY:
-                decoded_chunks = []
-                for i, (chunk_content, chunk_modality) in enumerate(
-                    self._parse_speech_and_text(gen)
-                ):
-                    if chunk_modality == "s":
-                        # TODO: the way of finding Hubert token could be false positive
-                        nb_content_hubert_tokens = len(chunk_content.split("[Hu"))
-                        decoded = _decode(
-                            modality=OutputModality.SPEECH,
-                            gen=chunk_content,
-                        )[0]
-                        if i == 0 and is_last_content_speech:
-                            # edge case when the prompt ends with speech and the generation starts with speech
-                            nb_prompt_hubert_tokens = (
-                                len(prompt[last_speech_start_pos:].split("[Hu")) - 1
-                            )  # minus the one in prefix
-                            if nb_content_hubert_tokens - nb_prompt_hubert_tokens < 25:
-                                # continued speech from the prompt is too short
-                                continue
-                            # we drop the prompt part from the generation
-                            prompt_ratio = (
-                                nb_prompt_hubert_tokens / nb_content_hubert_tokens
-                            )
-                            decoded.content = decoded.content[
-                                math.ceil(decoded.content.size * prompt_ratio) :
-                            ]
-                        elif i > 0 and nb_content_hubert_tokens < 25:
-                            # new speech in generation is too short
-                            continue
-                    else:
-                        decoded = _decode(
-                            modality=OutputModality.TEXT,
-                            gen=chunk_content,
-                        )[0]
-                    decoded_chunks.append(decoded)
-                return decoded_chunks
-            else:
-                raise ValueError(f"Unknown output_modality: {output_modality}")
+    def _get_output_spans(
+        self,
+        output_modality: OutputModality,
+        generated_ids: Union[List[int], torch.Tensor],
+        prompt_ids: List[int],
+    ) -> List[Tuple[np.ndarray, str, float]]:
+        """
+        Split the generated token ids into the speech ("s") and text ("t") spans to decode,
+        each span comes with the ratio of its audio which belongs to the prompt.
+        """
+        if isinstance(generated_ids, torch.Tensor):
+            generated_ids = generated_ids.cpu().numpy()
+        generated_ids = np.asarray(generated_ids, dtype=np.int64)
 
-        generated_new_content = generated_content[len(prompt) :].strip()
-        is_last_content_speech, last_speech_start_pos = False, 0
+        if output_modality == OutputModality.TEXT:
+            return [(generated_ids, "t", 0.0)]
+        elif output_modality == OutputModality.SPEECH:
+            return [(generated_ids, "s", 0.0)]
+        elif output_modality != OutputModality.ARBITRARY:
+            raise ValueError(f"Unknown output_modality: {output_modality}")
+
+        is_last_content_speech, nb_prompt_hubert_tokens = False, 0
+        prompt_ids = np.asarray(prompt_ids, dtype=np.int64)
+        is_prompt_speech = self._is_speech_token(prompt_ids)
         if (
-            output_modality == OutputModality.ARBITRARY
-            and does_end_with_speech_token(prompt)
-            and does_start_with_speech_token(generated_new_content)
+            len(generated_ids)
+            and len(prompt_ids)
+            and is_prompt_speech[-1]
+            and self._is_speech_token(generated_ids[:1])[0]
         ):
-            is_last_content_speech = True
-            last_speech_start_pos = find_prompt_last_speech_start_position(prompt)
             # If the prompt ends with speech, we decode both the prompt and the generation
             # because we probably don't have pitch and style tokens in the generation.
-            generated_new_content = generated_content[last_speech_start_pos:]
-        return _decode(output_modality, generated_new_content)
+            non_speech_positions = np.flatnonzero(~is_prompt_speech)
+            last_speech_start_pos = (
+                non_speech_positions[-1] + 1 if len(non_speech_positions) else 0
+            )
+            is_last_content_speech = True
+            prompt_speech_ids = prompt_ids[last_speech_start_pos:]
+            nb_prompt_hubert_tokens = self._count_hubert_tokens(prompt_speech_ids)
+            generated_ids = np.concatenate([prompt_speech_ids, generated_ids])
+
+        spans = []
+        for i, (span_ids, span_modality) in enumerate(
+            self._split_speech_and_text_ids(generated_ids)
+        ):
+            prompt_ratio = 0.0
+            if span_modality == "s":
+                # counted as the number of splits on "[Hu" of the content string
+                nb_content_hubert_tokens = self._count_hubert_tokens(span_ids) + 1
+                if i == 0 and is_last_content_speech:
+                    # edge case when the prompt ends with speech and the generation starts with speech
+                    if nb_content_hubert_tokens - nb_prompt_hubert_tokens < 25:
+                        # continued speech from the prompt is too short
+                        continue
+                    # we drop the prompt part from the generation
+                    prompt_ratio = nb_prompt_hubert_tokens / nb_content_hubert_tokens
+                elif i > 0 and nb_content_hubert_tokens < 25:
+                    # new speech in generation is too short
+                    continue
+            spans.append((span_ids, span_modality, prompt_ratio))
+        return spans
+
+    def _decode_output_spans(
+        self,
+        spans_batch: List[List[Tuple[np.ndarray, str, float]]],
+        speaker_id: int = 2,
+    ) -> List[InterleavedOutputs]:
+        """
+        Decode the spans of `_get_output_spans` of each sample,
+        all the speech spans are vocoded as a batch.
+        """
+        speech_spans = [
+            span_ids
+            for spans in spans_batch
+            for span_ids, span_modality, _ in spans
+            if span_modality == "s"
+        ]
+        wavs = iter(
+            self.speech_tokenizer.decode_batch(
+                [self._speech_ids_to_units(span_ids) for span_ids in speech_spans],
+                speaker_id=speaker_id,
+            )
+            if speech_spans
+            else []
+        )
+
+        outputs_batch = []
+        for spans in spans_batch:
+            outputs = []
+            for i, (span_ids, span_modality, prompt_ratio) in enumerate(spans):
+                if span_modality == "s":
+                    wav = next(wavs)
+                    outputs.append(
+                        GenerationOuput(
+                            content=wav[math.ceil(wav.size * prompt_ratio) :],
+                            content_type=ContentType.SPEECH,
+                        )
+                    )
+                else:
+                    text = self.tokenizer.decode(
+                        span_ids,
+                        skip_special_tokens=True,
+                        clean_up_tokenization_spaces=False,
+                    )
+                    # only the whole generation is stripped, not each of its text spans
+                    if i == 0:
+                        text = text.lstrip()
+                    if i == len(spans) - 1:
+                        text = text.rstrip()
+                    outputs.append(
+                        GenerationOuput(content=text, content_type=ContentType.TEXT)
+                    )
+            outputs_batch.append(outputs)
+        return outputs_batch
+
+    def _generate_ids(
+        self,
+        prompt_ids: List[int],
+        output_modality: OutputModality,
+        generation_config: GenerationConfig,
+        force_tokens_to_output_modality: bool = True,
+        restrict_lm_head: bool = False,
+        streamer: Optional[BaseStreamer] = None,
+        stopping_criteria: Optional[StoppingCriteriaList] = None,
+    ) -> torch.Tensor:
+        """
+        Run the model generation on the prompt token ids and return the prompt and generated ids of shape (1, T).
+        """
+        input_ids = torch.tensor([prompt_ids], device=self.device)
+
+        # Get the forbidden tokens mask, not needed if the LM head is restricted to the allowed tokens
+        logits_processor = LogitsProcessorList()
+        restricted_modality = None
+        if (
+            force_tokens_to_output_modality
+            and restrict_lm_head
+            and self._get_restricted_token_range(output_modality) is not None
+        ):
+            restricted_modality = output_modality
+        elif force_tokens_to_output_modality:
+            forbidden_tokens_mask = self._build_forbidden_tokens_mask(output_modality)
+            if forbidden_tokens_mask is not None:
+                logits_processor.append(
+                    ForbiddenTokensLogitsProcessor(forbidden_tokens_mask)
+                )
+
+        # Reuse the KV cache of the longest cached prompt prefix, at least one token is prefilled,
+        # the cache holds the KV tensors of a single row: generate expands the prompt to
+        # the beams and the returned sequences but not the past key values.
+        past_key_values = None
+        if self._prefix_cache is not None:
+            num_cached_tokens, kv_tensors = self._prefix_cache.match(prompt_ids[:-1])
+            if num_cached_tokens > 0:
+                expand_size = max(
+                    generation_config.num_beams or 1,
+                    generation_config.num_return_sequences or 1,
+                )
+                past_key_values = build_kv_cache(
+                    [
+                        (
+                            key.expand(expand_size, -1, -1, -1),
+                            value.expand(expand_size, -1, -1, -1),
+                        )
+                        for key, value in kv_tensors
+                    ]
+                )
+            _logger.debug(
+                f"Prefix cache: {num_cached_tokens}/{len(prompt_ids)} prompt tokens cached"
+            )
+
+        outputs = self._get_generation_model(restricted_modality).generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            generation_config=generation_config,
+            logits_processor=logits_processor,
+            pad_token_id=-1,
+            past_key_values=past_key_values,
+            return_dict_in_generate=True,
+            streamer=streamer,
+            stopping_criteria=stopping_criteria,
+        )
+
+        # Cache the KV tensors of the prompt, which are the same on all the rows
+        if self._prefix_cache is not None:
+            self._prefix_cache.insert(
+                prompt_ids,
+                [
+                    (key[:1], value[:1])
+                    for key, value in get_kv_cache_tensors(outputs.past_key_values)
+                ],
+            )
+        return outputs.sequences
 
     def generate(
         self,
@@ -443,6 +750,7 @@ class Spiritlm:
         speaker_id: int = 2,
         return_prompt: bool = False,
         seed: Optional[int] = None,
+        restrict_lm_head: bool = False,
         **kwargs,  # GenerationConfig args can be passing here
     ) -> Union[InterleavedOutputs, Tuple[InterleavedOutputs, str]]:
         """
@@ -471,6 +779,10 @@ class Spiritlm:
                 Speaker id, 0, 1, 2 or 3.
             return_prompt (bool):
                 Whether to return the constructed prompt (could be used for debug).
+            restrict_lm_head (bool):
+                Whether to compute only the logits of the speech tokens when the output modality is SPEECH
+                and force_tokens_to_output_modality is True. This skips the rows of the LM head
+                that would be forbidden anyway. The other output modalities use the forbidden tokens mask.
             **kwargs:
                 Directly passing arguments from transformers.GenerationConfig (e.g. temperature, max_new_tokens, do_sample).
                 See: https://huggingface.co/docs/transformers/main_classes/text_generation#transformers.GenerationConfig
@@ -484,71 +796,414 @@ class Spiritlm:
         output_modality = _convert_str_output_modality(output_modality)
 
         # Get the input prompt
-        assert not (
-            interleaved_inputs is None and prompt is None
-        ), "interleaved_inputs and prompt can not both be None"
-        if (
-            prompt is not None
-            and interleaved_inputs is not None
-            and len(interleaved_inputs) > 0
-        ):
-            _logger.warning(
-                "When prompt is specified, interleaved_inputs will not be used."
+        prompt_ids = self._get_prompt_ids(interleaved_inputs, prompt, output_modality)
+
+        # Get generation config from kwargs
+        generation_config = _overwrite_generation_config(generation_config, kwargs)
+
+        # Perform the generation
+        generate_ids = self._generate_ids(
+            prompt_ids,
+            output_modality=output_modality,
+            generation_config=generation_config,
+            force_tokens_to_output_modality=force_tokens_to_output_modality,
+            restrict_lm_head=restrict_lm_head,
+        )
+
+        # Decode the output
+        generated_ids = generate_ids[0, len(prompt_ids) :]
+        try:
+            decoded_output = self._decode_from_generated_ids(
+                output_modality=output_modality,
+                generated_ids=generated_ids,
+                prompt_ids=prompt_ids,
+                speaker_id=speaker_id,
             )
-        if prompt is None:
-            if not isinstance(interleaved_inputs, list):
-                interleaved_inputs = [interleaved_inputs]
-            interleaved_inputs = _get_generation_inputs(interleaved_inputs)
-            prompt = self._build_prompt(
-                interleaved_inputs,
-                output_modality,
+        except Exception as e:
+            _logger.error(
+                f"Fail to decode the content: {self._decode_ids(generated_ids)}"
             )
+            raise e
+
+        if return_prompt:
+            return decoded_output, self._decode_ids(prompt_ids)
+        else:
+            return decoded_output
+
+    def generate_stream(
+        self,
+        interleaved_inputs: Optional[List[Union[GenerationInput, tuple]]] = None,
+        prompt: Optional[str] = None,
+        output_modality: Union[OutputModality, str] = OutputModality.ARBITRARY,
+        generation_config: Optional[GenerationConfig] = None,
+        force_tokens_to_output_modality: bool = True,
+        speaker_id: int = 2,
+        seed: Optional[int] = None,
+        restrict_lm_head: bool = False,
+        speech_chunk_size: int = 50,
+        vocode_speech: bool = True,
+        **kwargs,  # GenerationConfig args can be passing here
+    ) -> Iterator[Union[TextDelta, SpeechChunk]]:
+        """
+        Speech/text generation given speech/text prompt, streaming the outputs as they are generated.
 
-        # Get input tensor
-        inputs = self.tokenizer(prompt, return_tensors="pt").to(self.device)
+        Yield `TextDelta` events with the text generated since the previous event,
+        and `SpeechChunk` events with the units (and the waveform if `vocode_speech`)
+        of every `speech_chunk_size` generated hubert tokens and of the end of each speech span.
+        The waveforms of a speech span are synthesized incrementally (see `decode_stream`),
+        so that their concatenation is the waveform of the whole span.
+        The model generation runs in a background thread, which is stopped and joined
+        when the iteration ends, including when the consumer stops iterating early
+        (e.g. `close()` of the returned generator).
+
+        The other parameters are the same as `generate`. Unlike `generate`, the speech spans
+        are streamed without waiting for their end, so the short speech spans are not discarded
+        and the speech continuing the prompt speech is vocoded without the prompt.
+        """
+        if seed is not None:
+            _logger.info(f"Set seed to {seed}")
+            set_seed(seed)
+
+        output_modality = _convert_str_output_modality(output_modality)
+        prompt_ids = self._get_prompt_ids(interleaved_inputs, prompt, output_modality)
+        generation_config = _overwrite_generation_config(generation_config, kwargs)
+
+        streamer = TokenIdsIteratorStreamer()
+        # set when the consumer stops iterating, to stop the generation
+        stop_event = Event()
+        errors = []
+
+        def _generate():
+            try:
+                self._generate_ids(
+                    prompt_ids,
+                    output_modality=output_modality,
+                    generation_config=generation_config,
+                    force_tokens_to_output_modality=force_tokens_to_output_modality,
+                    restrict_lm_head=restrict_lm_head,
+                    streamer=streamer,
+                    stopping_criteria=StoppingCriteriaList(
+                        [EventStoppingCriteria(stop_event)]
+                    ),
+                )
+            except Exception as e:
+                errors.append(e)
+                streamer.end()
+
+        thread = Thread(target=_generate, daemon=True)
+        thread.start()
+
+        # as in `generate`, all the tokens are decoded to the output modality if it is not ARBITRARY
+        if output_modality == OutputModality.TEXT:
+            is_speech_token = lambda token_ids: np.zeros(len(token_ids), dtype=bool)
+        elif output_modality == OutputModality.SPEECH:
+            is_speech_token = lambda token_ids: np.ones(len(token_ids), dtype=bool)
+        else:
+            is_speech_token = self._is_speech_token
+        parser = IncrementalSpeechTextParser(
+            decode_text=self._decode_ids,
+            is_speech_token=is_speech_token,
+            is_hubert_token=self._is_hubert_token,
+            dropped_token_ids=self._get_dropped_token_ids(),
+            speech_chunk_size=speech_chunk_size,
+        )
+        # the last style and pitch tokens of the prompt or of the previous chunk,
+        # so that the units of a chunk continue the previous ones
+        prompt_ids = np.asarray(prompt_ids, dtype=np.int64)
+        speech_context_ids = self._get_speech_context_ids(prompt_ids)
+
+        # vocoder stream of the current speech span
+        decode_stream = None
+
+        def _to_events(parsed_events) -> List[Union[TextDelta, SpeechChunk]]:
+            nonlocal speech_context_ids, decode_stream
+            events = []
+            for parsed_event in parsed_events:
+                if parsed_event[0] == "t":
+                    events.append(TextDelta(content=parsed_event[1]))
+                    continue
+                _, speech_ids, is_last = parsed_event
+                speech_ids = np.concatenate([speech_context_ids, speech_ids])
+                units = self._speech_ids_to_units(speech_ids)
+                speech_context_ids = (
+                    np.array([], dtype=np.int64)
+                    if is_last
+                    else self._get_speech_context_ids(speech_ids)
+                )
+                has_units = len(units.arrays[self.speech_tokenizer.hubert_key]) > 0
+                if not has_units and not (is_last and decode_stream is not None):
+                    continue
+                wav = None
+                if vocode_speech:
+                    # the audio of the last frames of a chunk is delayed to the next one
+                    if decode_stream is None:
+                        decode_stream = self.speech_tokenizer.decode_stream(
+                            speaker_id=speaker_id
+                        )
+                    wav = (
+                        decode_stream.push(units)
+                        if has_units
+                        else np.zeros(0, dtype=np.float32)
+                    )
+                    if is_last:
+                        wav = np.concatenate([wav, decode_stream.flush()])
+                        decode_stream = None
+                events.append(SpeechChunk(units=units, content=wav, is_last=is_last))
+            return events
+
+        try:
+            for token_ids in streamer:
+                yield from _to_events(parser.feed(token_ids))
+        finally:
+            # the generation is stopped if the consumer stopped iterating early
+            stop_event.set()
+            thread.join()
+        if errors:
+            raise errors[0]
+        yield from _to_events(parser.flush())
+
+    def _get_speech_context_ids(self, token_ids: np.ndarray) -> np.ndarray:
+        """
+        Return the last style and pitch token ids of the trailing speech span of the token ids.
+        """
+        is_speech = self._is_speech_token(token_ids)
+        non_speech_positions = np.flatnonzero(~is_speech)
+        if len(non_speech_positions):
+            token_ids = token_ids[non_speech_positions[-1] + 1 :]
+        context_ids = []
+        for tok_type in ["St", "Pi"]:
+            start, end = self._get_speech_token_ranges()[tok_type]
+            type_ids = token_ids[(token_ids >= start) & (token_ids < end)]
+            if len(type_ids):
+                context_ids.append(type_ids[-1])
+        return np.array(context_ids, dtype=np.int64)
+
+    def generate_batch(
+        self,
+        interleaved_inputs: Optional[List[List[Union[GenerationInput, tuple]]]] = None,
+        prompts: Optional[List[str]] = None,
+        output_modality: Union[
+            OutputModality, str, List[Union[OutputModality, str]]
+        ] = OutputModality.ARBITRARY,
+        generation_config: Optional[GenerationConfig] = None,
+        force_tokens_to_output_modality: bool = True,
+        speaker_id: int = 2,
+        return_prompt: bool = False,
+        seed: Optional[int] = None,
+        restrict_lm_head: bool = False,
+        **kwargs,  # GenerationConfig args can be passing here
+    ) -> Union[List[InterleavedOutputs], Tuple[List[InterleavedOutputs], List[str]]]:
+        """
+        Speech/text generation for a batch of speech/text prompts.
+
+        The prompts are left-padded and generated with a single `generate` call,
+        then each row is decoded according to its own output modality.
+        With `num_return_sequences` > 1, the `num_return_sequences` outputs of each sample
+        follow each other in the returned list, as the rows of Huggingface `generate`.
+
+        Parameters:
+            interleaved_inputs (List of list of `GenerationInput` or tuples):
+                One list of speech/text inputs per sample, see `generate`.
+            prompts (List of str):
+                One prompt in encoded tokens string per sample, see `generate`.
+            output_modality (str, `OutputModality` or a list of them):
+                The output modality of all the samples, or one output modality per sample.
+            generation_config (`GenerationConfig`):
+                Generation configuration used by Huggingface `generate` function.
+            force_tokens_to_output_modality (bool):
+                Whether to force generating tokens to the output modality of each sample.
+            speaker_id (int):
+                Speaker id, 0, 1, 2 or 3.
+            return_prompt (bool):
+                Whether to return the constructed prompts (could be used for debug).
+            restrict_lm_head (bool):
+                Whether to compute only the logits of the speech tokens,
+                only applied when all the samples have the SPEECH output modality, see `generate`.
+            **kwargs:
+                Directly passing arguments from transformers.GenerationConfig (e.g. temperature, max_new_tokens, do_sample).
+        """
+
+        if seed is not None:
+            _logger.info(f"Set seed to {seed}")
+            set_seed(seed)
+
+        assert not (
+            interleaved_inputs is None and prompts is None
+        ), "interleaved_inputs and prompts can not both be None"
+        batch_size = len(prompts) if prompts is not None else len(interleaved_inputs)
+        if interleaved_inputs is None:
+            interleaved_inputs = [None] * batch_size
+        if prompts is None:
+            prompts = [None] * batch_size
+        assert (
+            len(interleaved_inputs) == len(prompts) == batch_size
+        ), "interleaved_inputs and prompts should have the same length"
+
+        # Set the output modalities
+        if not isinstance(output_modality, list):
+            output_modality = [output_modality] * batch_size
+        assert (
+            len(output_modality) == batch_size
+        ), f"expects {batch_size} output modalities, found {len(output_modality)}"
+        output_modalities = [
+            _convert_str_output_modality(modality) for modality in output_modality
+        ]
+
+        # Get the input prompts
+        prompts_ids = [
+            self._get_prompt_ids(sample_inputs, sample_prompt, modality)
+            for sample_inputs, sample_prompt, modality in zip(
+                interleaved_inputs, prompts, output_modalities
+            )
+        ]
+
+        # Get left-padded input tensors
+        input_ids, attention_mask = _left_pad(
+            prompts_ids,
+            pad_token_id=self.tokenizer.unk_token_id,
+        )
 
         # Get generation config from kwargs
         generation_config = _overwrite_generation_config(generation_config, kwargs)
+        num_return_sequences = generation_config.num_return_sequences or 1
 
-        # Get forbidden token ids
+        # Get the forbidden tokens mask of each sample
+        logits_processor = LogitsProcessorList()
+        restricted_modality = None
         if (
             force_tokens_to_output_modality
-            and output_modality != OutputModality.ARBITRARY
+            and restrict_lm_head
+            and len(set(output_modalities)) == 1
+            and self._get_restricted_token_range(output_modalities[0]) is not None
         ):
-            forbidden_token_ids = [
-                [tok_id] for tok_id in self._build_forbidden_tokens(output_modality)
+            restricted_modality = output_modalities[0]
+        elif force_tokens_to_output_modality:
+            masks = [
+                self._build_forbidden_tokens_mask(modality)
+                for modality in output_modalities
             ]
-        else:
-            forbidden_token_ids = None
+            if any(mask is not None for mask in masks):
+                no_forbidden_tokens = torch.zeros(
+                    self.model.config.vocab_size, dtype=torch.bool, device=self.device
+                )
+                forbidden_tokens_mask = torch.stack(
+                    [no_forbidden_tokens if mask is None else mask for mask in masks]
+                )
+                if len(set(output_modalities)) == 1:
+                    forbidden_tokens_mask = forbidden_tokens_mask[0]
+                else:
+                    # the prompts are expanded to one row per beam or returned sequence
+                    forbidden_tokens_mask = forbidden_tokens_mask.repeat_interleave(
+                        max(generation_config.num_beams, num_return_sequences), dim=0
+                    )
+                logits_processor.append(
+                    ForbiddenTokensLogitsProcessor(forbidden_tokens_mask)
+                )
 
         # Perform the generation
-        generate_ids = self.model.generate(
-            **inputs,
+        generate_ids = self._get_generation_model(restricted_modality).generate(
+            input_ids=input_ids.to(self.device),
+            attention_mask=attention_mask.to(self.device),
             generation_config=generation_config,
-            bad_words_ids=forbidden_token_ids,
-            pad_token_id=-1,
+            logits_processor=logits_processor,
+            pad_token_id=self.tokenizer.unk_token_id,
         )
 
-        # Decode the output
-        gen = self.tokenizer.batch_decode(
-            generate_ids, skip_special_tokens=True, clean_up_tokenization_spaces=False
-        )[0]
+        # Decode the output of each sample, the prompts are left-padded to the same length,
+        # the speech of all the samples is vocoded as a batch
+        # the rows of the sequences of a sample follow each other
+        assert generate_ids.size(0) == batch_size * num_return_sequences
+        spans_batch = []
+        for row, generated_ids in enumerate(generate_ids[:, input_ids.size(1) :]):
+            prompt_ids = prompts_ids[row // num_return_sequences]
+            modality = output_modalities[row // num_return_sequences]
+            try:
+                spans_batch.append(
+                    self._get_output_spans(
+                        output_modality=modality,
+                        generated_ids=generated_ids,
+                        prompt_ids=prompt_ids,
+                    )
+                )
+            except Exception as e:
+                _logger.error(
+                    f"Fail to decode the content: {self._decode_ids(generated_ids)}"
+                )
+                raise e
+        decoded_outputs = self._decode_output_spans(spans_batch, speaker_id=speaker_id)
+
+        if return_prompt:
+            return decoded_outputs, [
+                self._decode_ids(prompt_ids) for prompt_ids in prompts_ids
+            ]
+        else:
+            return decoded_outputs
+
+    def submit(
+        self,
+        interleaved_inputs: Optional[List[Union[GenerationInput, tuple]]] = None,
+        prompt: Optional[str] = None,
+        output_modality: Union[OutputModality, str] = OutputModality.ARBITRARY,
+        generation_config: Optional[GenerationConfig] = None,
+        force_tokens_to_output_modality: bool = True,
+        speaker_id: int = 2,
+        **kwargs,  # GenerationConfig args can be passing here
+    ) -> int:
+        """
+        Submit a generation request to the continuous batching engine and return its request id.
+
+        The request is admitted into the running batch at the next engine step,
+        use `poll` to drive the engine and get the decoded output.
+        The parameters are the same as `generate`.
+        """
+        output_modality = _convert_str_output_modality(output_modality)
+        prompt_ids = self._get_prompt_ids(interleaved_inputs, prompt, output_modality)
+
+        generation_config = _overwrite_generation_config(generation_config, kwargs)
+        if force_tokens_to_output_modality:
+            forbidden_tokens_mask = self._build_forbidden_tokens_mask(output_modality)
+        else:
+            forbidden_tokens_mask = None
+
+        request_id = self.engine.submit(
+            prompt_ids,
+            generation_config=generation_config,
+            forbidden_tokens_mask=forbidden_tokens_mask,
+        )
+        self._engine_requests[request_id] = (
+            prompt_ids,
+            output_modality,
+            speaker_id,
+        )
+        return request_id
+
+    def poll(self, request_id: int, step: bool = True) -> Optional[InterleavedOutputs]:
+        """
+        Return the decoded output of a submitted request if it is finished, None otherwise.
+
+        If `step` is True and the request is not finished yet, one engine step is run first
+        (admitting the waiting requests and decoding one token for all the running ones).
+        """
+        assert request_id in self._engine_requests, f"Unknown request id: {request_id}"
+        output_ids = self.engine.poll(request_id)
+        if output_ids is None and step:
+            self.engine.step()
+            output_ids = self.engine.poll(request_id)
+        if output_ids is None:
+            return None
+
+        prompt_ids, output_modality, speaker_id = self._engine_requests.pop(request_id)
         try:
-            decoded_output = self._decode_from_generated_output(
+            return self._decode_from_generated_ids(
                 output_modality=output_modality,
-                generated_content=gen,
-                prompt=prompt,
+                generated_ids=output_ids,
+                prompt_ids=prompt_ids,
                 speaker_id=speaker_id,
             )
         except Exception as e:
-            _logger.error(f"Fail to decode the content: {gen[len(prompt) :].strip()}")
+            _logger.error(f"Fail to decode the content: {self._decode_ids(output_ids)}")
             raise e
 
-        if return_prompt:
-            return decoded_output, prompt
-        else:
-            return decoded_output
-
 
 if __name__ == "__main__":
     spirit_lm = Spiritlm("spirit-lm-expressive-7b")
@@ -0,0 +1,184 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the FAIR Noncommercial Research License
+# found in the LICENSE file in the root directory of this source tree.
+
+# Streaming helpers of `Spiritlm.generate_stream`: a streamer receiving the token ids
+# from the HF generation loop, and an incremental version of the speech/text parsing
+# of the generated tokens.
+
+from queue import Queue
+from threading import Event
+from typing import Callable, Iterable, List, Optional, Tuple, Union
+
+import numpy as np
+import torch
+from transformers import StoppingCriteria
+from transformers.generation.streamers import BaseStreamer
+
+
+class TokenIdsIteratorStreamer(BaseStreamer):
+    """
+    Streamer putting the generated token ids (of a single sequence) into a queue,
+    to be iterated from another thread than the one running `generate`.
+    The prompt, which is the first value put by `generate`, is skipped.
+    """
+
+    def __init__(self, timeout: Optional[float] = None):
+        self.queue = Queue()
+        self.timeout = timeout
+        self.stop_signal = None
+        self.next_tokens_are_prompt = True
+
+    def put(self, value: torch.Tensor):
+        if self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+        assert value.dim() == 1 or value.size(0) == 1, "only supports batch size 1"
+        self.queue.put(value.view(-1).tolist())
+
+    def end(self):
+        self.queue.put(self.stop_signal)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> List[int]:
+        value = self.queue.get(timeout=self.timeout)
+        if value is self.stop_signal:
+            raise StopIteration()
+        return value
+
+
+class EventStoppingCriteria(StoppingCriteria):
+    """
+    Stop the generation of all the sequences once `event` is set,
+    e.g. when the consumer of a stream stops iterating.
+    """
+
+    def __init__(self, event: Event):
+        self.event = event
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs
+    ) -> torch.BoolTensor:
+        return torch.full(
+            (input_ids.size(0),),
+            self.event.is_set(),
+            dtype=torch.bool,
+            device=input_ids.device,
+        )
+
+
+# parsed events: ("t", text delta) or ("s", speech token ids, whether the speech span is closed)
+ParsedEvent = Union[Tuple[str, str], Tuple[str, np.ndarray, bool]]
+
+
+class IncrementalSpeechTextParser:
+    """
+    Incremental version of the splitting of the generated tokens into speech and text spans.
+
+    The token ids are fed as they are generated. Text is returned as deltas of the detokenized
+    (and stripped) span, only the window of the last token ids is detokenized at each feed,
+    with the previous token ids as context for the tokenizer (e.g. the spaces of "▁" tokens).
+    Speech token ids are returned by chunks of `speech_chunk_size`
+    hubert tokens, and when the speech span is closed by a text token or by the end of the generation.
+    The modality prefix tokens and the special tokens (`dropped_token_ids`) are dropped.
+    """
+
+    def __init__(
+        self,
+        decode_text: Callable[[List[int]], str],
+        is_speech_token: Callable[[np.ndarray], np.ndarray],
+        is_hubert_token: Callable[[np.ndarray], np.ndarray],
+        dropped_token_ids: Iterable[int],
+        speech_chunk_size: int = 50,
+    ):
+        assert speech_chunk_size > 0, "speech_chunk_size should be positive"
+        self.decode_text = decode_text
+        self.is_speech_token = is_speech_token
+        self.is_hubert_token = is_hubert_token
+        self.dropped_token_ids = list(dropped_token_ids)
+        self.speech_chunk_size = speech_chunk_size
+
+        self.modality = None  # "s" or "t", modality of the current span
+        self.text_ids: List[int] = []  # token ids of the current text span
+        # text_ids[prefix_offset:read_offset] are the context of the window to detokenize,
+        # the text of text_ids[:read_offset] is already returned
+        self.prefix_offset = 0
+        self.read_offset = 0
+        self.text_started = False  # whether some non-space text of the span is returned
+        self.trailing_spaces = ""  # the spaces held back until some text follows them
+        self.speech_ids: List[int] = []  # speech token ids not returned yet
+        self.num_hubert_tokens = 0  # number of hubert tokens in speech_ids
+
+    def feed(self, token_ids: List[int]) -> List[ParsedEvent]:
+        token_ids = np.asarray(token_ids, dtype=np.int64)
+        token_ids = token_ids[~np.isin(token_ids, self.dropped_token_ids)]
+        is_speech = self.is_speech_token(token_ids)
+        is_hubert = self.is_hubert_token(token_ids)
+        events = []
+        for token_id, token_is_speech, token_is_hubert in zip(
+            token_ids.tolist(), is_speech.tolist(), is_hubert.tolist()
+        ):
+            modality = "s" if token_is_speech else "t"
+            if modality != self.modality:
+                events += self._close_span()
+                self.modality = modality
+            if modality == "s":
+                if (
+                    token_is_hubert
+                    and self.num_hubert_tokens >= self.speech_chunk_size
+                ):
+                    # the chunk is full, the new hubert token starts the next one
+                    events.append(
+                        ("s", np.array(self.speech_ids, dtype=np.int64), False)
+                    )
+                    self.speech_ids, self.num_hubert_tokens = [], 0
+                self.speech_ids.append(token_id)
+                self.num_hubert_tokens += int(token_is_hubert)
+            else:
+                self.text_ids.append(token_id)
+        if self.modality == "t":
+            events += self._text_delta()
+        return events
+
+    def flush(self) -> List[ParsedEvent]:
+        """Close the current span at the end of the generation"""
+        events = self._close_span()
+        self.modality = None
+        return events
+
+    def _text_delta(self) -> List[ParsedEvent]:
+        prefix_text = self.decode_text(
+            self.text_ids[self.prefix_offset : self.read_offset]
+        )
+        text = self.decode_text(self.text_ids[self.prefix_offset :])
+        if len(text) <= len(prefix_text) or text.endswith("\ufffd"):
+            # no new text, or an incomplete unicode character, wait for the next tokens
+            return []
+        delta = text[len(prefix_text) :]
+        self.prefix_offset, self.read_offset = self.read_offset, len(self.text_ids)
+
+        # strip the text of the span
+        if not self.text_started:
+            delta = delta.lstrip()
+            if not delta:
+                return []
+            self.text_started = True
+        delta = self.trailing_spaces + delta
+        stripped_delta = delta.rstrip()
+        self.trailing_spaces = delta[len(stripped_delta) :]
+        return [("t", stripped_delta)] if stripped_delta else []
+
+    def _close_span(self) -> List[ParsedEvent]:
+        events = []
+        if self.modality == "t":
+            events += self._text_delta()
+            self.text_ids, self.prefix_offset, self.read_offset = [], 0, 0
+            self.text_started, self.trailing_spaces = False, ""
+        elif self.modality == "s":
+            events.append(("s", np.array(self.speech_ids, dtype=np.int64), True))
+            self.speech_ids, self.num_hubert_tokens = [], 0
+        return events
@@ -4,32 +4,19 @@
 # This source code is licensed under the FAIR Noncommercial Research License
 # found in the LICENSE file in the root directory of this source tree.
 
+import copy
 import os
-import re
 from io import BytesIO
-from typing import List, Optional, Union
+from typing import List, Tuple, Union
 
 import numpy as np
 import torch
 import torchaudio
+from transformers import DynamicCache, LogitsProcessor
 
 EXPECTED_SAMPLING_RATE = 16_000
 
 
-def find_prompt_last_speech_start_position(prompt: str) -> Optional[int]:
-    prev_end = None
-    # revert the prompt so we can search from right to left, the speech token patterns are also reverted.
-    for match in re.finditer("(\]\d+uH\[)|(\]\d+iP\[)|(\]\d+tS\[)", prompt[::-1]):
-        start, end = match.start(), match.end()
-        if prev_end is not None and start != prev_end:
-            return len(prompt) - prev_end
-        prev_end = end
-    if prev_end is None:
-        # speech token is not found in the prompt
-        return None
-    return len(prompt) - prev_end
-
-
 def convert_to_wav_tensor(
     content: Union[str, os.PathLike, torch.Tensor, np.ndarray]
 ) -> torch.Tensor:
@@ -56,49 +43,6 @@ def convert_to_wav_tensor(
     return wav.squeeze()
 
 
-def does_start_with_speech_token(encoded_string) -> bool:
-    if (
-        encoded_string is None or len(encoded_string) <= 4
-    ):  # shortest speech token is "[Hu1]"
-        return False
-    if encoded_string[0] != "[":
-        return False
-    end_pos = 1
-    while end_pos < len(encoded_string):
-        if encoded_string[end_pos] == "]" and end_pos >= 4:
-            if any(encoded_string[1:3].startswith(tok) for tok in ["Hu", "Pi", "St"]):
-                return True
-            return False
-        # longest speech token is "[Huxxxxx]"
-        if end_pos >= 10:
-            return False
-        end_pos += 1
-    return False
-
-
-def does_end_with_speech_token(encoded_string: str) -> bool:
-    if (
-        encoded_string is None or len(encoded_string) <= 4
-    ):  # shortest speech token is "[Hu1]"
-        return False
-    if encoded_string[-1] != "]":
-        return False
-    start_pos = len(encoded_string) - 2
-    while start_pos >= 0:
-        if encoded_string[start_pos] == "[" and start_pos + 3 < len(encoded_string):
-            if any(
-                encoded_string[start_pos + 1 : start_pos + 3].startswith(tok)
-                for tok in ["Hu", "Pi", "St"]
-            ):
-                return True
-            return False
-        # longest speech token is "[Huxxxxx]"
-        if start_pos < len(encoded_string) - 10:
-            return False
-        start_pos -= 1
-    return False
-
-
 def get_forbidden_tokens(
     ban_special_tokens: bool = True,
     generate_only_speech: bool = False,
@@ -124,3 +68,95 @@ def get_forbidden_tokens(
                 range(32567, 32567 + 100)
             )  # forbidden style tokens
     return forbidden_tokens
+
+
+class ForbiddenTokensLogitsProcessor(LogitsProcessor):
+    """
+    Set the scores of the forbidden tokens to -inf with a precomputed boolean mask,
+    of shape (vocab_size,) shared by all the sequences or (batch_size, vocab_size).
+
+    This replaces `bad_words_ids` made of one singleton per forbidden token,
+    which is walked token by token at every decoding step.
+    """
+
+    def __init__(self, forbidden_tokens_mask: torch.Tensor):
+        assert forbidden_tokens_mask.dtype == torch.bool
+        assert forbidden_tokens_mask.dim() in [1, 2], forbidden_tokens_mask.shape
+        self.forbidden_tokens_mask = forbidden_tokens_mask
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        mask = self.forbidden_tokens_mask[..., : scores.size(-1)]
+        if mask.device != scores.device:
+            mask = mask.to(scores.device)
+        return scores.masked_fill(mask, -float("inf"))
+
+
+class RestrictedLMHead(torch.nn.Module):
+    """
+    LM head computing the logits of the contiguous token ids [start, end) only,
+    e.g. the speech tokens.
+
+    The weight rows of the allowed token ids are a view of the original `lm_head`,
+    and the logits are written to their global ids in a full-vocabulary buffer filled with -inf,
+    so that the sampled indices are the global token ids. The buffer is filled once and reused
+    as long as the shape of the logits is the same, so the head should not be shared by
+    concurrent generations (it is cheap to build one per generation).
+    """
+
+    def __init__(self, lm_head: torch.nn.Linear, start: int, end: int):
+        super().__init__()
+        assert 0 <= start < end <= lm_head.out_features, (start, end)
+        self.vocab_size = lm_head.out_features
+        self.start, self.end = start, end
+        self.weight = lm_head.weight[start:end]
+        self.bias = lm_head.bias[start:end] if lm_head.bias is not None else None
+        self._full_logits = None
+
+    def forward(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        logits = torch.nn.functional.linear(hidden_states, self.weight, self.bias)
+        shape = (*logits.shape[:-1], self.vocab_size)
+        if (
+            self._full_logits is None
+            or self._full_logits.shape != shape
+            or self._full_logits.dtype != logits.dtype
+            or self._full_logits.device != logits.device
+        ):
+            self._full_logits = logits.new_full(shape, -float("inf"))
+        # the logits outside of [start, end) are never written, they stay -inf
+        self._full_logits[..., self.start : self.end] = logits
+        return self._full_logits
+
+
+def with_lm_head(model: torch.nn.Module, lm_head: torch.nn.Module) -> torch.nn.Module:
+    """
+    Return a shallow copy of the model whose LM head is replaced by `lm_head`.
+    All the other modules and weights are shared, the original model is not modified,
+    so the copy can be used for a single generation while the model is used elsewhere.
+    """
+    model = copy.copy(model)
+    # the copy shares the submodules dict of the original model, replace it to set the head
+    model._modules = dict(model._modules)
+    model.lm_head = lm_head
+    return model
+
+
+def get_kv_cache_tensors(cache) -> List[Tuple[torch.Tensor, torch.Tensor]]:
+    """
+    Get the list of (key, value) tensors of shape (B, H, L, D) from a HF KV cache,
+    whatever the cache format of the installed transformers version.
+    """
+    if hasattr(cache, "layers"):
+        return [(layer.keys, layer.values) for layer in cache.layers]
+    if hasattr(cache, "key_cache"):
+        return list(zip(cache.key_cache, cache.value_cache))
+    return [(key, value) for key, value in cache]  # legacy tuple format
+
+
+def build_kv_cache(kv_tensors: List[Tuple[torch.Tensor, torch.Tensor]]) -> DynamicCache:
+    """Build a HF DynamicCache from a list of (key, value) tensors of shape (B, H, L, D)"""
+    cache = DynamicCache()
+    for layer_idx, (key, value) in enumerate(kv_tensors):
+        cache.update(key, value, layer_idx)
+    return cache
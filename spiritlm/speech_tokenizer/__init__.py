@@ -9,6 +9,8 @@ from .hifigan import spiritlm_base_hifigan, spiritlm_expressive_hifigan_w2v2
 from .hubert import spiritlm_hubert
 from .spiritlm_tokenizer import SpiritLMTokenizer
 from .style_encoder import spiritlm_expressive_style_encoder_w2v2
+from .units import Units
+from .units_corpus import UnitsCorpus, UnitsCorpusWriter
 
 # Trick to avoid reloading the same model twice when calling multiple times
 HUBERT = None
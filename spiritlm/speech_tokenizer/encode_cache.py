@@ -0,0 +1,123 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the FAIR Noncommercial Research License
+# found in the LICENSE file in the root directory of this source tree.
+
+# Content-addressed cache of the units extracted by `SpiritLMTokenizer.encode_units`:
+# the units are keyed by a hash of the waveform and of the tokenizer configuration,
+# so that the same audio (e.g. few-shot examples, repeated uploads) is only tokenized once.
+
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Union
+
+import numpy as np
+import torch
+
+_logger = logging.getLogger(__name__)
+
+
+def encode_cache_key(audio: torch.Tensor, config: Dict[str, Any]) -> str:
+    """Hash of the waveform (values, dtype and shape) and of the tokenizer configuration"""
+    hasher = hashlib.blake2b(digest_size=20)
+    hasher.update(json.dumps(config, sort_keys=True).encode("utf-8"))
+    audio = np.ascontiguousarray(audio.detach().cpu().numpy())
+    hasher.update(f"{audio.dtype}{audio.shape}".encode("utf-8"))
+    hasher.update(audio)
+    return hasher.hexdigest()
+
+
+class EncodeCache:
+    """
+    Cache of unit arrays keyed by `encode_cache_key`, with an in-memory LRU tier holding at most
+    `max_bytes` of units and an optional on-disk tier in `cache_dir` (one .npz file per entry,
+    without eviction). The cached arrays are read-only.
+
+    The number of memory hits, disk hits and misses are counted in
+    `hits`, `disk_hits` and `misses`.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = 256 * 1024**2,
+        cache_dir: Optional[Union[str, Path]] = None,
+    ):
+        assert max_bytes >= 0, f"max_bytes should be non-negative, found {max_bytes}"
+        self.max_bytes = max_bytes
+        self.cache_dir = Path(cache_dir) if cache_dir is not None else None
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.nbytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._entries: "OrderedDict[str, Dict[str, np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        """Number of entries of the in-memory tier"""
+        return len(self._entries)
+
+    def _disk_path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}.npz"
+
+    def get(self, key: str) -> Optional[Dict[str, np.ndarray]]:
+        with self._lock:
+            arrays = self._entries.get(key)
+            if arrays is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return arrays
+        if self.cache_dir is not None and self._disk_path(key).exists():
+            with np.load(self._disk_path(key)) as npz:
+                arrays = {name: npz[name] for name in npz.files}
+            for array in arrays.values():
+                array.setflags(write=False)
+            with self._lock:
+                self.disk_hits += 1
+                self._insert(key, arrays)
+            return arrays
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, key: str, arrays: Dict[str, np.ndarray]):
+        arrays = {name: np.array(array) for name, array in arrays.items()}
+        for array in arrays.values():
+            array.setflags(write=False)
+        with self._lock:
+            self._insert(key, arrays)
+        if self.cache_dir is not None and not self._disk_path(key).exists():
+            path = self._disk_path(key)
+            path.parent.mkdir(exist_ok=True)
+            # written to a temporary file and renamed, so that the entry only exists complete
+            tmp_path = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, path)
+
+    def _insert(self, key: str, arrays: Dict[str, np.ndarray]):
+        nbytes = sum(array.nbytes for array in arrays.values())
+        if nbytes > self.max_bytes:
+            return
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return
+        self._entries[key] = arrays
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            evicted_key, evicted_arrays = self._entries.popitem(last=False)
+            self.nbytes -= sum(array.nbytes for array in evicted_arrays.values())
+            _logger.debug(f"Evicted {evicted_key} from the encode cache")
+
+    def clear(self):
+        """Clear the in-memory tier (the on-disk tier is kept)"""
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
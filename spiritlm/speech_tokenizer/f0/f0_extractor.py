@@ -5,12 +5,19 @@
 # found in the LICENSE file in the root directory of this source tree.
 
 
+import itertools
 import logging
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
 
 import numpy as np
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import torchaudio
+from torch.nn.utils.rnn import pad_sequence
 
 _logger = logging.getLogger(__name__)
 
@@ -59,7 +66,95 @@ class F0Extractor(nn.Module):
 
 class pYAAPTF0Extractor(F0Extractor):
 
+    def __init__(
+        self,
+        hop_length=80,
+        sampling_rate=16000,
+        interpolate=True,
+    ):
+        super().__init__(
+            hop_length=hop_length, sampling_rate=sampling_rate, interpolate=interpolate
+        )
+        # see enable_process_pool
+        self._executor = None
+
+    def enable_process_pool(self, num_workers=None):
+        """
+        Run the pYAAPT extraction (pure python, under the GIL) on a persistent pool of
+        `num_workers` processes (os.cpu_count() by default): `compute_f0_uv` and
+        `compute_f0_uv_batch` send the waveforms to the workers through shared memory,
+        and the workers are warmed up (imports and a first extraction) when they start.
+        """
+        self.disable_process_pool()
+        num_workers = num_workers or os.cpu_count() or 1
+        # spawn the workers, as CUDA cannot be used in forked processes
+        self._executor = ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_pyaapt_worker,
+            initargs=(type(self), self.hop_length, self.sampling_rate),
+        )
+        _logger.info(f"pYAAPT f0 extraction on {num_workers} worker processes")
+
+    def disable_process_pool(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        self._executor = None
+
+    def compute_f0_uv_batch(self, wavs, interpolate=True):
+        """
+        f0 and vuv of a list of waveforms, extracted in parallel by the process pool if
+        enabled (else one after the other). Return the f0 and vuv [B, T_f0] (padded with
+        zeros) and the number of f0 frames of each waveform, as
+        `FCPEF0Extractor.compute_f0_uv_batch`.
+        """
+        wavs = [_float32_wav(wav) for wav in wavs]
+        if self._executor is None:
+            outputs = [self.compute_f0_uv(wav, interpolate=interpolate) for wav in wavs]
+        else:
+            outputs = self._compute_f0_uv_in_pool(wavs, interpolate)
+        lengths = torch.tensor([len(f0) for f0, _ in outputs])
+        f0 = pad_sequence(
+            [torch.as_tensor(np.asarray(f0)) for f0, _ in outputs], batch_first=True
+        )
+        vuv = pad_sequence(
+            [torch.as_tensor(np.asarray(vuv)) for _, vuv in outputs], batch_first=True
+        )
+        return f0, vuv, lengths
+
+    def _compute_f0_uv_in_pool(self, wavs, interpolate):
+        """
+        Copy the waveforms to one shared memory block and extract their f0 and vuv on
+        the workers, the results are collected in the order of the waveforms
+        """
+        lengths = [len(wav) for wav in wavs]
+        offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        itemsize = np.dtype(np.float32).itemsize
+        shm = shared_memory.SharedMemory(
+            create=True, size=max(1, int(offsets[-1]) * itemsize)
+        )
+        try:
+            buffer = np.ndarray((offsets[-1],), dtype=np.float32, buffer=shm.buf)
+            for wav, offset in zip(wavs, offsets):
+                buffer[offset : offset + len(wav)] = wav
+            del buffer  # the shared memory cannot be closed while it is viewed
+            return list(
+                self._executor.map(
+                    _pyaapt_worker_compute_f0_uv,
+                    itertools.repeat(shm.name),
+                    offsets[:-1].tolist(),
+                    lengths,
+                    itertools.repeat(interpolate),
+                )
+            )
+        finally:
+            shm.close()
+            shm.unlink()
+
     def compute_f0_uv(self, wav, interpolate=True):
+        if self._executor is not None:
+            # in a worker process, to release the GIL of this process
+            return self._compute_f0_uv_in_pool([_float32_wav(wav)], interpolate)[0]
         pitch = self.get_pitch(wav)
         # take interpolate, otherwise pitch.samp_values
         # pyaapt has some problems with pitch.samp_values, so do it manually (from pgslm)
@@ -132,6 +227,42 @@ class pYAAPTF0Extractor(F0Extractor):
         return f0_interp
 
 
+def _float32_wav(wav) -> np.ndarray:
+    if isinstance(wav, torch.Tensor):
+        wav = wav.detach().cpu().numpy()
+    wav = np.asarray(wav, dtype=np.float32).squeeze()
+    assert wav.ndim == 1, f"expects waveforms of shape [T], found {wav.shape}"
+    return wav
+
+
+# pYAAPT extractor of the worker processes of the pool, see enable_process_pool
+_WORKER_EXTRACTOR = None
+
+
+def _init_pyaapt_worker(extractor_class, hop_length, sampling_rate):
+    global _WORKER_EXTRACTOR
+    # the workers run in parallel, one thread each
+    torch.set_num_threads(1)
+    _WORKER_EXTRACTOR = extractor_class(
+        hop_length=hop_length, sampling_rate=sampling_rate
+    )
+    # warm-up: import the pYAAPT dependencies and run a first extraction
+    warmup_wav = np.random.RandomState(0).randn(sampling_rate).astype(np.float32)
+    _WORKER_EXTRACTOR.compute_f0_uv(0.1 * warmup_wav, interpolate=False)
+
+
+def _pyaapt_worker_compute_f0_uv(shm_name, offset, length, interpolate):
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        itemsize = np.dtype(np.float32).itemsize
+        wav = np.ndarray(
+            (length,), dtype=np.float32, buffer=shm.buf, offset=offset * itemsize
+        ).copy()
+    finally:
+        shm.close()
+    return _WORKER_EXTRACTOR.compute_f0_uv(wav, interpolate=interpolate)
+
+
 class FCPEF0Extractor(F0Extractor):
 
     def __init__(
@@ -175,6 +306,51 @@ class FCPEF0Extractor(F0Extractor):
         vuv = 1 - uv
         return f0.squeeze().cpu().numpy(), vuv.squeeze().cpu().numpy()
 
+    @torch.inference_mode()
+    def compute_f0_uv_batch(self, wavs, interpolate=True):
+        """
+        Batched version of `compute_f0_uv` for a list of waveforms of different lengths,
+        which are padded and run in one FCPE inference.
+        Return the f0 and vuv [B, T_f0] on the device of the model (padded with zeros),
+        and the number of f0 frames of each waveform (len(wav) // hop_length + 1).
+        The padding is in the context of the FCPE model, so the f0 of a waveform can
+        slightly differ from `compute_f0_uv` near its end: batches of waveforms of similar
+        lengths should be preferred.
+        """
+        wavs = [torch.as_tensor(wav).squeeze().float() for wav in wavs]
+        for wav in wavs:
+            assert wav.ndim == 1, f"expects waveforms of shape [T], found {wav.shape}"
+        device = self.model.get_device()
+        x = pad_sequence(wavs, batch_first=True).unsqueeze(-1).to(device)
+        model_hop_length = self.model.get_hop_size() * self.sampling_rate
+        model_hop_length /= self.model.get_model_sr()
+        f0, uv = self.model.infer(
+            x,
+            sr=self.sampling_rate,
+            decoder_mode="local_argmax",
+            threshold=0.05,
+            f0_min=50,
+            f0_max=1100,
+            interp_uv=interpolate,
+            # the frames of the model
+            output_interp_target_length=int(x.size(1) // model_hop_length) + 1,
+            retur_uv=True,
+        )
+
+        lengths = torch.tensor([len(wav) // self.hop_length + 1 for wav in wavs])
+        batch_f0 = f0.new_zeros((len(wavs), int(lengths.max())))
+        batch_vuv = f0.new_zeros((len(wavs), int(lengths.max())))
+        for i, (wav, length) in enumerate(zip(wavs, lengths.tolist())):
+            # the frames of the waveform, interpolated to its f0 frames
+            num_frames = int(len(wav) // model_hop_length) + 1
+            item_f0 = f0[i : i + 1, :num_frames].transpose(1, 2)  # (1, 1, num_frames)
+            item_uv = uv[i : i + 1, :num_frames].transpose(1, 2)
+            item_f0 = F.interpolate(item_f0, size=length, mode="nearest")
+            item_uv = F.interpolate(item_uv, size=length, mode="nearest")
+            batch_f0[i, :length] = item_f0[0, 0]
+            batch_vuv[i, :length] = 1 - item_uv[0, 0]
+        return batch_f0, batch_vuv, lengths
+
 
 def load_f0_extractor(
     f0_extractor_method, hop_length, sampling_rate, interpolate, device=None
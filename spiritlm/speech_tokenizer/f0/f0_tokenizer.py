@@ -7,8 +7,10 @@
 
 import logging
 import os
+from typing import List
 
 import torch
+from torch.nn.utils.rnn import pad_sequence
 
 from .f0_extractor import load_f0_extractor
 from .vqvae import load_vqvae
@@ -67,7 +69,25 @@ class F0Tokenizer(torch.nn.Module):
     def device(self):
         return self._float_tensor.device
 
-    def quantize_vqvae(self, f0, vuv, speaker=None, compute_vqvae_pred=False):
+    def enable_process_pool(self, num_workers=None):
+        """
+        Extract the f0 on a persistent pool of `num_workers` processes, for the pyaapt
+        f0 extractor (see `pYAAPTF0Extractor.enable_process_pool`): the waveforms of
+        `forward_batch` are extracted in parallel.
+        """
+        if not hasattr(self.f0_extractor, "enable_process_pool"):
+            raise ValueError(
+                f"{type(self.f0_extractor).__name__} has no process pool mode, "
+                "it is only available for the pyaapt f0 extractor"
+            )
+        self.f0_extractor.enable_process_pool(num_workers)
+
+    def disable_process_pool(self):
+        if hasattr(self.f0_extractor, "disable_process_pool"):
+            self.f0_extractor.disable_process_pool()
+
+    def _vqvae_input(self, f0, vuv, speaker=None) -> torch.Tensor:
+        """The (optionally normalized) f0 and vuv, stacked into the VQ-VAE input (2, T)"""
         assert self.quantizer_cfg.features in [
             "f0_interp,vuv",
             "f0,vuv",
@@ -94,18 +114,63 @@ class F0Tokenizer(torch.nn.Module):
                 mean = torch.mean(f0[vuv_mask])
             f0[mask] = f0[mask] - mean
 
-        x = torch.stack([f0, vuv])  # (2, T)
-        x = x.float().unsqueeze(0).to(self.device)  # (1, 2, T)
+        return torch.stack([f0, vuv]).float()  # (2, T)
+
+    def quantize_vqvae(self, f0, vuv, speaker=None, compute_vqvae_pred=False):
+        x = self._vqvae_input(f0, vuv, speaker=speaker)
+        x = x.unsqueeze(0).to(self.device)  # (1, 2, T)
         if not compute_vqvae_pred:
-            quant_f0 = self.quantizer(x, compute_pred=False)
-            quant_f0 = quant_f0[0].squeeze(0)
-            return quant_f0
+            # only the codes of the first level are used
+            quant_f0 = self.quantizer.encode_codes(x, level=0)
+            return quant_f0.squeeze(0)
         else:
             quant_f0, pred = self.quantizer(x, compute_pred=True)
             quant_f0 = quant_f0[0].squeeze(0)
             pred = pred[0]
             return quant_f0, pred
 
+    def quantize_vqvae_batch(self, f0s, vuvs, speakers=None) -> List[torch.Tensor]:
+        """
+        Batched version of `quantize_vqvae` for lists of f0 and vuv of different lengths,
+        which are padded and encoded at once, returning the codes of each item.
+        """
+        if speakers is None:
+            speakers = [None] * len(f0s)
+        assert len(f0s) == len(vuvs) == len(speakers), "expects one vuv per f0"
+        if not f0s:
+            return []
+        xs = [
+            self._vqvae_input(f0, vuv, speaker=speaker).transpose(0, 1)
+            for f0, vuv, speaker in zip(f0s, vuvs, speakers)
+        ]
+        lengths = [len(x) for x in xs]
+        x = pad_sequence(xs, batch_first=True).transpose(1, 2).to(self.device)
+        return self.quantizer.encode_codes(x, lengths=lengths, level=0)
+
+    @torch.inference_mode()
+    def forward_batch(self, xs, speakers=None) -> List[torch.Tensor]:
+        """
+        Batched version of `forward` for a list of waveforms of different lengths,
+        returning the codes of each waveform. With the FCPE extractor, their f0 are
+        extracted in one padded inference and stay on the device until they are quantized
+        in one padded batch.
+        """
+        if not xs:
+            return []
+        if hasattr(self.f0_extractor, "compute_f0_uv_batch"):
+            f0, vuv, lengths = self.f0_extractor.compute_f0_uv_batch(
+                xs, interpolate=self.f0_extractor.interpolate
+            )
+            f0s = [f0[i, :length] for i, length in enumerate(lengths.tolist())]
+            vuvs = [vuv[i, :length] for i, length in enumerate(lengths.tolist())]
+        else:
+            f0s, vuvs = [], []
+            for x in xs:
+                f0, vuv = self.f0_extractor(x, vuv=True)
+                f0s.append(f0)
+                vuvs.append(vuv)
+        return self.quantize_vqvae_batch(f0s, vuvs, speakers=speakers)
+
     def forward(self, x, speaker=None, dense=False, compute_vqvae_pred=False):
         f0, vuv = self.f0_extractor(x, vuv=True)
         if dense:
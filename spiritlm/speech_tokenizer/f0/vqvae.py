@@ -53,6 +53,29 @@ class VQVAE(nn.Module):
 
             return codes, x_hat
 
+    @torch.no_grad()
+    def encode_codes(self, x, lengths=None, level=0):
+        """
+        Inference-only encoding of x [N, C, T] into the codes [N, T_level] of `level`:
+        only the encoder levels up to `level` and the quantisation of its bottleneck block
+        are run, without the losses, metrics and dequantisation of `forward`.
+
+        For a padded batch, `lengths` are the lengths of the inputs, and the codes are
+        returned as a list of codes trimmed to their lengths. The padding is set to zero at
+        the input of each convolution, as the zero padding of the convolutions of unpadded
+        inputs, so that the codes match the codes of each input encoded alone.
+        """
+        if lengths is None:
+            for level_block in self.encoder.level_blocks[: level + 1]:
+                x = level_block(x)
+            return self.vq.level_blocks[level].encode_codes(x)
+
+        lengths = torch.as_tensor(lengths, device=x.device)
+        for level_block in self.encoder.level_blocks[: level + 1]:
+            x, lengths = _masked_forward(level_block, x, lengths)
+        codes = self.vq.level_blocks[level].encode_codes(x)
+        return [code[:length] for code, length in zip(codes, lengths.tolist())]
+
 
 class BottleneckBlock(nn.Module):
     def __init__(self, k_bins, emb_width, mu):
@@ -167,18 +190,33 @@ class BottleneckBlock(nn.Module):
         x_l = x_l.view(N, T)
         return x_l, x_d
 
-    def quantise(self, x):
-        # Calculate latent code x_l
+    def _distance(self, x):
         k_w = self.k.t()
-        distance = (
+        return (
             torch.sum(x**2, dim=-1, keepdim=True)
             - 2 * torch.matmul(x, k_w)
             + torch.sum(k_w**2, dim=0, keepdim=True)
         )  # (N * L, b)
-        min_distance, x_l = torch.min(distance, dim=-1)
+
+    def quantise(self, x):
+        # Calculate latent code x_l
+        min_distance, x_l = torch.min(self._distance(x), dim=-1)
         fit = torch.mean(min_distance)
         return x_l, fit
 
+    def encode_codes(self, x):
+        """Codes of x [N, width, T], without the prenorm and fit metrics of `encode`"""
+        N, width, T = x.shape
+        x = x.permute(0, 2, 1).reshape(N * T, width)
+        if width == 2 * self.emb_width:
+            x = x[..., : self.emb_width] + x[..., self.emb_width :]
+        else:
+            assert (
+                width == self.emb_width
+            ), f"Expected {width} to be (1 or 2) * {self.emb_width}"
+        _, x_l = torch.min(self._distance(x), dim=-1)
+        return x_l.view(N, T)
+
     def dequantise(self, x_l):
         x = F.embedding(x_l, self.k)
         return x
@@ -371,6 +409,39 @@ class Resnet1D(nn.Module):
             return self.model(x)
 
 
+def _masked_forward(module, x, lengths):
+    """
+    Run an encoder module on the padded batch x [N, C, T] of the given lengths,
+    setting the padding to zero at the input of each convolution.
+    Return the output and its lengths.
+    """
+    if isinstance(module, nn.Conv1d):
+        mask = torch.arange(x.size(-1), device=x.device)[None, :] < lengths[:, None]
+        x = module(x * mask[:, None, :].to(x.dtype))
+        (kernel_size,), (stride,), (padding,), (dilation,) = (
+            module.kernel_size,
+            module.stride,
+            module.padding,
+            module.dilation,
+        )
+        lengths = (lengths + 2 * padding - dilation * (kernel_size - 1) - 1) // stride + 1
+        return x, lengths
+    if isinstance(module, ResConv1DBlock):
+        y, _ = _masked_forward(module.model, x, lengths)
+        return x + module.res_scale * y, lengths
+    if isinstance(module, (EncoderConvBlock, Resnet1D)):
+        if getattr(module, "checkpoint_res", False) == 1:
+            raise NotImplementedError("Checkpoint not implemented")
+        return _masked_forward(module.model, x, lengths)
+    if isinstance(module, nn.Sequential):
+        for child in module:
+            x, lengths = _masked_forward(child, x, lengths)
+        return x, lengths
+    if isinstance(module, nn.ReLU):
+        return module(x), lengths
+    raise NotImplementedError(f"Masked forward of {type(module).__name__}")
+
+
 def assert_shape(x, exp_shape):
     assert x.shape == exp_shape, f"Expected {exp_shape} got {x.shape}"
 
@@ -13,8 +13,9 @@
 
 import json
 import logging
+import math
 from pathlib import Path
-from typing import Dict
+from typing import Dict, List, Optional
 
 import numpy as np
 import torch
@@ -22,6 +23,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import Conv1d, ConvTranspose1d
 from torch.nn.utils import remove_weight_norm, weight_norm
+from torch.nn.utils.rnn import pad_sequence
 
 _logger = logging.getLogger(__name__)
 
@@ -89,7 +91,7 @@ class HifiGANVocoder(nn.Module):
             code = list(map(int, code))
             code = torch.tensor(code)
         elif isinstance(code, np.ndarray):
-            code = torch.from_numpy(code)
+            code = torch.from_numpy(code.astype(np.int64, copy=False))
         code = code.long()
         if deduplicate_code:
             code = torch.unique_consecutive(code)
@@ -108,6 +110,67 @@ class HifiGANVocoder(nn.Module):
         assert not (
             dur_pred and not self.dur_pred
         ), "Model doesnt't support duration prediction"
+        inp = self._build_inputs(
+            code, speaker_id, style_id, dur_pred, f0_code, style_code, not_dedup_code
+        )
+        return self.vocoder(inp, dur_pred)
+
+    @torch.inference_mode()
+    def decode_batch(
+        self,
+        codes,
+        speaker_id=None,
+        style_id=None,
+        dur_pred=True,
+        f0_codes=None,
+        style_codes=None,
+        not_dedup_code=False,
+    ) -> List[torch.Tensor]:
+        """
+        Batched version of `forward` for a list of codes (and optionally the lists of their
+        f0_codes and style_codes), returning the list of the waveforms.
+        speaker_id and style_id can be a single id or a list of ids (one per sample).
+        """
+        assert not (
+            dur_pred and not self.dur_pred
+        ), "Model doesnt't support duration prediction"
+        batch_size = len(codes)
+        if batch_size == 0:
+            return []
+        if not isinstance(speaker_id, (list, tuple)):
+            speaker_id = [speaker_id] * batch_size
+        if not isinstance(style_id, (list, tuple)):
+            style_id = [style_id] * batch_size
+        if f0_codes is None:
+            f0_codes = [None] * batch_size
+        if style_codes is None:
+            style_codes = [None] * batch_size
+        assert (
+            len(speaker_id)
+            == len(style_id)
+            == len(f0_codes)
+            == len(style_codes)
+            == batch_size
+        ), "expects one speaker_id, style_id, f0_code and style_code per code"
+        inps = [
+            self._build_inputs(
+                code,
+                sample_speaker_id,
+                sample_style_id,
+                dur_pred,
+                f0_code,
+                style_code,
+                not_dedup_code,
+            )
+            for code, sample_speaker_id, sample_style_id, f0_code, style_code in zip(
+                codes, speaker_id, style_id, f0_codes, style_codes
+            )
+        ]
+        return self.vocoder.forward_batch(inps, dur_pred)
+
+    def _build_inputs(
+        self, code, speaker_id, style_id, dur_pred, f0_code, style_code, not_dedup_code
+    ):
         inp = dict()
         inp["code"] = self.preprocess_code(code, dur_pred and not not_dedup_code)
         if f0_code is not None:
@@ -122,8 +185,145 @@ class HifiGANVocoder(nn.Module):
             if style_id is None:
                 style_id = self.default_style
             inp["style"] = torch.LongTensor([style_id]).view(1, 1)
-        inp = {k: v.to(self.device) for k, v in inp.items()}
-        return self.vocoder(inp, dur_pred)
+        return {k: v.to(self.device) for k, v in inp.items()}
+
+    def stream(self, speaker_id=None, style_id=None, dur_pred=True):
+        """
+        Return a `HifiGANVocoderStream` synthesizing the audio of the code chunks pushed to it,
+        the codes are not deduplicated (as with `not_dedup_code=True`).
+        """
+        assert not (
+            dur_pred and not self.dur_pred
+        ), "Model doesnt't support duration prediction"
+        return HifiGANVocoderStream(
+            self, speaker_id=speaker_id, style_id=style_id, dur_pred=dur_pred
+        )
+
+
+class HifiGANVocoderStream:
+    """
+    Incremental synthesis of the codes pushed by chunks, stitched to match the one-shot synthesis.
+
+    The durations of the codes are predicted with the context of the neighbouring codes, and the
+    frames are synthesized with the left and right context of the receptive field of the Generator.
+    The audio of the frames lacking right context is delayed to the next push or to `flush`.
+
+    Example:
+        stream = vocoder.stream(speaker_id=2)
+        for code, f0_code, style_code in chunks:
+            play(stream.push(code, f0_code=f0_code, style_code=style_code))
+        play(stream.flush())
+    """
+
+    def __init__(
+        self,
+        vocoder: HifiGANVocoder,
+        speaker_id=None,
+        style_id=None,
+        dur_pred=True,
+    ):
+        self.vocoder = vocoder
+        self.generator = vocoder.vocoder.model
+        self.dur_pred = dur_pred
+        self.global_inputs = {}
+        if vocoder.multispkr:
+            if speaker_id is None:
+                speaker_id = vocoder.default_speaker
+            self.global_inputs["spkr"] = torch.LongTensor([speaker_id]).view(1, 1)
+        if vocoder.multistyle:
+            if style_id is None:
+                style_id = vocoder.default_style
+            self.global_inputs["style"] = torch.LongTensor([style_id]).view(1, 1)
+        self.global_inputs = {
+            k: v.to(vocoder.device) for k, v in self.global_inputs.items()
+        }
+
+        # context of the duration predictor (in codes) and of the Generator (in frames)
+        self.code_context = (
+            self.generator.dur_predictor.conv1[0].kernel_size[0] if dur_pred else 0
+        )
+        self.frame_context = self.generator.get_receptive_field()
+        self.upsample_factor = int(np.prod([up.stride[0] for up in self.generator.ups]))
+
+        # codes whose durations are not predicted yet, after `num_left_codes` context codes
+        self.codes: Dict[str, torch.Tensor] = {}
+        self.num_left_codes = 0
+        # Generator input features not synthesized yet, after `num_left_frames` context frames
+        self.frames: Optional[torch.Tensor] = None
+        self.num_left_frames = 0
+
+    @torch.inference_mode()
+    def push(self, code, f0_code=None, style_code=None) -> torch.Tensor:
+        """
+        Push a chunk of codes, f0_code and style_code (if any) having one value per code,
+        and return the audio samples which are ready.
+        """
+        chunk = {"code": code, "f0_code": f0_code, "style_code": style_code}
+        for key, value in chunk.items():
+            if value is None:
+                continue
+            value = self.vocoder.preprocess_code(value).to(self.vocoder.device)
+            if key in self.codes:
+                value = torch.cat([self.codes[key], value], dim=1)
+            self.codes[key] = value
+        lengths = {value.size(1) for value in self.codes.values()}
+        assert len(lengths) == 1, f"expects one f0/style code per code, found {lengths}"
+        return self._synthesize(final=False)
+
+    @torch.inference_mode()
+    def flush(self) -> torch.Tensor:
+        """Return the remaining audio samples at the end of the codes"""
+        return self._synthesize(final=True)
+
+    def _synthesize(self, final: bool) -> torch.Tensor:
+        self._expand_codes(final)
+        if self.frames is None:
+            return torch.zeros(0, device=self.vocoder.device)
+        num_frames = self.frames.size(2)
+        ready_end = num_frames if final else num_frames - self.frame_context
+        if ready_end <= self.num_left_frames:
+            return torch.zeros(0, device=self.vocoder.device)
+        input_end = min(num_frames, ready_end + self.frame_context)
+        wav = Generator.forward(self.generator, self.frames[:, :, :input_end])
+        wav = wav.view(-1)[
+            self.num_left_frames
+            * self.upsample_factor : ready_end
+            * self.upsample_factor
+        ]
+        left_start = max(0, ready_end - self.frame_context)
+        self.frames = self.frames[:, :, left_start:]
+        self.num_left_frames = ready_end - left_start
+        return wav.detach()
+
+    def _expand_codes(self, final: bool):
+        """Expand the codes whose durations can be predicted to the Generator input features"""
+        if not self.codes:
+            return
+        num_codes = self.codes["code"].size(1)
+        ready_end = num_codes if final else num_codes - self.code_context
+        if ready_end <= self.num_left_codes:
+            return
+        ready_codes = {
+            key: value[:, self.num_left_codes : ready_end]
+            for key, value in self.codes.items()
+        }
+        if self.dur_pred:
+            dur_out = self.generator.predict_durations(
+                self.codes["code"][:, : min(num_codes, ready_end + self.code_context)]
+            )[:, self.num_left_codes : ready_end]
+            ready_codes = {
+                key: torch.repeat_interleave(value, dur_out.view(-1), dim=1)
+                for key, value in ready_codes.items()
+            }
+        features = self.generator.forward_features(**ready_codes, **self.global_inputs)
+        self.frames = (
+            features
+            if self.frames is None
+            else torch.cat([self.frames, features], dim=2)
+        )
+        left_start = max(0, ready_end - self.code_context)
+        self.codes = {key: value[:, left_start:] for key, value in self.codes.items()}
+        self.num_left_codes = ready_end - left_start
 
 
 class CodeHiFiGANVocoderModel(nn.Module):
@@ -154,8 +354,56 @@ class CodeHiFiGANVocoderModel(nn.Module):
         return upsampled_code
 
     def forward(self, x: Dict[str, torch.Tensor], dur_prediction=False) -> torch.Tensor:
-        assert "code" in x
+        x = self.preprocess_inputs(x, dur_prediction)
         x["dur_prediction"] = dur_prediction
+        return self.model(**x).detach().squeeze()
+
+    def forward_batch(
+        self, xs: List[Dict[str, torch.Tensor]], dur_prediction=False
+    ) -> List[torch.Tensor]:
+        """
+        Synthesize a batch of samples (each one being the input of `forward`) at once,
+        the durations are predicted per sample, then the frames are padded and masked
+        through the Generator and the output of each sample is trimmed to its length.
+        """
+        frame_inputs = []
+        for x in xs:
+            assert "f0" not in x, "f0 input is not supported in batch"
+            x = self.preprocess_inputs(x, dur_prediction)
+            if dur_prediction:
+                dur_out = self.model.predict_durations(x["code"])
+                for key in ["code", "f0_code", "style_code"]:
+                    if key in x:
+                        x[key] = torch.repeat_interleave(
+                            x[key], dur_out.view(-1), dim=1
+                        )
+            frame_inputs.append(x)
+
+        lengths = torch.LongTensor([x["code"].size(1) for x in frame_inputs])
+        batch = {}
+        for key in frame_inputs[0]:
+            if key in ["spkr", "style"]:
+                batch[key] = torch.cat([x[key] for x in frame_inputs], dim=0)
+            else:
+                batch[key] = pad_sequence(
+                    [x[key][0] for x in frame_inputs], batch_first=True
+                )
+        features = self.model.forward_features(**batch)
+        x_mask = (
+            torch.arange(features.size(2), device=features.device)[None, :]
+            < lengths.to(features.device)[:, None]
+        ).unsqueeze(1)
+        wavs = Generator.forward(self.model, features, x_mask.to(features.dtype))
+        upsample_factor = wavs.size(2) // features.size(2)
+        return [
+            wav[0, : length * upsample_factor].detach()
+            for wav, length in zip(wavs, lengths.tolist())
+        ]
+
+    def preprocess_inputs(
+        self, x: Dict[str, torch.Tensor], dur_prediction=False
+    ) -> Dict[str, torch.Tensor]:
+        assert "code" in x
 
         # remove invalid code
         mask = x["code"] >= 0
@@ -184,7 +432,7 @@ class CodeHiFiGANVocoderModel(nn.Module):
                     x["code"], x["style_code"], self.model.hubert_to_style
                 )
 
-        return self.model(**x).detach().squeeze()
+        return x
 
 
 # Higigan Generator
@@ -276,11 +524,15 @@ class ResBlock(nn.Module):
         )
         self.convs2.apply(init_weights)
 
-    def forward(self, x):
+    def forward(self, x, x_mask=None):
         for c1, c2 in zip(self.convs1, self.convs2):
             xt = F.leaky_relu(x, LRELU_SLOPE)
+            if x_mask is not None:
+                xt = xt * x_mask
             xt = c1(xt)
             xt = F.leaky_relu(xt, LRELU_SLOPE)
+            if x_mask is not None:
+                xt = xt * x_mask
             xt = c2(xt)
             x = xt + x
         return x
@@ -335,18 +587,51 @@ class Generator(nn.Module):
         self.ups.apply(init_weights)
         self.conv_post.apply(init_weights)
 
-    def forward(self, x):
+    def get_receptive_field(self) -> int:
+        """
+        Upper bound of the number of input frames on each side of a frame
+        that its output samples depend on.
+        """
+        # radius in samples at the current resolution, from the output to the input
+        radius = self.conv_post.kernel_size[0] // 2
+        for i in reversed(range(self.num_upsamples)):
+            radius += max(
+                sum(
+                    (conv1.kernel_size[0] - 1) // 2 * conv1.dilation[0]
+                    + (conv2.kernel_size[0] - 1) // 2 * conv2.dilation[0]
+                    for conv1, conv2 in zip(resblock.convs1, resblock.convs2)
+                )
+                for resblock in self.resblocks[
+                    i * self.num_kernels : (i + 1) * self.num_kernels
+                ]
+            )
+            up = self.ups[i]
+            radius = math.ceil((radius + up.kernel_size[0]) / up.stride[0])
+        return radius + self.conv_pre.kernel_size[0] // 2
+
+    def forward(self, x, x_mask=None):
+        # x_mask (B x 1 x T) zeroes the padding frames before each convolution,
+        # so that the padded samples of a batch are synthesized as if they were alone
+        if x_mask is not None:
+            x = x * x_mask
         x = self.conv_pre(x)
         for i in range(self.num_upsamples):
+            if x_mask is not None:
+                x = x * x_mask
             x = F.leaky_relu(x, LRELU_SLOPE)
             x = self.ups[i](x)
+            if x_mask is not None:
+                x_mask = torch.repeat_interleave(x_mask, self.ups[i].stride[0], dim=2)
+                x = x * x_mask
             xs = None
             for j in range(self.num_kernels):
                 if xs is None:
-                    xs = self.resblocks[i * self.num_kernels + j](x)
+                    xs = self.resblocks[i * self.num_kernels + j](x, x_mask)
                 else:
-                    xs += self.resblocks[i * self.num_kernels + j](x)
+                    xs += self.resblocks[i * self.num_kernels + j](x, x_mask)
             x = xs / self.num_kernels
+        if x_mask is not None:
+            x = x * x_mask
         x = F.leaky_relu(x)
         x = self.conv_post(x)
         x = torch.tanh(x)
@@ -475,16 +760,22 @@ class CodeGenerator(Generator):
         signal = signal.view(bsz, channels, max_frames)
         return signal
 
+    def predict_durations(self, code: torch.Tensor) -> torch.Tensor:
+        """Predict the number of frames of each code, code: B x T; Output: B x T"""
+        log_dur_pred = self.dur_predictor(self.dict(code))
+        return torch.clamp(torch.round((torch.exp(log_dur_pred) - 1)).long(), min=1)
+
     def forward(self, **kwargs):
+        return super().forward(self.forward_features(**kwargs))
+
+    def forward_features(self, **kwargs):
+        """Build the input features of the Generator, B x C x T"""
         x = self.dict(kwargs["code"]).transpose(1, 2)
 
         dur_out = None
         if self.dur_predictor and kwargs.get("dur_prediction", False):
             assert x.size(0) == 1, "only support single sample"
-            log_dur_pred = self.dur_predictor(x.transpose(1, 2))
-            dur_out = torch.clamp(
-                torch.round((torch.exp(log_dur_pred) - 1)).long(), min=1
-            )
+            dur_out = self.predict_durations(kwargs["code"])
             # B x C x T
             x = torch.repeat_interleave(x, dur_out.view(-1), dim=2)
 
@@ -543,4 +834,4 @@ class CodeGenerator(Generator):
             feat = self._upsample(feat, x.shape[-1])
             x = torch.cat([x, feat], dim=1)
 
-        return super().forward(x)
+        return x
@@ -444,14 +444,16 @@ class HubertModel(torch.nn.Module):
         logits = logits.transpose(0, 1)  # (num_x, num_cls+1)
         return logits
 
-    def forward_features(self, source: torch.Tensor) -> torch.Tensor:
+    def forward_features(
+        self, source: torch.Tensor, padding_mask: Optional[torch.Tensor] = None
+    ) -> torch.Tensor:
         if self.feature_grad_mult > 0:
-            features = self.feature_extractor(source)
+            features = self.feature_extractor(source, padding_mask)
             if self.feature_grad_mult != 1.0:
                 features = GradMultiply.apply(features, self.feature_grad_mult)
         else:
             with torch.no_grad():
-                features = self.feature_extractor(source)
+                features = self.feature_extractor(source, padding_mask)
         return features
 
     def forward_targets(
@@ -474,11 +476,13 @@ class HubertModel(torch.nn.Module):
         features: torch.Tensor,
         padding_mask: torch.Tensor,
     ) -> torch.Tensor:
-        extra = padding_mask.size(1) % features.size(1)
-        if extra > 0:
-            padding_mask = padding_mask[:, :-extra]
-        padding_mask = padding_mask.view(padding_mask.size(0), features.size(1), -1)
-        padding_mask = padding_mask.all(-1)
+        # the frames computed from padding samples are padding
+        input_lengths = (~padding_mask).long().sum(-1)
+        output_lengths = self.feature_extractor.get_output_lengths(input_lengths)
+        padding_mask = (
+            torch.arange(features.size(1), device=features.device)[None, :]
+            >= output_lengths.to(features.device)[:, None]
+        )
         return padding_mask
 
     def forward(
@@ -491,7 +495,7 @@ class HubertModel(torch.nn.Module):
         output_layer: Optional[int] = None,
     ) -> Dict[str, torch.Tensor]:
         """output layer is 1-based"""
-        features = self.forward_features(source)
+        features = self.forward_features(source, padding_mask)
         if target_list is not None:
             features, target_list = self.forward_targets(features, target_list)
 
@@ -599,6 +603,46 @@ class HubertModel(torch.nn.Module):
         feature = res["features"] if ret_conv else res["x"]
         return feature, res["padding_mask"]
 
+    @torch.inference_mode()
+    def extract_features_inference(
+        self,
+        source: torch.Tensor,
+        padding_mask: Optional[torch.Tensor] = None,
+        output_layer: Optional[int] = None,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """
+        Inference version of `extract_features` (output layer is 1-based), skipping the
+        training-only computations (feature penalty, unmasked features, dropout, masking)
+        and keeping only the activations of the output layer.
+        """
+        features = self.feature_extractor(source, padding_mask)
+        features = self.layer_norm(features.transpose(1, 2))
+
+        if padding_mask is not None:
+            padding_mask = self.forward_padding_mask(features, padding_mask)
+
+        if self.post_extract_proj is not None:
+            features = self.post_extract_proj(features)
+
+        x = self.encoder.extract_features_inference(
+            features,
+            padding_mask=padding_mask,
+            tgt_layer=None if output_layer is None else output_layer - 1,
+        )
+        return x, padding_mask
+
+    def prune_for_inference(self, output_layer: Optional[int] = None):
+        """
+        Remove the parameters which are not needed to extract the features
+        of the output layer (1-based): the pretraining modules, the mask embedding
+        and the encoder layers after the output layer.
+        """
+        self.remove_pretraining_modules()
+        self.label_embs_concat = None
+        self.mask_emb = None
+        if output_layer is not None and output_layer < len(self.encoder.layers):
+            self.encoder.layers = self.encoder.layers[:output_layer]
+
     def get_logits(self, net_output, is_masked=True):
         if is_masked:
             logits_list = net_output["logit_m_list"]
@@ -2900,17 +2900,62 @@ class ConvFeatureExtractionModel(nn.Module):
             )
             in_d = dim
 
-    def forward(self, x):
+    def get_output_lengths(self, input_lengths: torch.LongTensor) -> torch.LongTensor:
+        """Number of output frames of the inputs of the given numbers of samples"""
+        for conv in self.conv_layers:
+            kernel_size, stride = conv[0].kernel_size[0], conv[0].stride[0]
+            input_lengths = torch.div(
+                input_lengths - kernel_size, stride, rounding_mode="floor"
+            ) + 1
+        return input_lengths.clamp(min=0)
+
+    def forward(self, x, padding_mask=None):
+        """
+        x: BxT, padding_mask: BxT (True at the padding samples). The group norm statistics
+        are computed over the non-padding frames, so that the non-padding frames
+        of a padded sample are the same as the ones of the sample alone.
+        """
 
         # BxT -> BxCxT
         x = x.unsqueeze(1)
 
+        if padding_mask is None:
+            for conv in self.conv_layers:
+                x = conv(x)
+            return x
+
+        lengths = (~padding_mask).long().sum(-1)
         for conv in self.conv_layers:
-            x = conv(x)
+            kernel_size, stride = conv[0].kernel_size[0], conv[0].stride[0]
+            lengths = torch.div(lengths - kernel_size, stride, rounding_mode="floor") + 1
+            for layer in conv:
+                if isinstance(layer, Fp32GroupNorm):
+                    x = masked_group_norm(layer, x, lengths.clamp(min=1))
+                else:
+                    x = layer(x)
 
         return x
 
 
+def masked_group_norm(
+    group_norm: nn.GroupNorm, x: torch.Tensor, lengths: torch.LongTensor
+) -> torch.Tensor:
+    """Group norm of x (BxCxT) whose statistics are computed over the first `lengths` frames"""
+    B, C, T = x.shape
+    G = group_norm.num_groups
+    mask = torch.arange(T, device=x.device)[None, :] < lengths[:, None]  # BxT
+    mask = mask.view(B, 1, 1, T).float()
+    count = mask.sum(dim=(2, 3), keepdim=True) * (C // G)
+    xg = x.float().view(B, G, C // G, T)
+    mean = (xg * mask).sum(dim=(2, 3), keepdim=True) / count
+    var = (((xg - mean) * mask) ** 2).sum(dim=(2, 3), keepdim=True) / count
+    output = ((xg - mean) / torch.sqrt(var + group_norm.eps)).view(B, C, T)
+    if group_norm.affine:
+        output = output * group_norm.weight.float().view(1, C, 1)
+        output = output + group_norm.bias.float().view(1, C, 1)
+    return output.type_as(x)
+
+
 def make_conv_pos(e, k, g, is_batch_norm=False):
     pos_conv = nn.Conv1d(
         e,
@@ -3094,6 +3139,51 @@ class TransformerEncoder(nn.Module):
 
         return x, layer_results
 
+    def extract_features_inference(self, x, padding_mask=None, tgt_layer=None):
+        """
+        Inference version of `forward`, without dropout and without keeping
+        the intermediate layer results: only the output of tgt_layer is returned.
+        """
+        if padding_mask is not None:
+            x = index_put(x, padding_mask, 0)
+
+        x_conv = self.pos_conv(x.transpose(1, 2))
+        x = x + x_conv.transpose(1, 2)
+
+        if not self.layer_norm_first:
+            x = self.layer_norm(x)
+
+        # pad to the sequence length dimension
+        x, pad_length = pad_to_multiple(
+            x, self.required_seq_len_multiple, dim=-2, value=0
+        )
+        if pad_length > 0 and padding_mask is None:
+            padding_mask = x.new_zeros((x.size(0), x.size(1)), dtype=torch.bool)
+            padding_mask[:, -pad_length:] = True
+        else:
+            padding_mask, _ = pad_to_multiple(
+                padding_mask, self.required_seq_len_multiple, dim=-1, value=True
+            )
+
+        # B x T x C -> T x B x C
+        x = x.transpose(0, 1)
+        for i, layer in enumerate(self.layers):
+            x, _ = layer(x, self_attn_padding_mask=padding_mask, need_weights=False)
+            if i == tgt_layer:
+                break
+
+        # T x B x C -> B x T x C
+        x = x.transpose(0, 1)
+
+        # undo paddding
+        if pad_length > 0:
+            x = x[:, :-pad_length]
+
+        if self.layer_norm_first and tgt_layer is None:
+            x = self.layer_norm(x)
+
+        return x
+
     def max_positions(self):
         """Maximum output length supported by the encoder."""
         return self.args.max_positions
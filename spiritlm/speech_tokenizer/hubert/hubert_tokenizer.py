@@ -4,9 +4,12 @@
 # This source code is licensed under the FAIR Noncommercial Research License
 # found in the LICENSE file in the root directory of this source tree.
 
+from typing import List
+
 import torch
 import torchaudio
 from torch import nn
+from torch.nn.utils.rnn import pad_sequence
 
 from .hubert_model import load_hubert_model
 from .quantizer_model import load_quantizer_model
@@ -48,6 +51,8 @@ class HubertTokenizer(nn.Module):
         self.hubert_task_cfg = task_cfg
         self.hubert_model_cfg = model_cfg
         self.hubert_model = hubert_model
+        # only the features of hubert_layer are extracted
+        self.hubert_model.prune_for_inference(self.hubert_layer)
         self.hubert_model.to(self.device)
         self.hubert_model.eval()
         for parameter in self.hubert_model.parameters():
@@ -72,6 +77,16 @@ class HubertTokenizer(nn.Module):
             hop_size *= stride
         return hop_size  # 320 for 50hz model and 640 for 25hz model
 
+    @property
+    def receptive_field(self) -> int:
+        """Number of samples of the receptive field of a frame of the conv layers"""
+        receptive_field = 1
+        for dim, kernel, stride in reversed(
+            eval(self.hubert_model_cfg.conv_feature_layers)
+        ):
+            receptive_field = (receptive_field - 1) * stride + kernel
+        return receptive_field  # 400 for 50hz model and 720 for 25hz model
+
     @property
     def frame_rate(self) -> int:
         return self.expected_sample_rate / self.code_hop_size  # 50 or 25
@@ -120,7 +135,42 @@ class HubertTokenizer(nn.Module):
             return tokens
 
     @torch.inference_mode()
-    def get_dense_features(self, x, separate_channels=False):
+    def forward_batch(self, xs, dense=False) -> List[torch.Tensor]:
+        """
+        Tokenize a list of audio (paths or tensors of shape [T] or [C, T]) of different lengths,
+        they are padded to a batch and the tokens (or dense features) are trimmed per sample.
+        """
+        wavs = []
+        for x in xs:
+            if isinstance(x, str):
+                x = self.load_audio(x)
+            if x.dim() == 2:
+                x = x.mean(0)
+            assert x.dim() == 1, f"expects audio of shape [T] or [C, T], found {x.shape}"
+            wavs.append(x)
+        if not wavs:
+            return []
+
+        lengths = torch.LongTensor([len(wav) for wav in wavs])
+        x = pad_sequence(wavs, batch_first=True).unsqueeze(1)  # [B, 1, T]
+        padding_mask = torch.arange(x.size(2))[None, :] >= lengths[:, None]
+        feats, feats_padding_mask = self.get_dense_features(
+            x, padding_mask=padding_mask
+        )
+        feats_lengths = (~feats_padding_mask).long().sum(-1).tolist()
+        feats = [feat[:length] for feat, length in zip(feats, feats_lengths)]
+
+        if dense:
+            return feats
+        return [self.quantizer_model(feat.unsqueeze(0))[0] for feat in feats]
+
+    @torch.inference_mode()
+    def get_dense_features(self, x, separate_channels=False, padding_mask=None):
+        """
+        x: [B, C, T], padding_mask: [B, T] (True at the padding samples).
+        Return the features [B, T_enc, D], and their padding mask [B, T_enc]
+        if padding_mask is given.
+        """
         x = x.to(self.device)
 
         assert separate_channels == False, "Not supported yet"  # TODO: Fix this
@@ -128,20 +178,68 @@ class HubertTokenizer(nn.Module):
         if not separate_channels:
             x = x.mean(1)  # [B, T]
 
+        if padding_mask is None:
+            lengths = torch.full((x.size(0),), x.size(1), dtype=torch.long)
+        else:
+            lengths = (~padding_mask).long().sum(-1)
+        lengths = lengths.to(self.device)
+
         if self.should_normalize:
-            x = torch.cat([nn.functional.layer_norm(item, item.shape) for item in x])
+            x = _masked_layer_norm(x, lengths)
 
         feat = []
+        feat_padding_mask = []
         for start in range(0, x.size(1), self.max_chunk):
             x_chunk = x[:, start : start + self.max_chunk]
-            if x_chunk.size(1) < self.min_chunk:
+            chunk_lengths = (lengths - start).clamp(min=0, max=x_chunk.size(1))
+            # the chunks shorter than min_chunk are skipped
+            is_valid = chunk_lengths >= self.min_chunk
+            if not is_valid.any():
+                continue
+            if padding_mask is None:
+                feat_chunk, _ = self.hubert_model.extract_features_inference(
+                    source=x_chunk,
+                    padding_mask=None,
+                    output_layer=self.hubert_layer,
+                )
+                feat.append(feat_chunk)
                 continue
-            feat_chunk, _ = self.hubert_model.extract_features(
-                source=x_chunk,
-                padding_mask=None,
-                mask=False,
-                output_layer=self.hubert_layer,
-            )
-            feat.append(feat_chunk)
 
-        return torch.cat(feat, 1)
+            valid_indices = torch.nonzero(is_valid).view(-1)
+            valid_lengths = chunk_lengths[valid_indices]
+            x_chunk = x_chunk[valid_indices, : valid_lengths.max()]
+            feat_chunk, chunk_padding_mask = (
+                self.hubert_model.extract_features_inference(
+                    source=x_chunk,
+                    padding_mask=(
+                        torch.arange(x_chunk.size(1), device=self.device)[None, :]
+                        >= valid_lengths[:, None]
+                    ),
+                    output_layer=self.hubert_layer,
+                )
+            )
+            full_feat_chunk = feat_chunk.new_zeros(
+                (x.size(0), feat_chunk.size(1), feat_chunk.size(2))
+            )
+            full_feat_chunk[valid_indices] = feat_chunk
+            full_chunk_padding_mask = torch.ones(
+                (x.size(0), feat_chunk.size(1)), dtype=torch.bool, device=self.device
+            )
+            full_chunk_padding_mask[valid_indices] = chunk_padding_mask
+            feat.append(full_feat_chunk)
+            feat_padding_mask.append(full_chunk_padding_mask)
+
+        if padding_mask is None:
+            return torch.cat(feat, 1)
+        return torch.cat(feat, 1), torch.cat(feat_padding_mask, 1)
+
+
+def _masked_layer_norm(x: torch.Tensor, lengths: torch.LongTensor) -> torch.Tensor:
+    """Layer norm of each item of x [B, T] over its first `lengths` samples, padding set to 0"""
+    mask = (torch.arange(x.size(1), device=x.device)[None, :] < lengths[:, None]).to(
+        x.dtype
+    )
+    count = lengths.clamp(min=1).to(x.dtype)[:, None]
+    mean = (x * mask).sum(-1, keepdim=True) / count
+    var = (((x - mean) * mask) ** 2).sum(-1, keepdim=True) / count
+    return (x - mean) / torch.sqrt(var + 1e-5) * mask
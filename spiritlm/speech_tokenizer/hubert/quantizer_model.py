@@ -42,14 +42,28 @@ class LinearQuantizerModel(nn.Module):
         code = logits.argmax(dim=-1)
 
         # post-process units: replace BLANK with most-left non-BLANK units
-        non_stop_counter = 0
-        while (code == self.vocab_size).any():
-            non_stop_counter += 1
-            code[code == self.vocab_size] = torch.roll(code, 1)[code == self.vocab_size]
-            if non_stop_counter == 10000:
-                break
+        return forward_fill_blanks(code, blank=self.vocab_size)
 
+
+def forward_fill_blanks(code: torch.Tensor, blank: int) -> torch.Tensor:
+    """
+    Replace the BLANK units of each sequence (last dimension of code) by the closest
+    non-BLANK unit on their left. As the units are rolled circularly, the leading BLANK
+    units take the last non-BLANK unit of the sequence. Sequences of BLANK units are unchanged.
+    """
+    is_blank = code == blank
+    if not is_blank.any():
         return code
+    positions = torch.arange(code.size(-1), device=code.device).expand_as(code)
+    non_blank_positions = torch.where(is_blank, -1, positions)
+    # position of the last non-BLANK unit at or before each position
+    last_positions = torch.cummax(non_blank_positions, dim=-1).values
+    # leading BLANK units wrap around to the last non-BLANK unit of the sequence
+    last_positions = torch.where(
+        last_positions < 0, last_positions[..., -1:], last_positions
+    )
+    filled = torch.gather(code, -1, last_positions.clamp(min=0))
+    return torch.where(last_positions < 0, code, filled)
 
 
 class KmeansModel(nn.Module):
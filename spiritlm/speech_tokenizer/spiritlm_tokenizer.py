@@ -7,28 +7,119 @@
 import logging
 import os
 import random
-from typing import Dict, List
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from typing import Any, Dict, List, Mapping, Optional, Tuple
 
+import numpy as np
+import torch
 import torchaudio
 
+from .encode_cache import EncodeCache, encode_cache_key
+from .units import Units, get_units_array, to_units_array
+from .wav_chunks import num_frames, overlapping_chunks, stitch_chunks
+
 MOST_COMMON_STYLES = [71, 68, 98]
 
 
 _logger = logging.getLogger(__name__)
 
 
-def _toks_positions(toks: List[str], rate: float, dedup: bool):
-    prev_tok = None
-    res = []
-    for i, tok in enumerate(toks):
-        if (not dedup) or (prev_tok is None or tok != prev_tok):
-            res += [(tok, i / rate)]
-        prev_tok = tok
-    return res
+def _toks_positions(units: np.ndarray, rate: float, dedup: bool):
+    """The (optionally deduped) units with their time positions"""
+    keep = np.ones(len(units), dtype=bool)
+    if dedup:
+        keep[1:] = units[1:] != units[:-1]
+    return units[keep], np.flatnonzero(keep) / rate
+
+
+def _interleave_units(
+    units: Mapping[str, Any],
+    has_pitch=False,
+    has_style=False,
+    hubert_rate=24.99,
+    hubert_dedup=True,
+    hubert_key="hubert",
+    pitch_rate=12.5,
+    pitch_dedup=True,
+    pitch_key="pitch",
+    style_rate=1,
+    style_dedup=False,
+    style_key="style",
+) -> Tuple[List[Tuple[str, np.ndarray]], np.ndarray]:
+    """
+    Return the (token type, units) streams and the order interleaving their
+    concatenated units by time steps. The streams are already sorted by time, so the
+    stable sort of their concatenation merges them, units at the same time step
+    being ordered as style, pitch then hubert.
+    """
+    streams = []
+    if has_style:
+        streams.append((style_key, "St", style_rate, style_dedup))
+    if has_pitch:
+        streams.append((pitch_key, "Pi", pitch_rate, pitch_dedup))
+    streams.append((hubert_key, "Hu", hubert_rate, hubert_dedup))
+
+    toks, positions = [], []
+    for key, tok_type, rate, dedup in streams:
+        stream_units, stream_positions = _toks_positions(
+            get_units_array(units, key), rate, dedup
+        )
+        toks.append((tok_type, stream_units))
+        positions.append(stream_positions)
+    order = np.argsort(np.concatenate(positions), kind="stable")
+    return toks, order
+
+
+def units_to_tokens(
+    units: Mapping[str, Any],
+    has_pitch=False,
+    has_style=False,
+    hubert_rate=24.99,
+    hubert_dedup=True,
+    hubert_key="hubert",
+    pitch_rate=12.5,
+    pitch_dedup=True,
+    pitch_key="pitch",
+    style_rate=1,
+    style_dedup=False,
+    style_key="style",
+) -> List[Tuple[str, int]]:
+    """
+    Interleave the units by time steps as (token type, unit) pairs.
+    Example:
+     - input (units):
+        {
+            'hubert': '78 42 81 159 316 259',
+            'pitch': '13 13 13 13 13 3',
+            'style': '81 81 81 81 81 81',
+        }
+     - output:
+        [('St', 81), ('Hu', 78), ('Pi', 13), ('Hu', 42), ('Hu', 81), ('Hu', 159), ('Hu', 316), ('Pi', 3), ('Hu', 259)]
+    """
+    toks, order = _interleave_units(
+        units=units,
+        has_pitch=has_pitch,
+        has_style=has_style,
+        hubert_rate=hubert_rate,
+        hubert_dedup=hubert_dedup,
+        hubert_key=hubert_key,
+        pitch_rate=pitch_rate,
+        pitch_dedup=pitch_dedup,
+        pitch_key=pitch_key,
+        style_rate=style_rate,
+        style_dedup=style_dedup,
+        style_key=style_key,
+    )
+    tok_types = np.concatenate(
+        [np.full(len(tok_units), tok_type) for tok_type, tok_units in toks]
+    )[order]
+    tok_units = np.concatenate([tok_units for _, tok_units in toks])[order]
+    return list(zip(tok_types.tolist(), tok_units.tolist()))
 
 
 def units_to_string(
-    units: Dict[str, str],
+    units: Mapping[str, Any],
     has_pitch=False,
     has_style=False,
     hubert_rate=24.99,
@@ -52,37 +143,85 @@ def units_to_string(
      - output:
         '[St81][Hu78][Pi13][Hu42][Hu81][Hu159][Hu316][Pi3][Hu259]'
     """
-
-    combine_toks = []
-
-    if has_style:
-        combine_toks += _toks_positions(
-            [f"[St{i}]" for i in units[style_key].split()], style_rate, style_dedup
-        )
-    if has_pitch:
-        combine_toks += _toks_positions(
-            [f"[Pi{i}]" for i in units[pitch_key].split()], pitch_rate, pitch_dedup
-        )
-    combine_toks += _toks_positions(
-        [f"[Hu{i}]" for i in units[hubert_key].split()], hubert_rate, hubert_dedup
+    toks, order = _interleave_units(
+        units=units,
+        has_pitch=has_pitch,
+        has_style=has_style,
+        hubert_rate=hubert_rate,
+        hubert_dedup=hubert_dedup,
+        hubert_key=hubert_key,
+        pitch_rate=pitch_rate,
+        pitch_dedup=pitch_dedup,
+        pitch_key=pitch_key,
+        style_rate=style_rate,
+        style_dedup=style_dedup,
+        style_key=style_key,
     )
-    combine_toks = [tok_pos[0] for tok_pos in sorted(combine_toks, key=lambda x: x[1])]
-    return "".join(combine_toks)
+    # render each distinct unit of a stream once
+    tok_strings = []
+    for tok_type, tok_units in toks:
+        unique_units, inverse = np.unique(tok_units, return_inverse=True)
+        unique_strings = np.array(
+            [f"[{tok_type}{unit}]" for unit in unique_units.tolist()], dtype=object
+        )
+        tok_strings.append(unique_strings[inverse.reshape(-1)])
+    return "".join(np.concatenate(tok_strings)[order].tolist())
 
 
 def get_random_most_common_style() -> int:
     return random.choice(MOST_COMMON_STYLES)
 
 
+SPEECH_TOKEN_TYPES = ["Hu", "Pi", "St"]
+
+
+def _parse_speech_tokens(gen: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Parse the speech tokens ([Hu12], [Pi3] and [St7]) of the string into the arrays of
+    their types and units, other characters are ignored.
+    The tokens are located on the utf-8 bytes, as the brackets and digits are ascii.
+    """
+    chars = np.frombuffer(gen.encode("utf-8"), dtype=np.uint8)
+    starts = np.flatnonzero(chars == ord("["))
+    ends = np.flatnonzero(chars == ord("]"))
+    # a token candidate spans from a "[" to the next "]"
+    end_indices = np.searchsorted(ends, starts)
+    starts = starts[end_indices < len(ends)]
+    ends = ends[end_indices[end_indices < len(ends)]]
+    # ... with a 2-letters type followed by digits only
+    has_digits = ends > starts + 3
+    starts, ends = starts[has_digits], ends[has_digits]
+    digit_starts, num_digits = starts + 3, ends - starts - 3
+    is_digit = (chars >= ord("0")) & (chars <= ord("9"))
+    digit_counts = np.concatenate([[0], np.cumsum(is_digit)])
+    type_codes = chars[starts + 1].astype(np.int64) * 256 + chars[starts + 2]
+    type_indices = np.full(len(starts), -1)
+    for i, tok_type in enumerate(SPEECH_TOKEN_TYPES):
+        type_indices[type_codes == ord(tok_type[0]) * 256 + ord(tok_type[1])] = i
+    is_token = (type_indices >= 0) & (
+        digit_counts[ends] - digit_counts[digit_starts] == num_digits
+    )
+    digit_starts, num_digits = digit_starts[is_token], num_digits[is_token]
+    ends = ends[is_token]
+
+    tok_units = np.zeros(len(digit_starts), dtype=np.int64)
+    for i in range(num_digits.max(initial=0)):
+        # the positions after the last digit are clipped to the closing bracket
+        digits = chars[np.minimum(digit_starts + i, ends)].astype(np.int64) - ord("0")
+        tok_units = np.where(i < num_digits, tok_units * 10 + digits, tok_units)
+    tok_types = np.array(SPEECH_TOKEN_TYPES)[type_indices[is_token]]
+    return tok_types, tok_units
+
+
 def string_to_units(
     gen,
     hubert_key="hubert",
     pitch_key="pitch",
     style_key="style",
     duplicate_hubert_for_multiple_pitch=False,
-):
+) -> Units:
     """
-    Convert from tokenized string to dictionary of units.
+    Convert from tokenized string to units.
     The units are 'pre-duplicated' to match the number of hubert units.
     Examples
      - input:
@@ -94,57 +233,131 @@ def string_to_units(
             'style': '81 81 81 81 81 81',
         }
     """
-    prev_hubert = None
-    first_hubert = None
-    prev_pitch = None
-    first_pitch = None
-    prev_style = None
-    first_style = None
-    prev_is_pitch = False  # If this is True, add prev_hubert to the codes
-    hubert = []
-    pitch = []
-    style = []
-    for item in gen.split("["):
-        if item and len(item) > 2:
-            if item.startswith("Hu") and item[2].isdigit():
-                hubert += [item[2:-1]]
-                pitch += [prev_pitch]
-                style += [prev_style]
-                prev_is_pitch = False
-                prev_hubert = item[2:-1]
-                if first_hubert is None:
-                    first_hubert = item[2:-1]
-            elif item.startswith("St") and item[2].isdigit():
-                if prev_style is None:
-                    first_style = item[2:-1]
-                prev_style = item[2:-1]
-            elif item.startswith("Pi") and item[2].isdigit():
-                if duplicate_hubert_for_multiple_pitch and prev_is_pitch:
-                    hubert += [prev_hubert]
-                    pitch += [item[2:-1]]
-                    style += [prev_style]
-                if prev_pitch is None:
-                    first_pitch = item[2:-1]
-                prev_pitch = item[2:-1]
-                prev_is_pitch = True
-    if first_pitch is not None and first_style is None:
-        # in rare case, style is not present, we select randomly a common style token to make decoding work
-        first_style = str(get_random_most_common_style())
-    for i in range(len(hubert)):
-        if hubert[i] is None:
-            hubert[i] = first_hubert
-        if style[i] is None:
-            style[i] = first_style
-        if pitch[i] is None:
-            pitch[i] = first_pitch
-    units = {hubert_key: " ".join(hubert)}
-    if first_pitch is not None:
-        units[pitch_key] = " ".join(pitch)
-    if first_style is not None:
-        units[style_key] = " ".join(style)
+    tok_types, tok_units = _parse_speech_tokens(gen)
+    return Units(
+        tokens_to_units(
+            tok_types,
+            tok_units,
+            hubert_key=hubert_key,
+            pitch_key=pitch_key,
+            style_key=style_key,
+            duplicate_hubert_for_multiple_pitch=duplicate_hubert_for_multiple_pitch,
+        )
+    )
+
+
+def _forward_fill_indices(mask: np.ndarray) -> np.ndarray:
+    """
+    Return for each position the index of the last True of the mask up to this position, -1 if none.
+    """
+    indices = np.where(mask, np.arange(len(mask)), -1)
+    return np.maximum.accumulate(indices) if len(indices) else indices
+
+
+def tokens_to_units(
+    tok_types: np.ndarray,
+    tok_units: np.ndarray,
+    hubert_key="hubert",
+    pitch_key="pitch",
+    style_key="style",
+    duplicate_hubert_for_multiple_pitch=False,
+) -> Dict[str, np.ndarray]:
+    """
+    Convert from arrays of token types and units to dictionary of unit arrays,
+    with the same rules as `string_to_units` but vectorized.
+    The units are 'pre-duplicated' to match the number of hubert units.
+    Examples
+     - input:
+        tok_types: ['St', 'Hu', 'Pi', 'Hu', 'Hu', 'Hu', 'Hu', 'Pi', 'Hu']
+        tok_units: [81, 78, 13, 42, 81, 159, 316, 3, 259]
+     - output:
+        {
+            'hubert': array([78, 42, 81, 159, 316, 259]),
+            'pitch': array([13, 13, 13, 13, 13, 3]),
+            'style': array([81, 81, 81, 81, 81, 81]),
+        }
+    """
+    tok_types = np.asarray(tok_types)
+    tok_units = np.asarray(tok_units, dtype=np.int64)
+    is_hubert = tok_types == "Hu"
+    is_pitch = tok_types == "Pi"
+    is_style = tok_types == "St"
+
+    # the units are emitted at each hubert token (and at each pitch token following
+    # another pitch token if duplicate_hubert_for_multiple_pitch), with the last
+    # hubert, pitch and style units seen so far
+    last_hubert = _forward_fill_indices(is_hubert)
+    last_pitch = _forward_fill_indices(is_pitch)
+    last_style = _forward_fill_indices(is_style)
+    is_emitted = is_hubert
+    if duplicate_hubert_for_multiple_pitch and is_hubert.any():
+        prev_pitch = np.concatenate([[-1], last_pitch[:-1]])
+        is_emitted = is_emitted | (is_pitch & (prev_pitch > last_hubert))
+
+    def _emitted_units(last_indices, is_type):
+        # the missing units are filled with the first unit of its type
+        last_indices = last_indices[is_emitted]
+        first_index = np.argmax(is_type) if is_type.any() else 0
+        return tok_units[np.where(last_indices >= 0, last_indices, first_index)]
+
+    units = {hubert_key: _emitted_units(last_hubert, is_hubert)}
+    if is_pitch.any():
+        units[pitch_key] = _emitted_units(last_pitch, is_pitch)
+        if not is_style.any():
+            # in rare case, style is not present, we select randomly a common style token to make decoding work
+            units[style_key] = np.full_like(
+                units[hubert_key], get_random_most_common_style()
+            )
+    if is_style.any():
+        units[style_key] = _emitted_units(last_style, is_style)
     return units
 
 
+def _concat_units(chunk_units) -> np.ndarray:
+    """Concatenate the unit tensors of the wav chunks into an int array"""
+    if not chunk_units:
+        return to_units_array([])
+    return np.concatenate([to_units_array(units) for units in chunk_units])
+
+
+def _model_config(model) -> Dict[str, Any]:
+    """Class and checkpoints of a unit extraction model, to tell apart the cached units"""
+    config = {"class": type(model).__qualname__}
+    for attribute in ["hubert_ckpt", "hubert_layer", "quantizer_ckpt", "pool_size"]:
+        if hasattr(model, attribute):
+            config[attribute] = str(getattr(model, attribute))
+    if hasattr(model, "f0_extractor"):
+        config["f0_extractor"] = type(model.f0_extractor).__qualname__
+    if hasattr(model, "name_or_path"):
+        config["name_or_path"] = str(model.name_or_path)
+    return config
+
+
+def _forward_sorted_batches(model, audio_chunks, batch_size: int) -> list:
+    """
+    Run `model.forward_batch` on batches of `batch_size` wav chunks, which are sorted
+    by length to minimize the padding, and return the outputs in the order of the chunks
+    """
+    outputs = [None] * len(audio_chunks)
+    order = sorted(range(len(audio_chunks)), key=lambda i: len(audio_chunks[i]))
+    for start in range(0, len(order), batch_size):
+        batch_indices = order[start : start + batch_size]
+        batch_outputs = model.forward_batch([audio_chunks[i] for i in batch_indices])
+        for i, output in zip(batch_indices, batch_outputs):
+            outputs[i] = output
+    return outputs
+
+
+def _run_with_num_threads(model, audio_chunk, num_threads: int):
+    # the number of intra-op threads is set for the calling thread
+    torch.set_num_threads(num_threads)
+    return model(audio_chunk)
+
+
+def _run_on_chunks(model, audio_chunks) -> list:
+    return [model(audio_chunk) for audio_chunk in audio_chunks]
+
+
 class SpiritLMTokenizer:
     def __init__(
         self,
@@ -192,6 +405,14 @@ class SpiritLMTokenizer:
         self.max_wav_chunk = max_wav_chunk
         self.min_wav_chunk = min_wav_chunk
 
+        # see enable_concurrent_extraction
+        self._executor = None
+        self._component_num_threads = {}
+        # see enable_encode_cache
+        self.encode_cache: Optional[EncodeCache] = None
+        # see enable_long_audio_mode
+        self.long_audio_mode: Optional[Dict[str, int]] = None
+
     def load_audio(self, path):
         wav, sr = torchaudio.load(path)
         if sr != self.expected_sample_rate:
@@ -202,16 +423,322 @@ class SpiritLMTokenizer:
 
     def encode_units(self, audio, channel_id=None):
         """
-        Get the speech units in dictionary format, e.g.
+        Get the speech units as a `Units`, which reads like the dictionary
         {
             'audio': 'path/to/audio.wav',
             'hubert': '1 1 2 2 3',
             'pitch': '15 15 20',
             'style': '7',
         }
+        while holding the int arrays of units (`units.arrays`) and their rates.
         The audio can be the path to audio file or an array.
         For stereo audio file, channel_id can be set (0 or 1).
         """
+        units, audio = self._prepare_audio(audio, channel_id)
+        if self.encode_cache is None:
+            units.update(self._extract_units(audio))
+            return Units(units, rates=self._units_rates())
+
+        cache_key = encode_cache_key(audio, self._encode_cache_config())
+        arrays = self.encode_cache.get(cache_key)
+        if arrays is None:
+            arrays = self._extract_units(audio)
+            self.encode_cache.put(cache_key, arrays)
+        units.update(arrays)
+        return Units(units, rates=self._units_rates())
+
+    def _extract_units(self, audio) -> Dict[str, np.ndarray]:
+        """Run the unit extraction models on the wav chunks of the mono audio"""
+        if self.long_audio_mode is not None:
+            return self._extract_overlapped_units(audio)
+        audio_chunks = [
+            audio[start : start + self.max_wav_chunk]
+            for start in range(0, len(audio), self.max_wav_chunk)
+            if len(audio[start : start + self.max_wav_chunk]) >= self.min_wav_chunk
+        ]
+        components = self._get_components()
+        if self._executor is None:
+            outputs = {
+                key: [model(audio_chunk) for audio_chunk in audio_chunks]
+                for key, model in components.items()
+            }
+        else:
+            # the components run concurrently, each one with its intra-op thread budget,
+            # as a single job running its chunks in order (one job per worker)
+            futures = {
+                key: self._executor.submit(
+                    _run_with_num_threads,
+                    partial(_run_on_chunks, model),
+                    audio_chunks,
+                    self._component_num_threads[key],
+                )
+                for key, model in components.items()
+            }
+            outputs = {key: future.result() for key, future in futures.items()}
+
+        return {
+            key: _concat_units(chunk_outputs) for key, chunk_outputs in outputs.items()
+        }
+
+    def _extract_overlapped_units(self, audio) -> Dict[str, np.ndarray]:
+        """Run the unit extraction models on the overlapping chunks of the mono audio"""
+        components = self._get_components()
+        if self._executor is None:
+            return {
+                key: self._extract_component_overlapped_units(key, model, audio)
+                for key, model in components.items()
+            }
+        futures = {
+            key: self._executor.submit(
+                _run_with_num_threads,
+                partial(self._extract_component_overlapped_units, key, model),
+                audio,
+                self._component_num_threads[key],
+            )
+            for key, model in components.items()
+        }
+        return {key: future.result() for key, future in futures.items()}
+
+    def _extract_component_overlapped_units(self, key, model, audio) -> np.ndarray:
+        if len(audio) < self.min_wav_chunk:
+            return _concat_units([])
+        hop_size = round(self.expected_sample_rate / self._units_rates()[key])
+        # the models without a conv receptive field are taken as giving ceil units
+        receptive_field = getattr(model, "receptive_field", 1)
+        chunks = overlapping_chunks(
+            len(audio),
+            self.long_audio_mode["chunk_size"],
+            self.long_audio_mode["overlap"],
+            hop_size,
+            receptive_field=receptive_field,
+            min_chunk=self.min_wav_chunk,
+        )
+        windows = [audio[start:end] for start, end, _, _ in chunks]
+        batch_size = self.long_audio_mode["batch_size"]
+        if hasattr(model, "forward_batch"):
+            # padded batches of windows, only batch_size windows are in memory at once
+            window_units = []
+            for start in range(0, len(windows), batch_size):
+                window_units += model.forward_batch(windows[start : start + batch_size])
+        else:
+            window_units = [model(window) for window in windows]
+        units = _concat_units(stitch_chunks(window_units, chunks, hop_size))
+        if hasattr(model, "receptive_field"):
+            expected_length = num_frames(len(audio), hop_size, receptive_field)
+            assert len(units) == expected_length, (
+                f"the stitched {key} units have {len(units)} frames, "
+                f"expects {expected_length}"
+            )
+        return units
+
+    def _units_rates(self) -> Dict[str, float]:
+        """Number of units per second of each unit key"""
+        rates = {self.hubert_key: self.hubert_rate}
+        if self.pitch_key:
+            rates[self.pitch_key] = self.pitch_rate
+        if self.style_key:
+            rates[self.style_key] = self.style_rate
+        return rates
+
+    def _get_components(self):
+        """The unit extraction models, indexed by their unit key"""
+        components = {self.hubert_key: self.hubert_model}
+        if self.pitch_model is not None:
+            components[self.pitch_key] = self.pitch_model
+        if self.style_model is not None:
+            components[self.style_key] = self.style_model
+        return components
+
+    def enable_concurrent_extraction(self, num_threads: Optional[int] = None):
+        """
+        Run the hubert, pitch and style models concurrently in `encode_units`, on a thread pool.
+        The `num_threads` intra-op threads (torch.get_num_threads() by default) are split
+        between the models, hubert taking the remainder.
+        """
+        self.disable_concurrent_extraction()
+        if num_threads is None:
+            num_threads = torch.get_num_threads()
+        keys = list(self._get_components())
+        threads_per_component = max(1, num_threads // len(keys))
+        self._component_num_threads = {key: threads_per_component for key in keys}
+        self._component_num_threads[self.hubert_key] = max(
+            1, num_threads - threads_per_component * (len(keys) - 1)
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(keys), thread_name_prefix="spiritlm-tokenizer"
+        )
+        _logger.info(
+            f"Concurrent unit extraction with threads: {self._component_num_threads}"
+        )
+
+    def disable_concurrent_extraction(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+        self._executor = None
+        self._component_num_threads = {}
+
+    def enable_encode_cache(
+        self, max_bytes: int = 256 * 1024**2, cache_dir: Optional[str] = None
+    ):
+        """
+        Cache the units of `encode_units` by the content of the audio (see `EncodeCache`),
+        in memory up to `max_bytes` of units and in `cache_dir` if given.
+        """
+        self.encode_cache = EncodeCache(max_bytes=max_bytes, cache_dir=cache_dir)
+
+    def disable_encode_cache(self):
+        self.encode_cache = None
+
+    def enable_long_audio_mode(
+        self,
+        chunk_seconds: float = 20.0,
+        overlap_seconds: float = 1.0,
+        batch_size: int = 8,
+    ):
+        """
+        Extract the units of `encode_units` on chunks of `chunk_seconds` extended by
+        `overlap_seconds` of context on both sides, and keep the units of each chunk
+        (see `overlapping_chunks`), so that the units at the chunk boundaries are computed
+        with context. The overlap is at least the receptive field of the conv layers
+        of the models, so that the stitched units are aligned frame for frame with the
+        units of the whole audio; their values are still computed on the windows only
+        (e.g. the attention of hubert and the normalizations only see the window).
+        The windows of the hubert model are run by padded batches of
+        `batch_size` windows, the memory of the extraction doesn't grow with the audio length.
+        `encode_units_batch` extracts the audios one by one in this mode.
+        """
+        assert chunk_seconds > 0 and overlap_seconds > 0 and batch_size > 0
+        overlap = int(overlap_seconds * self.expected_sample_rate)
+        for key, model in self._get_components().items():
+            receptive_field = getattr(model, "receptive_field", 1)
+            assert overlap >= receptive_field, (
+                f"the overlap of {overlap} samples is shorter than the receptive field "
+                f"of the {key} model ({receptive_field} samples)"
+            )
+        self.long_audio_mode = {
+            "chunk_size": int(chunk_seconds * self.expected_sample_rate),
+            "overlap": overlap,
+            "batch_size": batch_size,
+        }
+
+    def disable_long_audio_mode(self):
+        self.long_audio_mode = None
+
+    def _encode_cache_config(self) -> Dict[str, Any]:
+        """Configuration of the unit extraction, hashed in the encode cache keys"""
+        config = {
+            "expected_sample_rate": self.expected_sample_rate,
+            "max_wav_chunk": self.max_wav_chunk,
+            "min_wav_chunk": self.min_wav_chunk,
+        }
+        if self.long_audio_mode is not None:
+            config["long_audio_mode"] = {
+                key: value
+                for key, value in self.long_audio_mode.items()
+                if key != "batch_size"
+            }
+        for key, model in self._get_components().items():
+            config[key] = _model_config(model)
+        return config
+
+    def encode_units_batch(self, audios, channel_ids=None, batch_size=16):
+        """
+        Batched version of `encode_units` for a list of audio, returning the list of their units.
+        The hubert units (and the pitch units, if the pitch model has a `forward_batch`) of the
+        wav chunks are extracted by padded batches of `batch_size` chunks, which are sorted by
+        length to minimize the padding.
+        The units are looked up in (and added to) the encode cache per audio, if enabled,
+        only the audios missing from the cache are extracted.
+        With the long audio mode, each audio is extracted by `encode_units` on its
+        overlapping chunks, whose windows are batched.
+        """
+        if channel_ids is None:
+            channel_ids = [None] * len(audios)
+        assert len(channel_ids) == len(audios), "expects one channel_id per audio"
+        if self.long_audio_mode is not None:
+            return [
+                self.encode_units(audio, channel_id)
+                for audio, channel_id in zip(audios, channel_ids)
+            ]
+        prepared_audios = [
+            self._prepare_audio(audio, channel_id)
+            for audio, channel_id in zip(audios, channel_ids)
+        ]
+
+        # the units arrays of each audio, from the cache or extracted below
+        audio_arrays = [None] * len(prepared_audios)
+        cache_keys = [None] * len(prepared_audios)
+        if self.encode_cache is not None:
+            cache_config = self._encode_cache_config()
+            for audio_index, (_, audio) in enumerate(prepared_audios):
+                cache_keys[audio_index] = encode_cache_key(audio, cache_config)
+                audio_arrays[audio_index] = self.encode_cache.get(
+                    cache_keys[audio_index]
+                )
+
+        # (audio index, wav chunk) of all the audios to extract
+        chunks = []
+        for audio_index, (_, audio) in enumerate(prepared_audios):
+            if audio_arrays[audio_index] is not None:
+                continue
+            for start in range(0, len(audio), self.max_wav_chunk):
+                audio_chunk = audio[start : start + self.max_wav_chunk]
+                if len(audio_chunk) < self.min_wav_chunk:
+                    continue
+                chunks.append((audio_index, audio_chunk))
+
+        audio_chunks = [audio_chunk for _, audio_chunk in chunks]
+        hubert_chunk_units = _forward_sorted_batches(
+            self.hubert_model, audio_chunks, batch_size
+        )
+        pitch_chunk_units = [None] * len(chunks)
+        if self.pitch_model is not None and hasattr(self.pitch_model, "forward_batch"):
+            pitch_chunk_units = _forward_sorted_batches(
+                self.pitch_model, audio_chunks, batch_size
+            )
+
+        units_batch = []
+        for audio_index, (units, _) in enumerate(prepared_audios):
+            arrays = audio_arrays[audio_index]
+            if arrays is None:
+                arrays = self._assemble_batch_units(
+                    audio_index, chunks, hubert_chunk_units, pitch_chunk_units
+                )
+                if self.encode_cache is not None:
+                    self.encode_cache.put(cache_keys[audio_index], arrays)
+            units.update(arrays)
+            units_batch.append(Units(units, rates=self._units_rates()))
+        return units_batch
+
+    def _assemble_batch_units(
+        self, audio_index, chunks, hubert_chunk_units, pitch_chunk_units
+    ) -> Dict[str, np.ndarray]:
+        """Concatenate the units of the wav chunks of an audio of `encode_units_batch`"""
+        hubert_units = []
+        pitch_units = []
+        style_units = []
+        for (chunk_audio_index, audio_chunk), chunk_units, chunk_pitch_units in zip(
+            chunks, hubert_chunk_units, pitch_chunk_units
+        ):
+            if chunk_audio_index != audio_index:
+                continue
+            hubert_units.append(chunk_units)
+            if self.pitch_model is not None:
+                if chunk_pitch_units is None:
+                    chunk_pitch_units = self.pitch_model(audio_chunk)
+                pitch_units.append(chunk_pitch_units)
+            if self.style_model is not None:
+                style_units.append(self.style_model(audio_chunk))
+
+        arrays = {self.hubert_key: _concat_units(hubert_units)}
+        if self.pitch_model is not None:
+            arrays[self.pitch_key] = _concat_units(pitch_units)
+        if self.style_model is not None:
+            arrays[self.style_key] = _concat_units(style_units)
+        return arrays
+
+    def _prepare_audio(self, audio, channel_id=None):
+        """Return the units dict (with the audio path if any) and the mono audio"""
         units = {}
 
         if isinstance(audio, str):
@@ -231,40 +758,12 @@ class SpiritLMTokenizer:
             else:
                 audio = audio[channel_id]
         assert len(audio.shape) == 1, audio.shape
+        return units, audio
 
-        hubert_units = []
-        pitch_units = []
-        style_units = []
-        for start in range(0, len(audio), self.max_wav_chunk):
-            audio_chunk = audio[start : start + self.max_wav_chunk]
-            if len(audio_chunk) < self.min_wav_chunk:
-                continue
-            hubert_units.extend([str(i.item()) for i in self.hubert_model(audio_chunk)])
-            if self.pitch_model is not None:
-                pitch_units.extend(
-                    [str(i.item()) for i in self.pitch_model(audio_chunk)]
-                )
-            if self.style_model is not None:
-                style_units.extend(
-                    [str(i.item()) for i in self.style_model(audio_chunk)]
-                )
-
-        units[self.hubert_key] = " ".join(hubert_units)
-        if self.pitch_model is not None:
-            units[self.pitch_key] = " ".join(pitch_units)
-        if self.style_model is not None:
-            units[self.style_key] = " ".join(style_units)
-        return units
-
-    def units2string(self, units):
-        """
-        Convert from dictionary of units to tokenized string.
-        The units are (optionally deduped) sorted by time steps and interleaved
-        """
+    def _units_kwargs(self):
         has_pitch = self.pitch_model is not None
         has_style = self.style_model is not None
-        return units_to_string(
-            units=units,
+        return dict(
             has_pitch=has_pitch,
             has_style=has_style,
             hubert_rate=self.hubert_rate,
@@ -278,6 +777,21 @@ class SpiritLMTokenizer:
             style_key=self.style_key if has_style else None,
         )
 
+    def units2string(self, units):
+        """
+        Convert from dictionary of units to tokenized string.
+        The units are (optionally deduped) sorted by time steps and interleaved
+        """
+        return units_to_string(units=units, **self._units_kwargs())
+
+    def units2tokens(self, units):
+        """
+        Convert from dictionary of units to a list of (token type, unit) pairs.
+        The units are (optionally deduped) sorted by time steps and interleaved
+        as in `units2string`, without rendering the tokens as strings.
+        """
+        return units_to_tokens(units=units, **self._units_kwargs())
+
     def encode_string(self, audio):
         """
         Tokenize the audio into string format, e.g.
@@ -286,6 +800,14 @@ class SpiritLMTokenizer:
         units = self.encode_units(audio)
         return self.units2string(units)
 
+    def encode_tokens(self, audio):
+        """
+        Tokenize the audio into a list of (token type, unit) pairs, e.g.
+        [('St', 7), ('Pi', 15), ('Hu', 1), ('Hu', 2), ('Pi', 20), ('Hu', 3)]
+        """
+        units = self.encode_units(audio)
+        return self.units2tokens(units)
+
     def __call__(self, audio):
         """
         Default call method
@@ -314,9 +836,38 @@ class SpiritLMTokenizer:
             duplicate_hubert_for_multiple_pitch=duplicate_hubert_for_multiple_pitch,
         )
 
+    def tokens2units(
+        self, tok_types, tok_units, duplicate_hubert_for_multiple_pitch=False
+    ):
+        """
+        Convert from arrays of token types and units to dictionary of unit arrays.
+        The units are 'pre-duplicated' to match the number of hubert units.
+        Examples
+            - input:
+                tok_types: ['St', 'Hu', 'Pi', 'Hu', 'Hu', 'Hu', 'Hu', 'Pi', 'Hu']
+                tok_units: [81, 78, 13, 42, 81, 159, 316, 3, 259]
+            - output:
+                {
+                    'hubert': array([78, 42, 81, 159, 316, 259]),
+                    'pitch': array([13, 13, 13, 13, 13, 3]),
+                    'style': array([81, 81, 81, 81, 81, 81]),
+                }
+        """
+        return Units(
+            tokens_to_units(
+                tok_types,
+                tok_units,
+                hubert_key=self.hubert_key,
+                pitch_key=self.pitch_key if self.pitch_key else "pitch",
+                style_key=self.style_key if self.style_key else "style",
+                duplicate_hubert_for_multiple_pitch=duplicate_hubert_for_multiple_pitch,
+            )
+        )
+
     def decode(self, code, speaker_id=2, dur_pred=True):
         """
-        code can be under text form ([Hu1][Hu2]) or units form ({'hubert': '1 2'})
+        code can be under text form ([Hu1][Hu2]) or units form ({'hubert': '1 2'}),
+        the units can also be arrays ({'hubert': np.array([1, 2])})
         """
 
         assert self.hifigan_model is not None
@@ -331,21 +882,21 @@ class SpiritLMTokenizer:
         if (
             self.pitch_key
             and self.pitch_key in units
-            and len(units[self.pitch_key].split())
-            != len(units[self.hubert_key].split())
+            and len(get_units_array(units, self.pitch_key))
+            != len(get_units_array(units, self.hubert_key))
         ):
             dur_pred = False
 
         wav = (
             self.hifigan_model(
-                code=units[self.hubert_key],
+                code=get_units_array(units, self.hubert_key),
                 f0_code=(
-                    units[self.pitch_key]
+                    get_units_array(units, self.pitch_key)
                     if self.pitch_key and self.pitch_key in units
                     else None
                 ),
                 style_code=(
-                    units[self.style_key]
+                    get_units_array(units, self.style_key)
                     if self.style_key and self.style_key in units
                     else None
                 ),
@@ -359,3 +910,232 @@ class SpiritLMTokenizer:
         )
 
         return wav
+
+    def decode_batch(self, codes, speaker_id=2, dur_pred=True) -> List[np.ndarray]:
+        """
+        Batched version of `decode` for a list of codes (strings or units),
+        speaker_id can be a single id or a list of ids (one per sample)
+        """
+        assert self.hifigan_model is not None
+
+        batch_size = len(codes)
+        if not isinstance(speaker_id, (list, tuple)):
+            speaker_id = [speaker_id] * batch_size
+        assert len(speaker_id) == batch_size, "expects one speaker_id per sample"
+
+        units_batch = [
+            self.string2units(code) if isinstance(code, str) else code
+            for code in codes
+        ]
+        # the samples for resynthesis (see `decode`) are synthesized without duration prediction
+        sample_dur_preds = [
+            dur_pred
+            and not (
+                self.pitch_key
+                and self.pitch_key in units
+                and len(get_units_array(units, self.pitch_key))
+                != len(get_units_array(units, self.hubert_key))
+            )
+            for units in units_batch
+        ]
+
+        wavs = [None] * batch_size
+        for group_dur_pred in set(sample_dur_preds):
+            indices = [
+                i
+                for i, sample_dur_pred in enumerate(sample_dur_preds)
+                if sample_dur_pred == group_dur_pred
+            ]
+            group_units = [units_batch[i] for i in indices]
+            group_wavs = self.hifigan_model.decode_batch(
+                [get_units_array(units, self.hubert_key) for units in group_units],
+                f0_codes=(
+                    [get_units_array(units, self.pitch_key) for units in group_units]
+                    if self.pitch_key and self.pitch_key in group_units[0]
+                    else None
+                ),
+                style_codes=(
+                    [get_units_array(units, self.style_key) for units in group_units]
+                    if self.style_key and self.style_key in group_units[0]
+                    else None
+                ),
+                dur_pred=group_dur_pred,
+                speaker_id=[speaker_id[i] for i in indices],
+                not_dedup_code=True,
+            )
+            for i, wav in zip(indices, group_wavs):
+                wavs[i] = wav.cpu().numpy()
+        return wavs
+
+    def encode_stream(
+        self,
+        context_seconds: float = 5.0,
+        lookahead_seconds: float = 0.5,
+        min_emit_seconds: float = 0.2,
+    ):
+        """
+        Return a `UnitsEncodeStream` extracting the units of the audio pushed to it by blocks
+        (mono audio at expected_sample_rate), with `context_seconds` of left context
+        and `lookahead_seconds` of lookahead.
+        """
+        return UnitsEncodeStream(
+            self._get_components(),
+            rates=self._units_rates(),
+            sample_rate=self.expected_sample_rate,
+            context_seconds=context_seconds,
+            lookahead_seconds=lookahead_seconds,
+            min_emit_seconds=min_emit_seconds,
+            min_wav_chunk=self.min_wav_chunk,
+        )
+
+    def decode_stream(self, speaker_id=2, dur_pred=True):
+        """
+        Return a `UnitsDecodeStream` decoding the chunks of units pushed to it,
+        the units should have one pitch and style unit per hubert unit (as in the generated units)
+        """
+        assert self.hifigan_model is not None
+        return UnitsDecodeStream(
+            self.hifigan_model.stream(speaker_id=speaker_id, dur_pred=dur_pred),
+            hubert_key=self.hubert_key,
+            pitch_key=self.pitch_key,
+            style_key=self.style_key,
+        )
+
+
+class UnitsDecodeStream:
+    """
+    Incremental decoding of chunks of units, the concatenation of the returned audio
+    matches the decoding of the concatenated units.
+
+    Example:
+        stream = spiritlm_tokenizer.decode_stream(speaker_id=2)
+        for units in units_chunks:
+            play(stream.push(units))
+        play(stream.flush())
+    """
+
+    def __init__(self, vocoder_stream, hubert_key, pitch_key=None, style_key=None):
+        self.vocoder_stream = vocoder_stream
+        self.hubert_key = hubert_key
+        self.pitch_key = pitch_key
+        self.style_key = style_key
+
+    def push(self, units) -> np.ndarray:
+        wav = self.vocoder_stream.push(
+            get_units_array(units, self.hubert_key),
+            f0_code=(
+                get_units_array(units, self.pitch_key)
+                if self.pitch_key and self.pitch_key in units
+                else None
+            ),
+            style_code=(
+                get_units_array(units, self.style_key)
+                if self.style_key and self.style_key in units
+                else None
+            ),
+        )
+        return wav.cpu().numpy()
+
+    def flush(self) -> np.ndarray:
+        return self.vocoder_stream.flush().cpu().numpy()
+
+
+class UnitsEncodeStream:
+    """
+    Incremental extraction of the units of an audio stream, pushed by blocks of samples
+    (e.g. blocks of 20 to 100 ms from a microphone).
+
+    Each unit extraction model runs on a rolling window of the audio, from `context_seconds`
+    before its first unit not emitted yet to the end of the pushed audio. The units followed
+    by `lookahead_seconds` of pushed audio are final and emitted, a model only runs once
+    `min_emit_seconds` of its units (or one unit) can be emitted.
+    The windows start on multiples of the hop size of the units, so that their units are
+    aligned with the units of the whole audio, which are approximated with a bounded context
+    (as with the wav chunks of `encode_units`).
+
+    Example:
+        stream = spiritlm_tokenizer.encode_stream()
+        for block in audio_blocks:
+            units = stream.push(block)  # the units finalized by the block
+        units = stream.flush()  # the remaining units
+    """
+
+    def __init__(
+        self,
+        components,
+        rates,
+        sample_rate,
+        context_seconds=5.0,
+        lookahead_seconds=0.5,
+        min_emit_seconds=0.2,
+        min_wav_chunk=400,
+    ):
+        assert context_seconds >= 0 and lookahead_seconds >= 0
+        self.components = components
+        self.rates = rates
+        self.hop_sizes = {key: round(sample_rate / rates[key]) for key in components}
+        self.context_samples = int(context_seconds * sample_rate)
+        self.lookahead_samples = int(lookahead_seconds * sample_rate)
+        self.min_emit_samples = int(min_emit_seconds * sample_rate)
+        self.min_wav_chunk = min_wav_chunk
+
+        self.audio = torch.zeros(0)  # pushed audio from sample `audio_offset`
+        self.audio_offset = 0
+        self.num_samples = 0  # number of pushed samples
+        self.num_emitted = {key: 0 for key in components}  # number of emitted units
+
+    def push(self, audio) -> Units:
+        audio = torch.as_tensor(audio, dtype=torch.float32).squeeze()
+        assert audio.dim() <= 1, f"expected mono audio, found {audio.shape}"
+        self.audio = torch.cat([self.audio, audio.reshape(-1).cpu()])
+        self.num_samples += audio.numel()
+
+        arrays = {}
+        for key, hop_size in self.hop_sizes.items():
+            num_final = max(0, self.num_samples - self.lookahead_samples) // hop_size
+            num_new_samples = (num_final - self.num_emitted[key]) * hop_size
+            if num_new_samples >= max(hop_size, self.min_emit_samples):
+                arrays[key] = self._extract(key, end=num_final)
+            else:
+                arrays[key] = to_units_array([])
+        self._trim_audio()
+        return Units(arrays, rates=self.rates)
+
+    def flush(self) -> Units:
+        arrays = {
+            key: (
+                self._extract(key)
+                if self.num_emitted[key] * hop_size < self.num_samples
+                else to_units_array([])
+            )
+            for key, hop_size in self.hop_sizes.items()
+        }
+        self._trim_audio()
+        return Units(arrays, rates=self.rates)
+
+    def _window_start(self, key) -> int:
+        """First sample of the window of the next units, aligned on the hop size"""
+        hop_size = self.hop_sizes[key]
+        start = max(0, self.num_emitted[key] * hop_size - self.context_samples)
+        return start // hop_size * hop_size
+
+    def _extract(self, key, end=None) -> np.ndarray:
+        """Extract the units of the key from the next one to the unit `end` (excluded)"""
+        start = self._window_start(key)
+        window = self.audio[start - self.audio_offset :]
+        if len(window) < self.min_wav_chunk:
+            return to_units_array([])
+        units = to_units_array(self.components[key](window))
+        # the units of the window start at the unit window_first_unit
+        window_first_unit = start // self.hop_sizes[key]
+        first = self.num_emitted[key] - window_first_unit
+        last = None if end is None else end - window_first_unit
+        units = units[first:last]
+        self.num_emitted[key] += len(units)
+        return units
+
+    def _trim_audio(self):
+        """Drop the audio before the windows of all the keys"""
+        start = min(self._window_start(key) for key in self.hop_sizes)
+        self.audio = self.audio[start - self.audio_offset :]
+        self.audio_offset = start
@@ -0,0 +1,123 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the FAIR Noncommercial Research License
+# found in the LICENSE file in the root directory of this source tree.
+
+from collections.abc import Mapping, MutableMapping
+from typing import Any, Dict, Iterator, Optional
+
+import numpy as np
+import torch
+
+UNITS_DTYPE = np.int32
+# compact dtype of the stored units (see `UnitsCorpus`)
+STORAGE_UNITS_DTYPE = np.uint16
+
+
+def to_units_array(units: Any) -> np.ndarray:
+    """
+    Convert units under string form ('1 2 3'), list, array or tensor form to an int array.
+    Arrays of the storage dtype are kept as they are, e.g. the memory-mapped units of a corpus.
+    """
+    if isinstance(units, str):
+        return np.array(units.split(), dtype=UNITS_DTYPE)
+    if isinstance(units, torch.Tensor):
+        units = units.detach().cpu().numpy()
+    units = np.asarray(units)
+    if units.dtype != STORAGE_UNITS_DTYPE:
+        units = units.astype(UNITS_DTYPE, copy=False)
+    return units.reshape(-1)
+
+
+def get_units_array(units: Mapping, key: str) -> np.ndarray:
+    """Return the units of the key as an int array, units being a `Units` or a dictionary"""
+    if isinstance(units, Units):
+        return units.arrays[key]
+    return to_units_array(units[key])
+
+
+class Units(MutableMapping):
+    """
+    Speech units of an audio: int arrays of units (e.g. 'hubert', 'pitch' and 'style')
+    with their rates (number of units per second) and the path of the audio (if any).
+
+    For compatibility with the dictionary of units strings, `units[key]` returns the units
+    as a space-separated string (and the audio path for 'audio'), the arrays are in `units.arrays`.
+    The units can be set as in the dictionary, under any form of `to_units_array`
+    (e.g. `units["style"] = "81 81"`), and `copy()` returns an independent copy.
+
+    Example:
+        units = Units({"hubert": np.array([99, 49, 38])}, rates={"hubert": 25})
+        units.arrays["hubert"]  # array([99, 49, 38], dtype=int32)
+        units["hubert"]  # '99 49 38'
+        units.timestamps("hubert")  # array([0.  , 0.04, 0.08])
+    """
+
+    def __init__(
+        self,
+        arrays: Mapping[str, Any],
+        rates: Optional[Mapping[str, float]] = None,
+        audio: Optional[str] = None,
+    ):
+        if audio is None and "audio" in arrays:
+            audio = arrays["audio"]
+        self.arrays: Dict[str, np.ndarray] = {
+            key: to_units_array(value)
+            for key, value in arrays.items()
+            if key != "audio"
+        }
+        self.rates: Dict[str, float] = dict(rates) if rates is not None else {}
+        self.audio = audio
+        self._strings: Dict[str, str] = {}
+
+    def __getitem__(self, key: str) -> str:
+        if key == "audio" and self.audio is not None:
+            return self.audio
+        if key not in self._strings:
+            self._strings[key] = " ".join(map(str, self.arrays[key].tolist()))
+        return self._strings[key]
+
+    def __setitem__(self, key: str, value: Any):
+        if key == "audio":
+            self.audio = value
+            return
+        self.arrays[key] = to_units_array(value)
+        self._strings.pop(key, None)
+
+    def __delitem__(self, key: str):
+        if key == "audio" and self.audio is not None:
+            self.audio = None
+            return
+        del self.arrays[key]
+        self._strings.pop(key, None)
+
+    def __iter__(self) -> Iterator[str]:
+        if self.audio is not None:
+            yield "audio"
+        yield from self.arrays
+
+    def __len__(self) -> int:
+        return len(self.arrays) + int(self.audio is not None)
+
+    def __repr__(self) -> str:
+        return f"Units(arrays={self.arrays}, rates={self.rates}, audio={self.audio!r})"
+
+    def copy(self) -> "Units":
+        return Units(
+            {key: array.copy() for key, array in self.arrays.items()},
+            rates=self.rates,
+            audio=self.audio,
+        )
+
+    def timestamps(self, key: str) -> np.ndarray:
+        """Start time (in seconds) of each unit of the key"""
+        return np.arange(len(self.arrays[key])) / self.rates[key]
+
+    def duration(self, key: str) -> float:
+        """Duration (in seconds) covered by the units of the key"""
+        return len(self.arrays[key]) / self.rates[key]
+
+    def to_dict(self) -> Dict[str, str]:
+        """The dictionary of units strings"""
+        return dict(self.items())
@@ -0,0 +1,226 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the FAIR Noncommercial Research License
+# found in the LICENSE file in the root directory of this source tree.
+
+# Binary corpus of speech units: the units of all the utterances are concatenated in one
+# uint16 file per unit key, which is memory-mapped with its offsets and the utterance ids,
+# so that opening a corpus does not read it and the units are read as zero-copy views.
+#
+# Layout of the corpus directory:
+#   metadata.json       unit keys, rates and number of utterances
+#   {key}.bin           concatenated units of the key (uint16)
+#   {key}.offsets.npy   start of the units of each utterance, and the total length (int64)
+#   ids.npy             utterance ids, in corpus order (bytes)
+#   sorted_ids.npy      sorted utterance ids, and their indices in sorted_indices.npy,
+#   sorted_indices.npy  to look up an utterance by binary search
+
+import json
+import os
+from collections.abc import Mapping
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Union
+
+import numpy as np
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+from spiritlm.tokenize_manifest import units_table_rates
+
+from .units import STORAGE_UNITS_DTYPE, Units, get_units_array
+
+METADATA_FILE = "metadata.json"
+
+
+class UnitsCorpusWriter:
+    """
+    Write the units of utterances to a `UnitsCorpus` directory, the units are appended to
+    the files as they are added and the index is written when the writer is closed.
+
+    Example:
+        with UnitsCorpusWriter("units/corpus", keys=["hubert", "pitch", "style"]) as writer:
+            for utterance_id, units in ...:
+                writer.add(utterance_id, units)
+    """
+
+    def __init__(
+        self,
+        path: Union[str, Path],
+        keys: List[str],
+        rates: Optional[Dict[str, float]] = None,
+    ):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.keys = list(keys)
+        self.rates = dict(rates) if rates is not None else {}
+        self.ids: List[str] = []
+        self.lengths: Dict[str, List[np.ndarray]] = {key: [] for key in self.keys}
+        self.files = {key: open(self.path / f"{key}.bin", "wb") for key in self.keys}
+
+    def add(self, utterance_id: str, units):
+        """Add the units (`Units` or dictionary of units) of an utterance"""
+        self.add_batch(
+            [utterance_id],
+            {key: get_units_array(units, key) for key in self.keys},
+            {key: np.array([len(get_units_array(units, key))]) for key in self.keys},
+        )
+
+    def add_batch(
+        self,
+        utterance_ids: List[str],
+        values: Dict[str, np.ndarray],
+        lengths: Dict[str, np.ndarray],
+    ):
+        """
+        Add the units of several utterances, given for each key as the concatenated units
+        of the utterances and their lengths.
+        """
+        for key in self.keys:
+            assert len(lengths[key]) == len(utterance_ids), "expects one length per id"
+            assert lengths[key].sum() == len(values[key]), "lengths don't match the units"
+            if len(values[key]) and (
+                values[key].min() < 0
+                or values[key].max() > np.iinfo(STORAGE_UNITS_DTYPE).max
+            ):
+                raise ValueError(f"The {key} units don't fit in {STORAGE_UNITS_DTYPE}")
+            self.files[key].write(values[key].astype(STORAGE_UNITS_DTYPE).tobytes())
+            self.lengths[key].append(np.asarray(lengths[key], dtype=np.int64))
+        self.ids.extend(str(utterance_id) for utterance_id in utterance_ids)
+
+    def close(self):
+        for file in self.files.values():
+            file.close()
+        for key in self.keys:
+            lengths = np.concatenate([np.zeros(1, dtype=np.int64), *self.lengths[key]])
+            np.save(self.path / f"{key}.offsets.npy", np.cumsum(lengths))
+
+        ids = np.array([utterance_id.encode("utf-8") for utterance_id in self.ids])
+        if not len(ids):
+            ids = np.zeros(0, dtype="S1")
+        sorted_indices = np.argsort(ids, kind="stable")
+        sorted_ids = ids[sorted_indices]
+        if len(ids) and (sorted_ids[1:] == sorted_ids[:-1]).any():
+            duplicated_id = sorted_ids[1:][sorted_ids[1:] == sorted_ids[:-1]][0]
+            raise ValueError(f"Found duplicated utterance id: {duplicated_id.decode()}")
+        np.save(self.path / "ids.npy", ids)
+        np.save(self.path / "sorted_ids.npy", sorted_ids)
+        np.save(self.path / "sorted_indices.npy", sorted_indices)
+        with open(self.path / METADATA_FILE, "w") as f:
+            json.dump(
+                {
+                    "keys": self.keys,
+                    "rates": self.rates,
+                    "num_utterances": len(ids),
+                    "dtype": np.dtype(STORAGE_UNITS_DTYPE).name,
+                },
+                f,
+                indent=2,
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class UnitsCorpus(Mapping):
+    """
+    Memory-mapped corpus of speech units written by `UnitsCorpusWriter`, mapping the
+    utterance ids to their `Units`, whose arrays are zero-copy (read-only) views of the
+    corpus files. The units can be converted to strings (`units2string`) or decoded
+    (`decode`) by the speech tokenizer as any units.
+
+    Example:
+        corpus = UnitsCorpus("units/corpus")
+        units = corpus["utt1"]  # or corpus.get_units(0) for the first utterance
+        tokenizer.units2string(units)
+    """
+
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        with open(self.path / METADATA_FILE) as f:
+            metadata = json.load(f)
+        self.unit_keys = metadata["keys"]
+        self.rates = metadata["rates"]
+        self.num_utterances = metadata["num_utterances"]
+        assert metadata["dtype"] == np.dtype(STORAGE_UNITS_DTYPE).name, metadata
+
+        self.ids = np.load(self.path / "ids.npy", mmap_mode="r")
+        self.sorted_ids = np.load(self.path / "sorted_ids.npy", mmap_mode="r")
+        self.sorted_indices = np.load(self.path / "sorted_indices.npy", mmap_mode="r")
+        self.offsets = {
+            key: np.load(self.path / f"{key}.offsets.npy", mmap_mode="r")
+            for key in self.unit_keys
+        }
+        self.units = {}
+        for key in self.unit_keys:
+            if os.path.getsize(self.path / f"{key}.bin"):
+                self.units[key] = np.memmap(
+                    self.path / f"{key}.bin", dtype=STORAGE_UNITS_DTYPE, mode="r"
+                )
+            else:
+                # empty files cannot be memory-mapped
+                self.units[key] = np.zeros(0, dtype=STORAGE_UNITS_DTYPE)
+
+    def index(self, utterance_id: str) -> int:
+        """Index of the utterance in the corpus, by binary search of the sorted ids"""
+        utterance_id = str(utterance_id).encode("utf-8")
+        i = np.searchsorted(self.sorted_ids, utterance_id)
+        if i == len(self.sorted_ids) or self.sorted_ids[i] != utterance_id:
+            raise KeyError(utterance_id.decode("utf-8"))
+        return int(self.sorted_indices[i])
+
+    def get_units(self, index: int) -> Units:
+        """Units of the utterance at the index (in corpus order)"""
+        if not 0 <= index < self.num_utterances:
+            raise IndexError(index)
+        arrays = {
+            key: self.units[key][self.offsets[key][index] : self.offsets[key][index + 1]]
+            for key in self.unit_keys
+        }
+        return Units(arrays, rates=self.rates)
+
+    def __getitem__(self, utterance_id: str) -> Units:
+        return self.get_units(self.index(utterance_id))
+
+    def __iter__(self) -> Iterator[str]:
+        for utterance_id in self.ids:
+            yield utterance_id.decode("utf-8")
+
+    def __len__(self) -> int:
+        return self.num_utterances
+
+
+def write_units_corpus_from_shards(
+    shard_paths: Iterable[Union[str, Path]],
+    path: Union[str, Path],
+    rates: Optional[Dict[str, float]] = None,
+):
+    """
+    Write a `UnitsCorpus` from the Parquet or Arrow shards of units written by `spiritlm-tokenize`,
+    the unit columns are copied without being converted to python objects.
+    The rates of the units are read from the shards if not given.
+    """
+    writer = None
+    for shard_path in shard_paths:
+        if str(shard_path).endswith(".arrow"):
+            table = feather.read_table(shard_path)
+        else:
+            table = pq.read_table(shard_path)
+        keys = [
+            name for name in table.column_names if name not in ("id", "audio", "duration")
+        ]
+        if writer is None:
+            if rates is None:
+                rates = units_table_rates(table)
+            writer = UnitsCorpusWriter(path, keys=keys, rates=rates)
+        assert keys == writer.keys, f"{shard_path} has the unit keys {keys}"
+        values, lengths = {}, {}
+        for key in keys:
+            column = table[key].combine_chunks()
+            values[key] = column.flatten().to_numpy(zero_copy_only=False)
+            lengths[key] = column.value_lengths().to_numpy(zero_copy_only=False)
+        writer.add_batch(table["id"].to_pylist(), values, lengths)
+    assert writer is not None, "expects at least one shard"
+    writer.close()
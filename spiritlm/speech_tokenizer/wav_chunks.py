@@ -0,0 +1,92 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the FAIR Noncommercial Research License
+# found in the LICENSE file in the root directory of this source tree.
+
+# Overlapping wav chunks of long audio: each chunk is extracted on a window extended
+# by some context on both sides, and only keeps the units of its own samples, so that
+# the units at the chunk boundaries are not computed without context.
+
+from typing import List, Optional, Sequence, Tuple
+
+
+def overlapping_chunks(
+    num_samples: int,
+    chunk_size: int,
+    overlap: int,
+    hop_size: int,
+    receptive_field: int = 1,
+    min_chunk: int = 0,
+) -> List[Tuple[int, int, int, Optional[int]]]:
+    """
+    Split `num_samples` samples into chunks of `chunk_size` samples, each one extended by
+    `overlap` samples of context on both sides, and return for each chunk the tuple
+    (window start, window end, first unit, end unit).
+
+    The units are the frames of a convolutional model of stride `hop_size` and
+    receptive field `receptive_field`: the unit i covers the samples
+    [i * hop_size, i * hop_size + receptive_field), and there are
+    `num_frames(num_samples, hop_size, receptive_field)` units in the audio
+    (a receptive field of 1 gives ceil(num_samples / hop_size) units).
+    The window starts are aligned on `hop_size`, so that the units of the windows are
+    aligned with the units of the whole audio, and each chunk keeps the units
+    [first unit, end unit) of the audio starting in its samples, end unit being None
+    for the last chunk (which keeps all the units until the end of its window).
+    The overlap is at least the receptive field, so that the windows compute all the
+    units of their chunk. A last chunk shorter than `min_chunk` is merged into the
+    previous one.
+    """
+    assert chunk_size > 0 and hop_size > 0 and receptive_field > 0
+    assert overlap >= receptive_field, (
+        f"the overlap ({overlap} samples) is shorter than "
+        f"the receptive field ({receptive_field} samples)"
+    )
+    boundaries = list(range(0, num_samples, chunk_size))
+    if len(boundaries) > 1 and num_samples - boundaries[-1] < min_chunk:
+        boundaries.pop()
+    boundaries.append(num_samples)
+
+    total_units = num_frames(num_samples, hop_size, receptive_field)
+    chunks = []
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        window_start = max(0, start - overlap) // hop_size * hop_size
+        window_end = min(num_samples, end + overlap)
+        # the units starting in [start, end)
+        first_unit = min(-(-start // hop_size), total_units)
+        end_unit = min(-(-end // hop_size), total_units) if end < num_samples else None
+        chunks.append((window_start, window_end, first_unit, end_unit))
+    return chunks
+
+
+def num_frames(num_samples: int, hop_size: int, receptive_field: int = 1) -> int:
+    """
+    Number of frames of stride `hop_size` and receptive field `receptive_field` in
+    `num_samples` samples, like the output length of a stack of convolutions
+    """
+    return max(0, (num_samples - receptive_field) // hop_size + 1)
+
+
+def stitch_chunks(
+    window_units: Sequence,
+    chunks: List[Tuple[int, int, int, Optional[int]]],
+    hop_size: int,
+) -> list:
+    """
+    Slice the units (or features, along their first dimension) of the windows of
+    `overlapping_chunks` to the units of their chunks, which follow each other.
+    """
+    assert len(window_units) == len(chunks), "expects the units of each window"
+    chunk_units = []
+    for units, (window_start, window_end, first_unit, end_unit) in zip(
+        window_units, chunks
+    ):
+        window_first_unit = window_start // hop_size
+        first = first_unit - window_first_unit
+        last = None if end_unit is None else end_unit - window_first_unit
+        assert last is None or len(units) >= last, (
+            f"the window [{window_start}, {window_end}) has {len(units)} units, "
+            f"expects at least {last}"
+        )
+        chunk_units.append(units[first:last])
+    return chunk_units
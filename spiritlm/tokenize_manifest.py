@@ -0,0 +1,444 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the FAIR Noncommercial Research License
+# found in the LICENSE file in the root directory of this source tree.
+
+"""
+Bulk tokenization of an audio manifest into sharded Parquet (or Arrow) files of speech units.
+
+The manifest is either a jsonl file with one record per audio, e.g.
+    {"id": "utt1", "wav_path": "path/to/utt1.wav"}
+    {"id": "utt2", "wav_path": "path/to/utt2.wav", "channel": 0}
+or a fairseq-style tsv file, with the root directory on the first line and then one
+relative audio path (and its number of samples) per line, the id being the relative path.
+
+The manifest is split into shards of `--shard_size` audios, tokenized by a pool of
+`--num_workers` processes (each one loading the tokenizer once, on its own GPU if any).
+Each shard is written to `{output_dir}/shard-{index:05d}.parquet` with the columns
+id, audio, duration (in seconds) and the unit arrays (hubert, pitch and style),
+the rates of the units being recorded in the schema metadata.
+The audios which failed to load or to tokenize are listed (with their error) in
+`{output_dir}/shard-{index:05d}.failed.jsonl`, only written if some audios of the shard failed.
+A run can be resumed: the shards already written are skipped.
+
+Usage example:
+
+cd {SPIRITLM ROOT FOLDER}
+spiritlm-tokenize --manifest data/examples/ref.jsonl --output_dir units/ref \
+    --tokenizer expressive --num_workers 8
+"""
+
+import argparse
+import csv
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+import torch
+
+# spiritlm.speech_tokenizer is only imported by the workers, once their GPU is selected:
+# the speech tokenizer models are placed on the current device when the module is imported
+
+_logger = logging.getLogger(__name__)
+
+# tokenizer of the worker process
+_TOKENIZER = None
+
+FORMAT_EXTENSIONS = {"parquet": ".parquet", "arrow": ".arrow"}
+
+# schema metadata of the shards holding the rates of their unit keys
+RATES_METADATA_KEY = "spiritlm.rates"
+
+
+def read_manifest(
+    manifest_path: str,
+    root_dir: Optional[str] = None,
+    id_field: str = "id",
+    audio_field: str = "wav_path",
+) -> List[Dict[str, Any]]:
+    """
+    Read the audio manifest (jsonl or fairseq-style tsv) into a list of records
+    with the id, the audio path (joined to root_dir if relative) and the channel.
+    """
+    records = []
+    with open(manifest_path) as f:
+        if str(manifest_path).endswith(".tsv"):
+            reader = csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE)
+            tsv_root_dir = next(reader)[0]
+            for row in reader:
+                if row:
+                    records.append(
+                        {
+                            "id": row[0],
+                            "audio": os.path.join(tsv_root_dir, row[0]),
+                            "channel": None,
+                        }
+                    )
+        else:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                records.append(
+                    {
+                        "id": str(record.get(id_field, record[audio_field])),
+                        "audio": record[audio_field],
+                        "channel": record.get("channel"),
+                    }
+                )
+    if root_dir is not None:
+        for record in records:
+            record["audio"] = os.path.join(root_dir, record["audio"])
+    ids = set(record["id"] for record in records)
+    if len(ids) != len(records):
+        raise ValueError(f"Found duplicated ids in {manifest_path}")
+    return records
+
+
+def shard_path(output_dir: str, shard_index: int, format: str = "parquet") -> Path:
+    return Path(output_dir) / f"shard-{shard_index:05d}{FORMAT_EXTENSIONS[format]}"
+
+
+def failed_path(output_path: Path) -> Path:
+    """Path of the jsonl file listing the failed audios of the shard at output_path"""
+    return output_path.with_name(output_path.stem + ".failed.jsonl")
+
+
+def units_table(records: List[Dict[str, Any]], units_batch, durations) -> pa.Table:
+    """
+    Arrow table of the units of the records, with one list column per unit key.
+    The rates of the units are in the schema metadata (see `units_table_rates`).
+    """
+    columns = {
+        "id": pa.array([record["id"] for record in records], type=pa.string()),
+        "audio": pa.array([record["audio"] for record in records], type=pa.string()),
+        "duration": pa.array(durations, type=pa.float64()),
+    }
+    keys = list(units_batch[0].arrays) if units_batch else []
+    for key in keys:
+        arrays = [units.arrays[key] for units in units_batch]
+        offsets = np.concatenate([[0], np.cumsum([len(array) for array in arrays])])
+        columns[key] = pa.ListArray.from_arrays(
+            pa.array(offsets, type=pa.int32()),
+            pa.array(np.concatenate(arrays).astype(np.int32), type=pa.int32()),
+        )
+    rates = units_batch[0].rates if units_batch else {}
+    return pa.table(columns, metadata={RATES_METADATA_KEY: json.dumps(rates)})
+
+
+def units_table_rates(table: pa.Table) -> Dict[str, float]:
+    """Rates of the units of a table of `units_table` ({} if they are not recorded)"""
+    metadata = table.schema.metadata or {}
+    return json.loads(metadata.get(RATES_METADATA_KEY.encode(), b"{}"))
+
+
+def _encode_batch(tokenizer, records, audios, batch_size, failed):
+    """
+    Encode the units of a batch of audios, if the batch fails each audio is encoded on its own
+    so that only the failing audios are dropped (and added to `failed`).
+    Return the records and the units of the encoded audios.
+    """
+    channel_ids = [record["channel"] for record in records]
+    try:
+        return records, tokenizer.encode_units_batch(
+            audios, channel_ids=channel_ids, batch_size=batch_size
+        )
+    except Exception as e:
+        if len(audios) == 1:
+            _logger.warning(f"Failed to tokenize {records[0]['audio']}: {e}")
+            failed.append({**records[0], "error": repr(e)})
+            return [], []
+        _logger.warning(
+            f"Failed to tokenize a batch, tokenizing its audios one by one: {e}"
+        )
+    encoded_records, units_batch = [], []
+    for record, audio in zip(records, audios):
+        record_encoded, record_units = _encode_batch(
+            tokenizer, [record], [audio], batch_size, failed
+        )
+        encoded_records += record_encoded
+        units_batch += record_units
+    return encoded_records, units_batch
+
+
+def _write_jsonl(path: Path, records: List[Dict[str, Any]]):
+    with open(path, "w") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+
+
+def _write_atomic(output_path: Path, write_fn):
+    # written to a temporary path and then renamed, so that the file only exists complete
+    tmp_path = output_path.with_name(output_path.name + ".tmp")
+    write_fn(tmp_path)
+    os.replace(tmp_path, output_path)
+
+
+def tokenize_shard(
+    tokenizer,
+    records: List[Dict[str, Any]],
+    output_path: Path,
+    batch_size: int = 16,
+) -> Dict[str, float]:
+    """
+    Tokenize the audios of the records by batches of `batch_size` and write their units
+    to output_path (Parquet or Arrow according to its extension).
+    The audios which fail to load or to tokenize are skipped, and written with their error
+    to the jsonl file of `failed_path(output_path)`, before the shard itself.
+    The files are written to a temporary path and then renamed, so that they only exist complete.
+    Return the number of audios, their duration and the number of failed audios.
+    """
+    batches = []
+    durations = []
+    tokenized_records = []
+    failed = []
+    for start in range(0, len(records), batch_size):
+        batch_records, audios = [], []
+        for record in records[start : start + batch_size]:
+            try:
+                audio = tokenizer.load_audio(record["audio"])
+            except Exception as e:
+                _logger.warning(f"Failed to load {record['audio']}: {e}")
+                failed.append({**record, "error": repr(e)})
+                continue
+            batch_records.append(record)
+            audios.append(audio)
+        if not audios:
+            continue
+        audio_durations = {
+            record["id"]: audio.size(-1) / tokenizer.expected_sample_rate
+            for record, audio in zip(batch_records, audios)
+        }
+        batch_records, units_batch = _encode_batch(
+            tokenizer, batch_records, audios, batch_size, failed
+        )
+        batches += units_batch
+        durations += [audio_durations[record["id"]] for record in batch_records]
+        tokenized_records += batch_records
+
+    if failed:
+        _write_atomic(
+            failed_path(output_path), lambda path: _write_jsonl(path, failed)
+        )
+    elif failed_path(output_path).exists():
+        # left by a previous attempt of the shard
+        failed_path(output_path).unlink()
+
+    table = units_table(tokenized_records, batches, durations)
+    if output_path.suffix == FORMAT_EXTENSIONS["arrow"]:
+        _write_atomic(
+            output_path,
+            lambda path: feather.write_feather(
+                table, path, compression="uncompressed"
+            ),
+        )
+    else:
+        _write_atomic(output_path, lambda path: pq.write_table(table, path))
+    return {
+        "num_audios": len(tokenized_records),
+        "duration": float(sum(durations)),
+        "num_failed": len(failed),
+    }
+
+
+def _init_worker(
+    worker_counter,
+    devices: List[str],
+    num_threads: int,
+    tokenizer_name: str,
+    f0_backbone: str,
+):
+    global _TOKENIZER
+    with worker_counter.get_lock():
+        worker_index = worker_counter.value
+        worker_counter.value += 1
+    # one GPU per worker (round robin), selected before any CUDA initialization
+    if devices:
+        os.environ["CUDA_VISIBLE_DEVICES"] = devices[worker_index % len(devices)]
+    torch.set_num_threads(num_threads)
+
+    from spiritlm.speech_tokenizer import spiritlm_base, spiritlm_expressive
+
+    if tokenizer_name == "base":
+        _TOKENIZER = spiritlm_base()
+    elif tokenizer_name == "expressive":
+        _TOKENIZER = spiritlm_expressive(f0_backbone=f0_backbone)
+    else:
+        raise ValueError(f"Unknown tokenizer: {tokenizer_name}")
+
+
+def _tokenize_shard_worker(
+    records: List[Dict[str, Any]], output_path: Path, batch_size: int
+) -> Dict[str, float]:
+    return tokenize_shard(_TOKENIZER, records, output_path, batch_size=batch_size)
+
+
+def _check_run_config(output_dir: Path, run_config: Dict[str, Any]):
+    """Check that a resumed run has the same sharding and tokenizer as the previous one"""
+    config_path = output_dir / "tokenization.json"
+    if config_path.exists():
+        with open(config_path) as f:
+            previous_config = json.load(f)
+        if previous_config != run_config:
+            raise ValueError(
+                f"{output_dir} was tokenized with {previous_config}, "
+                f"cannot resume with {run_config}"
+            )
+    else:
+        with open(config_path, "w") as f:
+            json.dump(run_config, f, indent=2)
+
+
+def run(args):
+    records = read_manifest(
+        args.manifest,
+        root_dir=args.root_dir,
+        id_field=args.id_field,
+        audio_field=args.audio_field,
+    )
+    output_dir = Path(args.output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    _check_run_config(
+        output_dir,
+        {
+            "manifest": os.path.abspath(args.manifest),
+            "num_audios": len(records),
+            "shard_size": args.shard_size,
+            "tokenizer": args.tokenizer,
+            "f0_backbone": args.f0_backbone,
+            "format": args.format,
+        },
+    )
+
+    shards = [
+        (shard_index, records[start : start + args.shard_size])
+        for shard_index, start in enumerate(range(0, len(records), args.shard_size))
+    ]
+    todo_shards = [
+        (shard_index, shard_records)
+        for shard_index, shard_records in shards
+        if not shard_path(output_dir, shard_index, args.format).exists()
+    ]
+    _logger.info(
+        f"{len(records)} audios in {len(shards)} shards, "
+        f"{len(shards) - len(todo_shards)} shards already done"
+    )
+    if not todo_shards:
+        return
+
+    visible_devices = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible_devices:
+        devices = visible_devices.split(",")
+    else:
+        devices = [str(i) for i in range(torch.cuda.device_count())]
+    # spawn the workers, as CUDA cannot be used in forked processes
+    mp_context = multiprocessing.get_context("spawn")
+    start_time = time.perf_counter()
+    num_audios, duration, num_failed = 0, 0.0, 0
+    with ProcessPoolExecutor(
+        max_workers=args.num_workers,
+        mp_context=mp_context,
+        initializer=_init_worker,
+        initargs=(
+            mp_context.Value("i", 0),
+            devices,
+            max(1, (os.cpu_count() or 1) // args.num_workers),
+            args.tokenizer,
+            args.f0_backbone,
+        ),
+    ) as executor:
+        futures = {
+            executor.submit(
+                _tokenize_shard_worker,
+                shard_records,
+                shard_path(output_dir, shard_index, args.format),
+                args.batch_size,
+            ): shard_index
+            for shard_index, shard_records in todo_shards
+        }
+        for num_done, future in enumerate(as_completed(futures), start=1):
+            stats = future.result()
+            num_audios += stats["num_audios"]
+            duration += stats["duration"]
+            num_failed += stats["num_failed"]
+            elapsed = time.perf_counter() - start_time
+            _logger.info(
+                f"shard {futures[future]} done ({num_done}/{len(todo_shards)}), "
+                f"{num_audios / elapsed:.1f} audios/s, "
+                f"{duration / 3600:.2f}h of audio at {duration / elapsed:.1f}x real time"
+                + (f", {num_failed} failed audios" if num_failed else "")
+            )
+    if num_failed:
+        _logger.warning(
+            f"{num_failed} audios failed, listed in {output_dir}/*.failed.jsonl"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Tokenize an audio manifest into sharded files of speech units"
+    )
+    parser.add_argument(
+        "--manifest",
+        type=str,
+        required=True,
+        help="Path to the jsonl or tsv manifest of the audios",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        required=True,
+        help="Directory of the shards of units",
+    )
+    parser.add_argument(
+        "--root_dir",
+        type=str,
+        default=None,
+        help="Root directory of the relative audio paths of the manifest",
+    )
+    parser.add_argument("--id_field", type=str, default="id")
+    parser.add_argument("--audio_field", type=str, default="wav_path")
+    parser.add_argument(
+        "--tokenizer",
+        type=str,
+        default="expressive",
+        choices=["base", "expressive"],
+    )
+    parser.add_argument(
+        "--f0_backbone",
+        type=str,
+        default="fcpe",
+        choices=["fcpe", "pyaapt"],
+        help="F0 extractor of the expressive tokenizer",
+    )
+    parser.add_argument("--shard_size", type=int, default=1000)
+    parser.add_argument(
+        "--batch_size",
+        type=int,
+        default=16,
+        help="Number of audios loaded at once, and of hubert chunks per padded batch",
+    )
+    parser.add_argument("--num_workers", type=int, default=1)
+    parser.add_argument(
+        "--format", type=str, default="parquet", choices=list(FORMAT_EXTENSIONS)
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(
+        level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s"
+    )
+    run(args)
+
+
+if __name__ == "__main__":
+    main()
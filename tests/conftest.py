@@ -0,0 +1,65 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the FAIR Noncommercial Research License
+# found in the LICENSE file in the root directory of this source tree.
+
+import pytest
+import torch
+from omegaconf import OmegaConf
+from spiritlm.speech_tokenizer.f0.vqvae import VQVAE
+from transformers import LlamaConfig, LlamaForCausalLM
+
+TINY_VQVAE_CFG = {
+    "features": "norm_f0_interp,vuv",
+    "speaker_norm": True,
+    "encoder_params": {
+        "input_emb_width": 2,
+        "output_emb_width": 16,
+        "levels": 2,
+        "downs_t": [2, 1],
+        "strides_t": [2, 2],
+        "width": 16,
+        "depth": 2,
+        "m_conv": 1.0,
+        "dilation_growth_rate": 3,
+    },
+    "vq_params": {"l_bins": 32, "emb_width": 16, "mu": 0.99, "levels": 2},
+    "decoder_params": {
+        "input_emb_width": 2,
+        "output_emb_width": 16,
+        "levels": 2,
+        "downs_t": [2, 1],
+        "strides_t": [2, 2],
+        "width": 16,
+        "depth": 2,
+        "m_conv": 1.0,
+        "dilation_growth_rate": 3,
+    },
+}
+
+
+@pytest.fixture(scope="module")
+def tiny_vqvae():
+    torch.manual_seed(0)
+    cfg = OmegaConf.create(TINY_VQVAE_CFG)
+    model = VQVAE(cfg).eval()
+    for level_block in model.vq.level_blocks:
+        level_block.k.normal_()
+    return model, cfg
+
+
+@pytest.fixture
+def tiny_llama():
+    torch.manual_seed(0)
+    config = LlamaConfig(
+        vocab_size=128,
+        hidden_size=32,
+        intermediate_size=64,
+        num_hidden_layers=2,
+        num_attention_heads=4,
+        num_key_value_heads=2,
+        max_position_embeddings=256,
+        eos_token_id=2,
+    )
+    return LlamaForCausalLM(config).eval()
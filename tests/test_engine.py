@@ -0,0 +1,124 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the FAIR Noncommercial Research License
+# found in the LICENSE file in the root directory of this source tree.
+
+import torch
+from spiritlm.model.engine import (
+    ContinuousBatchingEngine,
+    _BatchSamplingParams,
+    _get_sampling_params,
+    _process_logits,
+    _Request,
+)
+from transformers import (
+    GenerationConfig,
+    LogitsProcessorList,
+    RepetitionPenaltyLogitsProcessor,
+    TemperatureLogitsWarper,
+    TopKLogitsWarper,
+    TopPLogitsWarper,
+)
+
+
+def _greedy_generate(model, input_ids, max_new_tokens):
+    output = model.generate(
+        torch.tensor([input_ids]),
+        max_new_tokens=max_new_tokens,
+        do_sample=False,
+        pad_token_id=0,
+    )
+    return output[0, len(input_ids) :].tolist()
+
+
+def test_continuous_batching_matches_generate(tiny_llama):
+    torch.manual_seed(1)
+    prompts = [torch.randint(3, 128, (length,)).tolist() for length in [5, 17, 9, 30]]
+    max_new_tokens = [12, 3, 25, 7]
+
+    engine = ContinuousBatchingEngine(tiny_llama, max_batch_size=2)
+    request_ids = [
+        engine.submit(prompt, max_new_tokens=n, do_sample=False)
+        for prompt, n in zip(prompts[:2], max_new_tokens[:2])
+    ]
+    finished_ids = engine.step() + engine.step()
+    # admit new requests while the first ones are still running
+    request_ids += [
+        engine.submit(prompt, max_new_tokens=n, do_sample=False)
+        for prompt, n in zip(prompts[2:], max_new_tokens[2:])
+    ]
+    while engine.has_unfinished_requests():
+        finished_ids += engine.step()
+        assert engine.num_running <= 2
+    outputs = {request_id: engine.poll(request_id) for request_id in finished_ids}
+
+    for request_id, prompt, n in zip(request_ids, prompts, max_new_tokens):
+        assert outputs[request_id] == _greedy_generate(tiny_llama, prompt, n)
+
+
+def test_continuous_batching_forbidden_tokens(tiny_llama):
+    engine = ContinuousBatchingEngine(tiny_llama)
+    forbidden_tokens_mask = torch.arange(128) < 64
+    request_id = engine.submit(
+        [5, 6, 7], max_new_tokens=10, forbidden_tokens_mask=forbidden_tokens_mask
+    )
+    engine.run_until_complete()
+    output_ids = engine.poll(request_id)
+    assert len(output_ids) == 10
+    assert all(tok_id >= 64 for tok_id in output_ids)
+    assert engine.poll(request_id) is None
+
+
+def test_process_logits_matches_hf_processors():
+    torch.manual_seed(0)
+    vocab_size = 64
+    generation_configs = [
+        GenerationConfig(do_sample=False, repetition_penalty=1.3),
+        GenerationConfig(do_sample=True, temperature=0.7, top_k=10, top_p=0.9),
+        GenerationConfig(do_sample=True, top_p=0.5, repetition_penalty=0.8),
+    ]
+    hf_processors = [
+        LogitsProcessorList([RepetitionPenaltyLogitsProcessor(1.3)]),
+        LogitsProcessorList(
+            [TemperatureLogitsWarper(0.7), TopKLogitsWarper(10), TopPLogitsWarper(0.9)]
+        ),
+        LogitsProcessorList(
+            [
+                RepetitionPenaltyLogitsProcessor(0.8),
+                TopKLogitsWarper(50),
+                TopPLogitsWarper(0.5),
+            ]
+        ),
+    ]
+    sequences = [torch.randint(0, vocab_size, (n,)) for n in [7, 3, 5]]
+    requests = [
+        _Request(
+            request_id=i,
+            input_ids=sequence.view(1, -1),
+            max_new_tokens=10,
+            do_sample=bool(generation_config.do_sample),
+            eos_token_ids=[],
+            **_get_sampling_params(generation_config),
+        )
+        for i, (sequence, generation_config) in enumerate(
+            zip(sequences, generation_configs)
+        )
+    ]
+    # left-padded sequences, the padding token 0 is not penalized
+    token_ids = torch.zeros((3, 7), dtype=torch.long)
+    attention_mask = torch.zeros((3, 7), dtype=torch.long)
+    for row, sequence in enumerate(sequences):
+        token_ids[row, -len(sequence) :] = sequence
+        attention_mask[row, -len(sequence) :] = 1
+
+    scores = torch.randn(3, vocab_size)
+    processed = _process_logits(
+        scores.clone(),
+        token_ids,
+        attention_mask,
+        _BatchSamplingParams.from_requests(requests, vocab_size, "cpu"),
+    )
+    for row, (sequence, processors) in enumerate(zip(sequences, hf_processors)):
+        expected = processors(sequence.view(1, -1), scores[row : row + 1].clone())
+        assert torch.allclose(processed[row : row + 1], expected)
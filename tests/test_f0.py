@@ -0,0 +1,126 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the FAIR Noncommercial Research License
+# found in the LICENSE file in the root directory of this source tree.
+
+import sys
+import types
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+from spiritlm.speech_tokenizer.f0 import f0_tokenizer
+from spiritlm.speech_tokenizer.f0.f0_extractor import (
+    FCPEF0Extractor,
+    pYAAPTF0Extractor,
+)
+
+
+class _FakeFCPEModel:
+    # fake f0 of the frames of 160 samples, which only depends on the frame samples
+    def get_hop_size(self):
+        return 160
+
+    def get_model_sr(self):
+        return 16_000
+
+    def get_device(self):
+        return torch.device("cpu")
+
+    def infer(self, wav, sr, output_interp_target_length, retur_uv, **kwargs):
+        num_frames = wav.size(1) // 160 + 1
+        frames = F.pad(wav[..., 0], (0, 160))[:, : num_frames * 160]
+        f0 = 40 + 500 * frames.view(wav.size(0), num_frames, 160).abs().mean(-1)
+        uv = (f0 < 50).float()
+        f0, uv = (
+            F.interpolate(
+                y.unsqueeze(1), size=output_interp_target_length, mode="nearest"
+            ).transpose(1, 2)
+            for y in (f0, uv)
+        )
+        return f0, uv
+
+
+@pytest.fixture
+def fcpe_f0_extractor(monkeypatch):
+    torchfcpe = types.ModuleType("torchfcpe")
+    torchfcpe.spawn_bundled_infer_model = lambda device: _FakeFCPEModel()
+    monkeypatch.setitem(sys.modules, "torchfcpe", torchfcpe)
+    return FCPEF0Extractor(hop_length=80, sampling_rate=16_000, interpolate=False)
+
+
+def test_fcpe_compute_f0_uv_batch(fcpe_f0_extractor):
+    torch.manual_seed(0)
+    wavs = [torch.rand(length) * 0.2 for length in [16_000, 1_000, 7_123, 320]]
+    f0, vuv, lengths = fcpe_f0_extractor.compute_f0_uv_batch(wavs)
+    assert isinstance(f0, torch.Tensor) and f0.shape == vuv.shape == (4, 201)
+    assert lengths.tolist() == [201, 13, 90, 5]
+    for i, wav in enumerate(wavs):
+        expected_f0, expected_vuv = fcpe_f0_extractor.compute_f0_uv(wav)
+        np.testing.assert_array_equal(f0[i, : lengths[i]].numpy(), expected_f0)
+        np.testing.assert_array_equal(vuv[i, : lengths[i]].numpy(), expected_vuv)
+        assert not f0[i, lengths[i] :].any() and not vuv[i, lengths[i] :].any()
+
+
+def test_f0_tokenizer_forward_batch(fcpe_f0_extractor, tiny_vqvae, monkeypatch):
+    monkeypatch.setattr(
+        f0_tokenizer, "load_f0_extractor", lambda **kwargs: fcpe_f0_extractor
+    )
+    monkeypatch.setattr(f0_tokenizer, "load_vqvae", lambda path: tiny_vqvae)
+    tokenizer = f0_tokenizer.F0Tokenizer(
+        f0_extractor_method="fcpe", quantizer_path="vqvae.pt", device="cpu"
+    )
+    torch.manual_seed(1)
+    wavs = [torch.rand(length) * 0.2 for length in [16_000, 4_000, 9_999]]
+    for wav, codes in zip(wavs, tokenizer.forward_batch(wavs)):
+        assert torch.equal(codes, tokenizer(wav))
+
+
+class _FakePYAAPTF0Extractor(pYAAPTF0Extractor):
+    # fake pitch of the frames of 80 samples, instead of AMFM-decompy's YAAPT
+    def get_pitch(self, wav):
+        samp_values = np.abs(np.asarray(wav, dtype=np.float64)[::80]) * 1000
+        return SimpleNamespace(samp_values=samp_values, vuv=samp_values > 50)
+
+
+def test_pyaapt_process_pool():
+    extractor = _FakePYAAPTF0Extractor(interpolate=False)
+    torch.manual_seed(2)
+    wavs = [torch.rand(length) * 0.2 for length in [16_000, 1_000, 7_123, 0, 320]]
+    # scipy (for the f0 interpolation) may not be installed
+    expected_f0, expected_vuv, expected_lengths = extractor.compute_f0_uv_batch(
+        wavs, interpolate=False
+    )
+    assert expected_lengths.tolist() == [200, 13, 90, 0, 4]
+
+    extractor.enable_process_pool(num_workers=2)
+    try:
+        executor = extractor._executor
+        # the pool is persistent, and the results are in the order of the waveforms
+        for _ in range(2):
+            f0, vuv, lengths = extractor.compute_f0_uv_batch(wavs, interpolate=False)
+            assert torch.equal(f0, expected_f0) and torch.equal(vuv, expected_vuv)
+            assert torch.equal(lengths, expected_lengths)
+        assert extractor._executor is executor
+        f0, vuv = extractor(wavs[2], vuv=True)
+        np.testing.assert_array_equal(f0, expected_f0[2, :90].numpy())
+    finally:
+        extractor.disable_process_pool()
+    assert extractor._executor is None
+
+
+def test_f0_tokenizer_process_pool_needs_pyaapt(
+    fcpe_f0_extractor, tiny_vqvae, monkeypatch
+):
+    monkeypatch.setattr(
+        f0_tokenizer, "load_f0_extractor", lambda **kwargs: fcpe_f0_extractor
+    )
+    monkeypatch.setattr(f0_tokenizer, "load_vqvae", lambda path: tiny_vqvae)
+    tokenizer = f0_tokenizer.F0Tokenizer(
+        f0_extractor_method="fcpe", quantizer_path="vqvae.pt", device="cpu"
+    )
+    with pytest.raises(ValueError):
+        tokenizer.enable_process_pool()
@@ -0,0 +1,120 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the FAIR Noncommercial Research License
+# found in the LICENSE file in the root directory of this source tree.
+
+import json
+
+import pytest
+import torch
+from spiritlm.speech_tokenizer.hifigan.hifigan_vocoder import (
+    CodeGenerator,
+    HifiGANVocoder,
+)
+
+TINY_HIFIGAN_CONFIG = {
+    "resblock_kernel_sizes": [3, 7],
+    "resblock_dilation_sizes": [[1, 3, 5], [1, 3, 5]],
+    "upsample_rates": [5, 2, 2],
+    "upsample_kernel_sizes": [11, 4, 4],
+    "upsample_initial_channel": 32,
+    "model_in_dim": 32,
+    "num_embeddings": 20,
+    "embedding_dim": 8,
+    "num_f0_tokens": 8,
+    "f0_hop_size": 640,
+    "code_hop_size": 640,
+    "num_style_tokens": 10,
+    "style_hop_size": 640,
+    "multispkr": True,
+    "num_speakers": 4,
+    "dur_predictor_params": {
+        "encoder_embed_dim": 8,
+        "var_pred_hidden_dim": 8,
+        "var_pred_kernel_size": 3,
+        "var_pred_dropout": 0.5,
+    },
+}
+
+
+@pytest.fixture(scope="module")
+def tiny_hifigan(tmp_path_factory):
+    torch.manual_seed(0)
+    model = CodeGenerator(TINY_HIFIGAN_CONFIG)
+    # make the predicted durations vary between codes
+    torch.nn.init.normal_(model.dur_predictor.proj.weight, std=1.0)
+    torch.nn.init.constant_(model.dur_predictor.proj.bias, 1.0)
+    checkpoint_dir = tmp_path_factory.mktemp("hifigan")
+    torch.save({"generator": model.state_dict()}, checkpoint_dir / "generator.pt")
+    with open(checkpoint_dir / "config.json", "w") as f:
+        json.dump(TINY_HIFIGAN_CONFIG, f)
+    return HifiGANVocoder(checkpoint_dir / "generator.pt")
+
+
+@pytest.mark.parametrize("dur_pred", [True, False])
+@pytest.mark.parametrize("chunk_size", [1, 7, 200])
+def test_hifigan_stream_matches_one_shot(tiny_hifigan, dur_pred, chunk_size):
+    torch.manual_seed(1)
+    code = torch.randint(0, 20, (60,)).tolist()
+    f0_code = torch.randint(0, 8, (60,)).tolist()
+    style_code = torch.randint(0, 10, (60,)).tolist()
+    expected = tiny_hifigan(
+        code,
+        speaker_id=1,
+        dur_pred=dur_pred,
+        f0_code=f0_code,
+        style_code=style_code,
+        not_dedup_code=True,
+    )
+
+    stream = tiny_hifigan.stream(speaker_id=1, dur_pred=dur_pred)
+    wav_chunks = []
+    for start in range(0, len(code), chunk_size):
+        end = start + chunk_size
+        wav_chunks.append(
+            stream.push(
+                code[start:end],
+                f0_code=f0_code[start:end],
+                style_code=style_code[start:end],
+            )
+        )
+    wav_chunks.append(stream.flush())
+    wav = torch.cat(wav_chunks)
+
+    assert wav.shape == expected.shape
+    torch.testing.assert_close(wav, expected, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize("dur_pred", [True, False])
+def test_hifigan_decode_batch_matches_decode(tiny_hifigan, dur_pred):
+    torch.manual_seed(2)
+    lengths = [30, 7, 52]
+    codes = [torch.randint(0, 20, (length,)).tolist() for length in lengths]
+    f0_codes = [torch.randint(0, 8, (length,)).tolist() for length in lengths]
+    style_codes = [torch.randint(0, 10, (length,)).tolist() for length in lengths]
+    speaker_ids = [0, 3, 1]
+
+    wavs = tiny_hifigan.decode_batch(
+        codes,
+        speaker_id=speaker_ids,
+        dur_pred=dur_pred,
+        f0_codes=f0_codes,
+        style_codes=style_codes,
+        not_dedup_code=True,
+    )
+
+    assert len(wavs) == len(codes)
+    for wav, code, f0_code, style_code, speaker_id in zip(
+        wavs, codes, f0_codes, style_codes, speaker_ids
+    ):
+        expected = tiny_hifigan(
+            code,
+            speaker_id=speaker_id,
+            dur_pred=dur_pred,
+            f0_code=f0_code,
+            style_code=style_code,
+            not_dedup_code=True,
+        )
+        assert wav.shape == expected.shape
+        torch.testing.assert_close(wav, expected, rtol=1e-4, atol=1e-5)
@@ -0,0 +1,204 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the FAIR Noncommercial Research License
+# found in the LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import pytest
+import torch
+from spiritlm.speech_tokenizer.hubert.hubert_model import (
+    HubertConfig,
+    HubertModel,
+    HubertPretrainingConfig,
+)
+from spiritlm.speech_tokenizer.hubert.hubert_tokenizer import HubertTokenizer
+from spiritlm.speech_tokenizer.hubert.quantizer_model import forward_fill_blanks
+from spiritlm.speech_tokenizer.spiritlm_tokenizer import SpiritLMTokenizer
+from spiritlm.speech_tokenizer.wav_chunks import (
+    num_frames,
+    overlapping_chunks,
+    stitch_chunks,
+)
+
+TINY_HUBERT_MODEL_CFG = {
+    "label_rate": 25.0,
+    "extractor_mode": "default",
+    "conv_feature_layers": "[(32, 10, 5)] + [(32, 3, 2)] * 4 + [(32, 2, 2)] * 3",
+    "encoder_layers": 3,
+    "encoder_embed_dim": 32,
+    "encoder_ffn_embed_dim": 64,
+    "encoder_attention_heads": 4,
+    "conv_pos": 16,
+    "conv_pos_groups": 4,
+}
+TINY_HUBERT_TASK_CFG = {"label_rate": 25.0, "sample_rate": 16_000, "normalize": True}
+
+
+def _tiny_hubert_tokenizer(checkpoint_dir, **model_cfg):
+    model_cfg = {**TINY_HUBERT_MODEL_CFG, **model_cfg}
+    model = HubertModel(
+        HubertConfig(**model_cfg),
+        HubertPretrainingConfig(**TINY_HUBERT_TASK_CFG),
+    )
+    torch.save(
+        {
+            "model_cfg": model_cfg,
+            "task_cfg": TINY_HUBERT_TASK_CFG,
+            "model_weight": model.state_dict(),
+            "dictionaries_symbols": [],
+        },
+        checkpoint_dir / "hubert.pt",
+    )
+    vocab_size, dim = 10, 32
+    encoder = torch.nn.Sequential(
+        torch.nn.Linear(dim, 24),
+        torch.nn.LeakyReLU(),
+        torch.nn.Linear(24, 16),
+        torch.nn.LeakyReLU(),
+        torch.nn.Linear(16, vocab_size + 1),
+    )
+    torch.save(
+        {
+            # upstream_dim - (vocab_size + 1) = 32, giving the hidden dims 24 and 16
+            "model_cfg": {"vocab_size": vocab_size, "dim": dim, "upstream_dim": 43},
+            "model_weight": encoder.state_dict(),
+        },
+        checkpoint_dir / "quantizer.pt",
+    )
+    return HubertTokenizer(
+        hubert_ckpt=checkpoint_dir / "hubert.pt",
+        hubert_layer=2,
+        quantizer_ckpt=checkpoint_dir / "quantizer.pt",
+        max_chunk=16_000,
+    )
+
+
+@pytest.fixture(scope="module")
+def tiny_hubert_tokenizer(tmp_path_factory):
+    torch.manual_seed(0)
+    return _tiny_hubert_tokenizer(tmp_path_factory.mktemp("hubert"))
+
+
+def test_hubert_forward_batch_matches_forward(tiny_hubert_tokenizer):
+    torch.manual_seed(1)
+    # lengths across several max_chunk, with a last chunk shorter than min_chunk
+    wavs = [torch.randn(length) for length in [8_000, 20_000, 1_000, 32_200]]
+
+    batch_feats = tiny_hubert_tokenizer.forward_batch(wavs, dense=True)
+    batch_tokens = tiny_hubert_tokenizer.forward_batch(wavs)
+
+    for wav, feats, tokens in zip(wavs, batch_feats, batch_tokens):
+        expected_feats = tiny_hubert_tokenizer(wav, dense=True)[0]
+        assert feats.shape == expected_feats.shape
+        torch.testing.assert_close(feats, expected_feats, rtol=1e-4, atol=1e-4)
+        assert torch.equal(tokens, tiny_hubert_tokenizer(wav))
+
+
+def test_hubert_extract_features_inference():
+    torch.manual_seed(2)
+    model = HubertModel(
+        HubertConfig(**TINY_HUBERT_MODEL_CFG),
+        HubertPretrainingConfig(**TINY_HUBERT_TASK_CFG),
+    ).eval()
+    source = torch.randn(2, 12_000)
+    padding_mask = torch.arange(12_000)[None, :] >= torch.tensor([[12_000], [7_000]])
+    with torch.no_grad():
+        expected, expected_padding_mask = model.extract_features(
+            source, padding_mask=padding_mask, mask=False, output_layer=2
+        )
+
+    model.prune_for_inference(output_layer=2)
+    assert len(model.encoder.layers) == 2
+    assert model.mask_emb is None and model.final_proj is None
+    features, features_padding_mask = model.extract_features_inference(
+        source, padding_mask=padding_mask, output_layer=2
+    )
+    torch.testing.assert_close(features, expected)
+    assert torch.equal(features_padding_mask, expected_padding_mask)
+
+
+def _loop_forward_fill_blanks(code, blank):
+    # reference implementation: the former post-processing loop of LinearQuantizerModel
+    code = code.clone()
+    non_stop_counter = 0
+    while (code == blank).any():
+        non_stop_counter += 1
+        code[code == blank] = torch.roll(code, 1)[code == blank]
+        if non_stop_counter == 10000:
+            break
+    return code
+
+
+@pytest.mark.parametrize("blank_prob", [0.0, 0.3, 0.9])
+def test_forward_fill_blanks(blank_prob):
+    torch.manual_seed(3)
+    blank = 10
+    for length in [1, 2, 7, 50]:
+        codes = torch.randint(0, blank, (8, length))
+        codes[torch.rand(codes.shape) < blank_prob] = blank
+        codes[codes.eq(blank).all(-1)] = 0  # the loop runs 10000 passes on only blanks
+        # the loop rolls the flattened units, so it is applied per sequence
+        expected = torch.stack(
+            [_loop_forward_fill_blanks(code, blank) for code in codes]
+        )
+        assert torch.equal(forward_fill_blanks(codes, blank), expected)
+        assert torch.equal(forward_fill_blanks(codes[0], blank), expected[0])
+
+    # sequences with only blanks are unchanged
+    codes = torch.tensor([[10, 10, 10], [10, 4, 10]])
+    assert forward_fill_blanks(codes, 10).tolist() == [[10, 10, 10], [4, 4, 4]]
+
+
+def test_hubert_overlapped_chunks_frames(tmp_path):
+    torch.manual_seed(5)
+    # the group norm of the "default" extractor mode normalizes over the whole window,
+    # the conv layers of the "layer_norm" mode only depend on their receptive field
+    tokenizer = _tiny_hubert_tokenizer(tmp_path, extractor_mode="layer_norm")
+    tokenizer.max_chunk = 100 * 16_000
+    feature_extractor = tokenizer.hubert_model.feature_extractor
+    hop_size, receptive_field = tokenizer.code_hop_size, tokenizer.receptive_field
+    assert (hop_size, receptive_field) == (640, 720)
+    # 20s of audio give 499 frames, not ceil(320_000 / 640)
+    assert feature_extractor.get_output_lengths(torch.tensor([320_000])).item() == 499
+    assert num_frames(320_000, hop_size, receptive_field) == 499
+
+    wav = torch.randn(1, 50_000)
+    chunks = overlapping_chunks(
+        50_000, 16_000, receptive_field, hop_size, receptive_field=receptive_field
+    )
+    with torch.no_grad():
+        expected_feats = feature_extractor(wav)[0].T
+        window_feats = [
+            feature_extractor(wav[:, start:end])[0].T for start, end, _, _ in chunks
+        ]
+    # the stitched conv frames are the conv frames of the whole audio
+    feats = torch.cat(stitch_chunks(window_feats, chunks, hop_size))
+    assert feats.shape == expected_feats.shape
+    torch.testing.assert_close(feats, expected_feats, rtol=1e-4, atol=1e-4)
+
+    # the long audio mode of SpiritLMTokenizer runs the windows with forward_batch
+    spiritlm_tokenizer = SpiritLMTokenizer(hubert_model=tokenizer)
+    wavs = [torch.randn(length) for length in [320_000, 50_000, 17_000]]
+    expected_units = spiritlm_tokenizer.encode_units_batch(wavs)
+    # with an overlap longer than the audio, each window is the whole audio,
+    # the stitched units are the units of the whole audio
+    spiritlm_tokenizer.enable_long_audio_mode(
+        chunk_seconds=1.0, overlap_seconds=20.0, batch_size=4
+    )
+    units_batch = spiritlm_tokenizer.encode_units_batch(wavs)
+    for units, expected in zip(units_batch, expected_units):
+        np.testing.assert_array_equal(units.arrays["hubert"], expected.arrays["hubert"])
+    # with a short overlap, the units are aligned frame for frame, but their values
+    # depend on the window (the attention of the encoder only sees the window)
+    spiritlm_tokenizer.enable_long_audio_mode(
+        chunk_seconds=1.0, overlap_seconds=0.2, batch_size=4
+    )
+    units_batch = spiritlm_tokenizer.encode_units_batch(wavs)
+    for wav, units, expected in zip(wavs, units_batch, expected_units):
+        hubert_units = units.arrays["hubert"]
+        assert hubert_units.shape == expected.arrays["hubert"].shape
+        assert len(hubert_units) == num_frames(len(wav), hop_size, receptive_field)
+
+    with pytest.raises(AssertionError, match="receptive field"):
+        spiritlm_tokenizer.enable_long_audio_mode(overlap_seconds=0.04)
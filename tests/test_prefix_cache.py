@@ -0,0 +1,95 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the FAIR Noncommercial Research License
+# found in the LICENSE file in the root directory of this source tree.
+
+import torch
+from spiritlm.model.prefix_cache import PrefixCache
+from spiritlm.model.utils import build_kv_cache, get_kv_cache_tensors
+
+
+def _kv_tensors(token_ids, num_layers=2):
+    # fake KV tensors of shape (1, H, L, D) whose values encode the token ids
+    position_values = torch.tensor(token_ids, dtype=torch.float).view(1, 1, -1, 1)
+    return [
+        (
+            position_values.expand(1, 2, -1, 4) + layer_idx,
+            -position_values.expand(1, 2, -1, 4) - layer_idx,
+        )
+        for layer_idx in range(num_layers)
+    ]
+
+
+def _assert_kv_equal(kv_tensors, expected):
+    assert len(kv_tensors) == len(expected)
+    for (key, value), (expected_key, expected_value) in zip(kv_tensors, expected):
+        assert torch.equal(key, expected_key)
+        assert torch.equal(value, expected_value)
+
+
+def test_prefix_cache_match():
+    prefix_cache = PrefixCache(max_bytes=1024**2)
+    assert prefix_cache.match([1, 2, 3]) == (0, None)
+
+    prefix_cache.insert([1, 2, 3, 4, 5], _kv_tensors([1, 2, 3, 4, 5]))
+    prefix_cache.insert([1, 2, 3, 7], _kv_tensors([1, 2, 3, 7]))  # split the edge
+    prefix_cache.insert([1, 2], _kv_tensors([1, 2]))  # split the edge again
+    assert len(prefix_cache) == 6
+
+    for token_ids, expected_length in [
+        ([1, 2, 3, 4, 5, 6], 5),
+        ([1, 2, 3, 7, 8], 4),
+        ([1, 2, 3, 4, 9], 4),  # partial match of an edge
+        ([1, 2, 8], 2),
+        ([1], 1),
+        ([2, 1], 0),
+    ]:
+        length, kv_tensors = prefix_cache.match(token_ids)
+        assert length == expected_length
+        if expected_length > 0:
+            _assert_kv_equal(kv_tensors, _kv_tensors(token_ids[:expected_length]))
+
+
+def test_prefix_cache_lru_eviction():
+    nbytes = sum(
+        key.nbytes + value.nbytes for key, value in _kv_tensors([1, 2, 3, 4])
+    )
+    prefix_cache = PrefixCache(max_bytes=2 * nbytes)
+    prefix_cache.insert([1, 2, 3, 4], _kv_tensors([1, 2, 3, 4]))
+    prefix_cache.insert([5, 6, 7, 8], _kv_tensors([5, 6, 7, 8]))
+    assert prefix_cache.nbytes == 2 * nbytes
+    prefix_cache.match([1, 2, 3, 4])  # [1, 2, 3, 4] is now more recent than [5, 6, 7, 8]
+    prefix_cache.insert([9, 10, 11, 12], _kv_tensors([9, 10, 11, 12]))
+    assert prefix_cache.nbytes == 2 * nbytes
+    assert prefix_cache.match([1, 2, 3, 4])[0] == 4
+    assert prefix_cache.match([5, 6, 7, 8])[0] == 0
+    assert prefix_cache.match([9, 10, 11, 12])[0] == 4
+
+
+def test_prefix_cache_generate(tiny_llama):
+    prefix = torch.randint(3, 128, (20,)).tolist()
+    prompts = [prefix + torch.randint(3, 128, (n,)).tolist() for n in [5, 1, 8]]
+
+    def _generate(prompt_ids, past_key_values=None):
+        input_ids = torch.tensor([prompt_ids])
+        return tiny_llama.generate(
+            input_ids=input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            max_new_tokens=10,
+            do_sample=False,
+            pad_token_id=0,
+            past_key_values=past_key_values,
+            return_dict_in_generate=True,
+        )
+
+    prefix_cache = PrefixCache(max_bytes=1024**2)
+    for prompt_ids in prompts:
+        expected = _generate(prompt_ids).sequences
+        num_cached_tokens, kv_tensors = prefix_cache.match(prompt_ids[:-1])
+        outputs = _generate(
+            prompt_ids, build_kv_cache(kv_tensors) if num_cached_tokens else None
+        )
+        assert torch.equal(outputs.sequences, expected)
+        prefix_cache.insert(prompt_ids, get_kv_cache_tensors(outputs.past_key_values))
+    assert prefix_cache.match(prompts[-1])[0] == len(prompts[-1])
@@ -6,179 +6,436 @@
 
 from unittest.mock import Mock, patch
 
+import numpy as np
 import pytest
-from spiritlm.model.spiritlm_model import Spiritlm
+import torch
+from spiritlm.model.spiritlm_model import (
+    ContentType,
+    GenerationInput,
+    OutputModality,
+    SpeechChunk,
+    Spiritlm,
+    TextDelta,
+)
 from spiritlm.model.utils import (
-    does_end_with_speech_token,
-    does_start_with_speech_token,
-    find_prompt_last_speech_start_position,
+    ForbiddenTokensLogitsProcessor,
+    RestrictedLMHead,
+    get_forbidden_tokens,
+)
+from spiritlm.speech_tokenizer.spiritlm_tokenizer import (
+    tokens_to_units,
+    units_to_string,
+    units_to_tokens,
+)
+from spiritlm.speech_tokenizer.units import Units
+from transformers import (
+    LlamaConfig,
+    LlamaForCausalLM,
+    LlamaTokenizer,
+    NoBadWordsLogitsProcessor,
 )
 
 
-@pytest.mark.parametrize(
-    "content,expected",
-    [
-        (
-            "abc[Speech][St1][Pi234][Hu123][Hu45][Text]hello world[",
-            [("abc", "t"), ("[St1][Pi234][Hu123][Hu45]", "s"), ("hello world[", "t")],
-        ),
-        (
-            "[St1][Pi234][Hu123][Hu45]",
-            [("[St1][Pi234][Hu123][Hu45]", "s")],
-        ),
-        (
-            "abc",
-            [("abc", "t")],
-        ),
-        (
-            "abc[]",
-            [("abc[]", "t")],
-        ),
-        (
-            "[St1][Pi234][Hu123][Hu45][Text][abc",
-            [("[St1][Pi234][Hu123][Hu45]", "s"), ("[abc", "t")],
-        ),
-        (
-            "abc[Text]def",
-            [("abcdef", "t")],
-        ),
-    ],
-)
-def test_parse_speech_and_text(content, expected):
-    with patch(
-        "spiritlm.model.spiritlm_model.Spiritlm.__init__", Mock(return_value=None)
-    ):
-        mock_spiritlm_model = Spiritlm("spirit-lm-base-7b")
-        mock_spiritlm_model.speech_prompt_prefix = "[Speech]"
-        assert mock_spiritlm_model._parse_speech_and_text(content) == expected
+def _tiny_llama_tokenizer(legacy=False):
+    # a real LLaMA tokenizer with the SPIRIT-LM added tokens, with 32000 text tokens
+    # (the letters, a few merges and fillers) so that the added token ids are the ones of SPIRIT-LM
+    vocab = {"<unk>": 0, "<s>": 1, "</s>": 2, "▁": 3}
+    for char in "abcdefghijklmnopqrstuvwxyz,.!?'":
+        vocab[char] = len(vocab)
+        vocab["▁" + char] = len(vocab)
+    for token in ["he", "▁he", "hel", "▁hel"]:
+        vocab[token] = len(vocab)
+    for i in range(32000 - len(vocab)):
+        vocab[f"▁w{i}" if i % 2 else f"w{i}"] = len(vocab)
+    tokenizer = LlamaTokenizer(
+        vocab=vocab,
+        merges=[("h", "e"), ("▁h", "e"), ("he", "l"), ("▁he", "l")],
+        legacy=legacy,
+        add_bos_token=True,
+        add_eos_token=False,
+    )
+    tokenizer.add_tokens(
+        ["[Text]", "[Speech]"]
+        + [f"[Hu{unit}]" for unit in range(501)]
+        + [f"[Pi{unit}]" for unit in range(64)]
+        + [f"[St{unit}]" for unit in range(100)]
+    )
+    assert tokenizer.convert_tokens_to_ids(["[Text]", "[Hu0]", "[St99]"]) == [
+        32000,
+        32002,
+        32666,
+    ]
+    return tokenizer
 
 
+@pytest.mark.parametrize("legacy", [False, True])
 @pytest.mark.parametrize(
-    "content,expected",
+    "inputs,output_modality",
     [
-        (
-            "[Hu338][Text] and they went out together[Speech][Hu431][Pi0][Hu457][Hu79][Pi11][Hu258][Hu85][Hu28][Hu50][Text] and mrs johnson  shoes except in mourning[Speech][Pi59][Hu32][Pi20][Hu453][Pi35][Pi26][Hu166]",
-            [
-                ("[Hu338]", "s"),
-                (" and they went out together", "t"),
-                ("[Hu431][Pi0][Hu457][Hu79][Pi11][Hu258][Hu85][Hu28][Hu50]", "s"),
-                (" and mrs johnson  shoes except in mourning", "t"),
-                ("[Pi59][Hu32][Pi20][Hu453][Pi35][Pi26][Hu166]", "s"),
-            ],
-        )
+        ([("TEXT", "hello"), ("TEXT", " world")], OutputModality.TEXT),
+        ([("TEXT", "hello "), ("SPEECH", None)], OutputModality.TEXT),
+        ([("SPEECH", None), ("TEXT", " hello, world ")], OutputModality.SPEECH),
+        ([("TEXT", "hello"), ("SPEECH", None), ("TEXT", "hi")], OutputModality.ARBITRARY),
+        ([("SPEECH", None)], OutputModality.SPEECH),
     ],
 )
-def test_parse_speech_and_text_with_expressive_tokens(content, expected):
+def test_build_prompt_ids(legacy, inputs, output_modality):
+    units = {
+        "hubert": "78 42 81 159 316 259",
+        "pitch": "13 13 13 13 13 3",
+        "style": "81 81 81 81 81 81",
+    }
+    speech_tokens = units_to_tokens(units, has_pitch=True, has_style=True)
+    speech_string = units_to_string(units, has_pitch=True, has_style=True)
+    assert (
+        "".join(f"[{tok_type}{unit}]" for tok_type, unit in speech_tokens)
+        == speech_string
+    )
+
     with patch(
         "spiritlm.model.spiritlm_model.Spiritlm.__init__", Mock(return_value=None)
     ):
-        mock_spiritlm_model = Spiritlm("spirit-lm-base-7b")
-        mock_spiritlm_model.speech_prompt_prefix = "[Speech]"
-        print(f"content: {content}")
-        print(f"expected: {expected}")
-        assert mock_spiritlm_model._parse_speech_and_text(content) == expected
+        mock_spiritlm_model = Spiritlm("spirit-lm-expressive-7b")
+    mock_spiritlm_model.tokenizer = _tiny_llama_tokenizer(legacy)
+    mock_spiritlm_model.speech_tokenizer = Mock()
+    mock_spiritlm_model.speech_tokenizer.encode_tokens.return_value = speech_tokens
+    generation_inputs = [
+        GenerationInput(
+            content=torch.zeros(1600) if content_type == "SPEECH" else content,
+            content_type=ContentType(content_type),
+        )
+        for content_type, content in inputs
+    ]
+    prompt_ids = mock_spiritlm_model._build_prompt_ids(
+        generation_inputs, output_modality
+    )
+
+    # the tokenization of the joined prompt string
+    prompt, prev_modality = "", None
+    for content_type, content in inputs:
+        if content_type == "SPEECH":
+            prompt += ("" if prev_modality == "s" else "[Speech]") + speech_string
+            prev_modality = "s"
+        else:
+            prompt += ("" if prev_modality == "t" else "[Text]") + content
+            prev_modality = "t"
+    if output_modality == OutputModality.TEXT and prev_modality != "t":
+        prompt += "[Text]"
+    elif output_modality == OutputModality.SPEECH and prev_modality != "s":
+        prompt += "[Speech]"
+    assert prompt_ids == mock_spiritlm_model.tokenizer(prompt).input_ids
 
 
 @pytest.mark.parametrize(
-    "encoded_string,expected",
+    "token_ids,expected",
     [
         (
-            "]]",
-            False,
-        ),
-        (
-            "[]",
-            False,
+            [5, 6, 32001, 32567 + 1, 32503 + 34, 32002 + 123, 32000, 7, 2],
+            [([5, 6], "t"), ([32568, 32537, 32125], "s"), ([7], "t")],
         ),
         (
-            "[Hu100]",
-            True,
+            [32002, 32001, 32003, 2, 32004, 32000, 32000],
+            [([32002, 32003, 32004], "s")],
         ),
-        ("abc[]", False),
         (
-            "[St1][Pi234][Hu123][Hu45][Text][abc]",
-            False,
-        ),
-        (
-            "abc[Text]def",
-            False,
-        ),
-        (
-            "[Pi9]",
-            True,
-        ),
-        (
-            "[St0]",
-            True,
+            [5, 32000, 6, 1],
+            [([5, 6], "t")],
         ),
+        ([], []),
     ],
 )
-def test_does_prompt_end_by_speech(encoded_string, expected):
-    assert does_end_with_speech_token(encoded_string) == expected
+def test_split_speech_and_text_ids(token_ids, expected):
+    vocab = {"[Text]": 32000, "[Speech]": 32001, "[Hu0]": 32002, "[Pi0]": 32503}
+    vocab["[St0]"] = 32567
+    tokenizer = Mock()
+    tokenizer.__len__ = Mock(return_value=32667)
+    tokenizer.all_special_ids = [0, 1, 2]
+    tokenizer.convert_tokens_to_ids.side_effect = lambda toks: (
+        [vocab[tok] for tok in toks] if isinstance(toks, list) else vocab[toks]
+    )
+    with patch(
+        "spiritlm.model.spiritlm_model.Spiritlm.__init__", Mock(return_value=None)
+    ):
+        mock_spiritlm_model = Spiritlm("spirit-lm-expressive-7b")
+        mock_spiritlm_model.tokenizer = tokenizer
+        splits = mock_spiritlm_model._split_speech_and_text_ids(
+            np.array(token_ids, dtype=np.int64)
+        )
+    assert [(span.tolist(), modality) for span, modality in splits] == expected
 
 
 @pytest.mark.parametrize(
-    "encoded_string,expected",
+    "forbidden_tokens_kwargs",
     [
-        (
-            "abc[Hu123][Hu456][Pi23][St2]",
-            3,
-        ),
-        (
-            "[Hu123]abc[Hu123][Hu456][Pi23][St2]",
-            10,
-        ),
-        (
-            "[Hu123][Hu456][Pi23][St2]",
-            0,
-        ),
-        (
-            "abc",
-            None,
-        ),
-        (
-            "[Speech][St71][Pi39][Hu99][Hu49][Pi57][Hu38][Hu149][Pi48][Hu71][Hu423][Hu427][Pi56][Hu492][Hu288][Pi44][Hu315][Hu153][Pi42][Hu389][Pi59][Hu497][Hu412][Pi51][Hu247][Hu354][Pi44][Hu7][Hu96][Pi43][Hu452][Pi0][Hu176][Hu266][Pi54][St71][Hu77][Pi13][Hu248][Hu336][Pi39][Hu211][Pi25][Hu166][Hu65][Pi58][Hu94][Hu224][Pi26][Hu148][Pi44][Hu492][Hu191][Pi26][Hu440][Pi13][Hu41][Pi20][Hu457][Hu79][Pi46][Hu382][Hu451][Pi26][Hu332][Hu216][Hu114][Hu340][St71][Pi40][Hu478][Hu74][Pi26][Hu79][Hu370][Pi56][Hu272][Hu370][Pi51][Hu53][Pi14][Hu477][Hu65][Pi46][Hu171][Hu60][Pi41][Hu258][Hu111][Pi40][Hu338][Hu23][Pi39][Hu338][Hu23][Hu338][St71][Pi57][Hu7][Hu338][Hu149][Pi59][Hu406][Hu7][Hu361][Hu99][Pi20][Hu209][Hu479][Pi35][Hu50][St71][Hu7][Hu149][Pi55][Hu35][Pi13][Hu130][Pi3][Hu169][Pi52][Hu72][Pi9][Hu434][Hu119][Hu272][Hu4][Pi20][Hu249][Hu245][Pi57][Hu433][Pi56][Hu159][Hu294][Hu139][Hu359][Hu343][Hu269][Hu302][St71][Hu226][Pi32][Hu370][Hu216][Pi39][Hu459][Hu424][Pi57][Hu226][Pi46][Hu382][Hu7][Pi27][Hu58][Hu138][Pi20][Hu428][Hu397][Pi44][Hu350][Pi32][Hu306][Pi59][Hu84][Hu11][Hu171][Pi42][Hu60][Pi48][Hu314][Hu227][St71][Hu355][Pi56][Hu9][Hu58][Pi44][Hu138][Hu226][Pi25][Hu370][Hu272][Pi56][Hu382][Hu334][Pi26][Hu330][Hu176][Pi56][Hu307][Pi46][Hu145][Hu248][Pi56][Hu493][Hu64][Pi40][Hu44][Hu388][Pi39][Hu7][Hu111][Pi59][St71][Hu23][Hu481][Pi13][Hu149][Pi15][Hu80][Hu70][Pi47][Hu431][Hu457][Pi13][Hu79][Pi27][Hu249][Pi55][Hu245][Pi54][Hu433][Pi36][Hu316][Pi53][Hu180][Pi3][Hu458][Pi26][Hu86][St71][Pi43][Hu225][Pi49][Hu103][Hu60][Pi3][Hu96][Hu119][Pi39][Hu129][Pi41][Hu356][Hu218][Pi14][Hu4][Hu259][Pi56][Hu392][Pi46][Hu490][Hu75][Pi14][Hu488][Hu166][Pi46][Hu65][Hu171][Pi40][Hu60][Hu7][Hu54][Pi39][Hu85][St83][Pi40][Hu361]",
-            8,
-        ),
+        {"generate_only_speech": True},
+        {"generate_only_text": True, "ban_expressivity_tokens": False},
+        {"generate_only_text": True, "ban_expressivity_tokens": True},
     ],
 )
-def test_find_prompt_last_speech_start_position(encoded_string, expected):
-    assert find_prompt_last_speech_start_position(encoded_string) == expected
-
+def test_forbidden_tokens_logits_processor(forbidden_tokens_kwargs):
+    vocab_size = 32768
+    forbidden_tokens = get_forbidden_tokens(**forbidden_tokens_kwargs)
+    mask = torch.zeros(vocab_size, dtype=torch.bool)
+    mask[forbidden_tokens] = True
 
-@pytest.mark.parametrize(
-    "encoded_string,expected",
-    [
-        (
-            "[[",
-            False,
-        ),
-        (
-            "[]",
-            False,
-        ),
-        (
-            "[Hu100]",
-            True,
-        ),
-        ("abc[]", False),
-        (
-            "[St1][Pi234][Hu123][Hu45][Text][abc]",
-            True,
-        ),
-        (
-            "abc[Text]def",
-            False,
-        ),
-        (
-            "[Pi9]",
-            True,
+    input_ids = torch.randint(0, vocab_size, (2, 5))
+    scores = torch.randn(2, vocab_size)
+    expected = NoBadWordsLogitsProcessor(
+        bad_words_ids=[[tok_id] for tok_id in forbidden_tokens]
+    )(input_ids, scores.clone())
+    assert torch.equal(
+        ForbiddenTokensLogitsProcessor(mask)(input_ids, scores.clone()), expected
+    )
+    # one mask per sequence
+    assert torch.equal(
+        ForbiddenTokensLogitsProcessor(torch.stack([mask, mask]))(
+            input_ids, scores.clone()
         ),
-        (
-            "[St0]",
-            True,
-        ),
-    ],
-)
-def test_does_start_with_speech_token(encoded_string, expected):
-    assert does_start_with_speech_token(encoded_string) == expected
+        expected,
+    )
+
+
+def test_restricted_lm_head():
+    vocab_size = 32768
+    lm_head = torch.nn.Linear(16, vocab_size, bias=False)
+    mask = torch.zeros(vocab_size, dtype=torch.bool)
+    mask[get_forbidden_tokens(generate_only_speech=True)] = True
+    allowed_token_ids = (~mask).nonzero().view(-1)
+
+    restricted_lm_head = RestrictedLMHead(
+        lm_head, allowed_token_ids[0].item(), allowed_token_ids[-1].item() + 1
+    )
+    # the weights of the speech tokens are a view of the LM head weights
+    assert restricted_lm_head.weight._base is lm_head.weight
+    for _ in range(2):  # the logits buffer is reused
+        hidden_states = torch.randn(2, 3, 16)
+        expected = lm_head(hidden_states).masked_fill(mask, -float("inf"))
+        assert torch.allclose(restricted_lm_head(hidden_states), expected)
+
+
+@pytest.fixture
+def tiny_spiritlm():
+    torch.manual_seed(0)
+    tokenizer = _tiny_llama_tokenizer()
+    config = LlamaConfig(
+        vocab_size=len(tokenizer),
+        hidden_size=16,
+        intermediate_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        num_key_value_heads=1,
+        max_position_embeddings=256,
+        eos_token_id=None,
+    )
+    # the speech tokenizer "vocodes" the hubert units as the waveform samples
+    speech_tokenizer = Mock()
+    speech_tokenizer.hubert_key = "hubert"
+    speech_tokenizer.tokens2units.side_effect = lambda tok_types, tok_units: Units(
+        tokens_to_units(tok_types, tok_units)
+    )
+    speech_tokenizer.decode_batch.side_effect = lambda units_batch, speaker_id: [
+        units.arrays["hubert"].astype(np.float32) for units in units_batch
+    ]
+    speech_tokenizer.decode_stream.side_effect = lambda speaker_id: Mock(
+        push=lambda units: units.arrays["hubert"].astype(np.float32),
+        flush=lambda: np.zeros(0, dtype=np.float32),
+    )
+    with patch(
+        "spiritlm.model.spiritlm_model.Spiritlm.__init__", Mock(return_value=None)
+    ):
+        spiritlm_model = Spiritlm("spirit-lm-expressive-7b")
+    spiritlm_model.model = LlamaForCausalLM(config).eval()
+    spiritlm_model.tokenizer = tokenizer
+    spiritlm_model.speech_tokenizer = speech_tokenizer
+    spiritlm_model.device = "cpu"
+    spiritlm_model.is_expressive_model = True
+    spiritlm_model._engine = None
+    spiritlm_model._engine_requests = {}
+    spiritlm_model._prefix_cache = None
+    return spiritlm_model
+
+
+def _spans_as_lists(spans_batch, speaker_id):
+    # the generated spans instead of their decoded content
+    return [
+        [(span_ids.tolist(), span_modality) for span_ids, span_modality, _ in spans]
+        for spans in spans_batch
+    ]
+
+
+
+def test_decode_from_generated_ids_strip(tiny_spiritlm):
+    tokenizer = tiny_spiritlm.tokenizer
+    hubert_ids = tokenizer.convert_tokens_to_ids([f"[Hu{i}]" for i in range(30)])
+    generated_ids = (
+        tokenizer(" hello there ", add_special_tokens=False).input_ids
+        + hubert_ids
+        + tokenizer(" my friend ", add_special_tokens=False).input_ids
+    )
+    outputs = tiny_spiritlm._decode_from_generated_ids(
+        OutputModality.ARBITRARY, generated_ids, prompt_ids=[1]
+    )
+    assert [output.content_type for output in outputs] == [
+        ContentType.TEXT,
+        ContentType.SPEECH,
+        ContentType.TEXT,
+    ]
+    # only the whole generation is stripped, the spaces between the spans are kept
+    assert outputs[0].content == "hello there "
+    assert outputs[2].content == "my friend"
+
+
+@pytest.mark.parametrize("num_return_sequences", [1, 2])
+def test_generate_batch_matches_generate(tiny_spiritlm, num_return_sequences):
+    prompts = ["hello", "a longer prompt", "hi"]
+    output_modalities = ["TEXT", "SPEECH", "SPEECH"]
+    with patch.object(Spiritlm, "_decode_output_spans", side_effect=_spans_as_lists):
+        outputs = tiny_spiritlm.generate_batch(
+            prompts=prompts,
+            output_modality=output_modalities,
+            max_new_tokens=8,
+            do_sample=False,
+            num_beams=num_return_sequences,
+            num_return_sequences=num_return_sequences,
+        )
+        assert len(outputs) == len(prompts) * num_return_sequences
+        for i, (prompt, modality) in enumerate(zip(prompts, output_modalities)):
+            expected = tiny_spiritlm.generate(
+                prompt=prompt,
+                output_modality=modality,
+                max_new_tokens=8,
+                do_sample=False,
+                num_beams=num_return_sequences,
+            )
+            assert outputs[i * num_return_sequences] == expected
+            sample_outputs = outputs[
+                i * num_return_sequences : (i + 1) * num_return_sequences
+            ]
+            _, expected_modality = expected[0]
+            for output in sample_outputs:
+                assert all(modality == expected_modality for _, modality in output)
+
+
+def test_submit_poll_matches_generate(tiny_spiritlm):
+    prompts = ["hello", "a longer prompt", "hi"]
+    output_modalities = ["TEXT", "SPEECH", "ARBITRARY"]
+    max_new_tokens = [8, 12, 5]
+    with patch.object(Spiritlm, "_decode_output_spans", side_effect=_spans_as_lists):
+        request_ids = [
+            tiny_spiritlm.submit(
+                prompt=prompt,
+                output_modality=modality,
+                max_new_tokens=n,
+                do_sample=False,
+            )
+            for prompt, modality, n in zip(prompts, output_modalities, max_new_tokens)
+        ]
+        # poll the requests in turn, each poll runs one engine step for all of them
+        outputs = {}
+        while len(outputs) < len(request_ids):
+            for request_id in request_ids:
+                if request_id not in outputs:
+                    output = tiny_spiritlm.poll(request_id)
+                    if output is not None:
+                        outputs[request_id] = output
+
+        for request_id, prompt, modality, n in zip(
+            request_ids, prompts, output_modalities, max_new_tokens
+        ):
+            assert outputs[request_id] == tiny_spiritlm.generate(
+                prompt=prompt,
+                output_modality=modality,
+                max_new_tokens=n,
+                do_sample=False,
+            )
+
+
+def test_generate_restrict_lm_head(tiny_spiritlm):
+    lm_head = tiny_spiritlm.model.lm_head
+    with patch.object(Spiritlm, "_decode_output_spans", side_effect=_spans_as_lists):
+        for output_modality in ["SPEECH", "TEXT"]:
+            expected = tiny_spiritlm.generate(
+                prompt="hello",
+                output_modality=output_modality,
+                max_new_tokens=8,
+                do_sample=False,
+            )
+            assert expected == tiny_spiritlm.generate(
+                prompt="hello",
+                output_modality=output_modality,
+                max_new_tokens=8,
+                do_sample=False,
+                restrict_lm_head=True,
+            )
+    # the restricted LM head is only set on a per-call copy of the model
+    assert tiny_spiritlm.model.lm_head is lm_head
+
+
+@pytest.mark.parametrize("output_modality", ["TEXT", "SPEECH"])
+def test_generate_stream_matches_generate(tiny_spiritlm, output_modality):
+    expected = tiny_spiritlm.generate(
+        prompt="hello", output_modality=output_modality, max_new_tokens=40
+    )
+    events = list(
+        tiny_spiritlm.generate_stream(
+            prompt="hello",
+            output_modality=output_modality,
+            max_new_tokens=40,
+            speech_chunk_size=7,
+        )
+    )
+    assert len(events) > 1 and len(expected) == 1
+    if output_modality == "TEXT":
+        assert all(isinstance(event, TextDelta) for event in events)
+        assert "".join(event.content for event in events) == expected[0].content
+    else:
+        assert all(isinstance(event, SpeechChunk) for event in events)
+        assert events[-1].is_last
+        assert np.array_equal(
+            np.concatenate([event.content for event in events]), expected[0].content
+        )
+
+
+def test_generate_stream_early_stop(tiny_spiritlm):
+    generated_lengths = []
+    generate = tiny_spiritlm.model.generate
+
+    def _generate(**kwargs):
+        outputs = generate(**kwargs)
+        generated_lengths.append(
+            outputs.sequences.size(1) - kwargs["input_ids"].size(1)
+        )
+        return outputs
+
+    tiny_spiritlm.model.generate = _generate
+    stream = tiny_spiritlm.generate_stream(
+        prompt="hello", output_modality="TEXT", max_new_tokens=200
+    )
+    next(stream)
+    stream.close()
+    # the generation thread is stopped and joined when the consumer stops
+    assert len(generated_lengths) == 1
+    assert generated_lengths[0] < 200
+
+
+def test_generate_prefix_cache_beam_search(tiny_spiritlm):
+    kwargs = dict(
+        prompt="[Text]hello there friend",
+        output_modality="TEXT",
+        max_new_tokens=6,
+        do_sample=False,
+    )
+    configs = [
+        {"num_beams": 1},
+        {"num_beams": 2},
+        {"num_beams": 2, "num_return_sequences": 2},
+    ]
+    expected = [tiny_spiritlm.generate(**kwargs, **config) for config in configs]
+    tiny_spiritlm.enable_prefix_cache()
+    try:
+        # the cached prompt KV tensors are reused across the numbers of beams
+        for i in [1, 0, 2, 1, 0]:
+            assert tiny_spiritlm.generate(**kwargs, **configs[i]) == expected[i]
+        assert len(tiny_spiritlm._prefix_cache) > 0
+    finally:
+        tiny_spiritlm.disable_prefix_cache()
@@ -0,0 +1,58 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the FAIR Noncommercial Research License
+# found in the LICENSE file in the root directory of this source tree.
+
+import pytest
+from spiritlm.model.streaming import IncrementalSpeechTextParser
+
+# text tokens are letters (ids 3 to 28), speech tokens are >= 100 and hubert tokens are >= 200
+TEXT_PREFIX, SPEECH_PREFIX = 1, 2
+
+
+def _parser(speech_chunk_size):
+    return IncrementalSpeechTextParser(
+        decode_text=lambda token_ids: "".join(
+            " " if token_id == 3 else chr(ord("a") + token_id - 4)
+            for token_id in token_ids
+        ),
+        is_speech_token=lambda token_ids: token_ids >= 100,
+        is_hubert_token=lambda token_ids: token_ids >= 200,
+        dropped_token_ids=[0, TEXT_PREFIX, SPEECH_PREFIX],
+        speech_chunk_size=speech_chunk_size,
+    )
+
+
+@pytest.mark.parametrize("feed_size", [1, 3, 100])
+def test_incremental_speech_text_parser(feed_size):
+    token_ids = (
+        [3, 4, 5, 3, 6]  # " ab c"
+        + [SPEECH_PREFIX, 100, 200, 201, 101, 202, 203, 204]
+        + [TEXT_PREFIX, 3, 7, 3]  # " d "
+        + [200, 0, 201]
+    )
+    parser = _parser(speech_chunk_size=2)
+    events = []
+    for start in range(0, len(token_ids), feed_size):
+        events += parser.feed(token_ids[start : start + feed_size])
+    events += parser.flush()
+
+    # merge the consecutive text deltas
+    merged_events = []
+    for event in events:
+        if event[0] == "t" and merged_events and merged_events[-1][0] == "t":
+            merged_events[-1] = ("t", merged_events[-1][1] + event[1])
+        elif event[0] == "t":
+            merged_events.append(event)
+        else:
+            merged_events.append(("s", event[1].tolist(), event[2]))
+    # the text spans are stripped
+    assert merged_events == [
+        ("t", "ab c"),
+        ("s", [100, 200, 201, 101], False),
+        ("s", [202, 203], False),
+        ("s", [204], True),
+        ("t", "d"),
+        ("s", [200, 201], True),
+    ]
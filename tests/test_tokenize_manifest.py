@@ -0,0 +1,152 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the FAIR Noncommercial Research License
+# found in the LICENSE file in the root directory of this source tree.
+
+import argparse
+import json
+
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+import pytest
+import torch
+from spiritlm.speech_tokenizer.spiritlm_tokenizer import SpiritLMTokenizer
+from spiritlm.tokenize_manifest import (
+    failed_path,
+    read_manifest,
+    run,
+    shard_path,
+    tokenize_shard,
+    units_table_rates,
+)
+
+
+class _FakeHubert:
+    # fake hubert units at 25hz
+    def __call__(self, wav):
+        return (wav[::640] * 1000).long().abs() % 501
+
+    def forward_batch(self, wavs):
+        return [self(wav) for wav in wavs]
+
+
+def test_read_manifest(tmp_path):
+    jsonl_manifest = tmp_path / "manifest.jsonl"
+    with open(jsonl_manifest, "w") as f:
+        f.write(json.dumps({"id": 1, "wav_path": "a.wav"}) + "\n")
+        f.write(json.dumps({"id": "b", "wav_path": "b.wav", "channel": 0}) + "\n")
+    assert read_manifest(jsonl_manifest, root_dir="/data") == [
+        {"id": "1", "audio": "/data/a.wav", "channel": None},
+        {"id": "b", "audio": "/data/b.wav", "channel": 0},
+    ]
+
+    tsv_manifest = tmp_path / "manifest.tsv"
+    with open(tsv_manifest, "w") as f:
+        f.write("/data\nspk1/a.flac\t16000\nspk2/b.flac\t32000\n")
+    assert [record["audio"] for record in read_manifest(tsv_manifest)] == [
+        "/data/spk1/a.flac",
+        "/data/spk2/b.flac",
+    ]
+
+    with open(jsonl_manifest, "a") as f:
+        f.write(json.dumps({"id": "b", "wav_path": "c.wav"}) + "\n")
+    with pytest.raises(ValueError):
+        read_manifest(jsonl_manifest)
+
+
+@pytest.mark.parametrize("format", ["parquet", "arrow"])
+def test_tokenize_shard(tmp_path, format):
+    torch.manual_seed(0)
+    wavs = {f"{i}.wav": torch.rand(1, 8_000 * (i + 1)) for i in range(5)}
+    tokenizer = SpiritLMTokenizer(hubert_model=_FakeHubert())
+    tokenizer.load_audio = lambda path: wavs[path]
+    records = [
+        {"id": f"utt{i}", "audio": audio, "channel": None}
+        for i, audio in enumerate(list(wavs) + ["missing.wav"])
+    ]
+
+    output_path = shard_path(tmp_path, 3, format)
+    stats = tokenize_shard(tokenizer, records, output_path, batch_size=2)
+    assert stats == {"num_audios": 5, "duration": 7.5, "num_failed": 1}
+    assert sorted(path.name for path in tmp_path.iterdir()) == sorted(
+        [output_path.name, "shard-00003.failed.jsonl"]
+    )
+    with open(failed_path(output_path)) as f:
+        failed = [json.loads(line) for line in f]
+    assert [(record["id"], record["audio"]) for record in failed] == [
+        ("utt5", "missing.wav")
+    ]
+
+    if format == "arrow":
+        table = feather.read_table(output_path)
+    else:
+        table = pq.read_table(output_path)
+    assert table.column_names == ["id", "audio", "duration", "hubert"]
+    assert table["id"].to_pylist() == [f"utt{i}" for i in range(5)]
+    assert table["duration"].to_pylist() == [0.5, 1.0, 1.5, 2.0, 2.5]
+    assert units_table_rates(table) == {"hubert": 24.99}
+    for wav, hubert in zip(wavs.values(), table["hubert"].to_pylist()):
+        assert hubert == tokenizer.encode_units(wav).arrays["hubert"].tolist()
+
+
+def test_tokenize_shard_encode_errors(tmp_path):
+    torch.manual_seed(0)
+    wavs = {f"{i}.wav": torch.rand(1, 8_000 * (i + 1)) for i in range(5)}
+    tokenizer = SpiritLMTokenizer(hubert_model=_FakeHubert())
+    tokenizer.load_audio = lambda path: wavs[path]
+    encode_units_batch = tokenizer.encode_units_batch
+
+    def _encode_units_batch(audios, **kwargs):
+        # the audio of 1.5s fails to be tokenized
+        if any(audio.size(-1) == 24_000 for audio in audios):
+            raise RuntimeError("corrupted audio")
+        return encode_units_batch(audios, **kwargs)
+
+    tokenizer.encode_units_batch = _encode_units_batch
+    records = [
+        {"id": f"utt{i}", "audio": audio, "channel": None}
+        for i, audio in enumerate(wavs)
+    ]
+    output_path = shard_path(tmp_path, 0)
+    stats = tokenize_shard(tokenizer, records, output_path, batch_size=2)
+    # only the failing audio of the batch is dropped
+    assert stats == {"num_audios": 4, "duration": 6.0, "num_failed": 1}
+    table = pq.read_table(output_path)
+    assert table["id"].to_pylist() == ["utt0", "utt1", "utt3", "utt4"]
+    assert table["duration"].to_pylist() == [0.5, 1.0, 2.0, 2.5]
+    with open(failed_path(output_path)) as f:
+        failed = [json.loads(line) for line in f]
+    assert [record["id"] for record in failed] == ["utt2"]
+    assert "corrupted audio" in failed[0]["error"]
+
+
+def test_run_skips_done_shards(tmp_path):
+    manifest = tmp_path / "manifest.jsonl"
+    with open(manifest, "w") as f:
+        for i in range(5):
+            f.write(json.dumps({"id": i, "wav_path": f"{i}.wav"}) + "\n")
+    output_dir = tmp_path / "units"
+    args = argparse.Namespace(
+        manifest=str(manifest),
+        output_dir=str(output_dir),
+        root_dir=None,
+        id_field="id",
+        audio_field="wav_path",
+        tokenizer="base",
+        f0_backbone="fcpe",
+        shard_size=2,
+        batch_size=16,
+        num_workers=1,
+        format="parquet",
+    )
+    output_dir.mkdir()
+    for shard_index in range(3):
+        shard_path(output_dir, shard_index).touch()
+    # all the shards are done, no worker (nor tokenizer) is started
+    run(args)
+
+    # the sharding cannot change when resuming
+    args.shard_size = 3
+    with pytest.raises(ValueError):
+        run(args)
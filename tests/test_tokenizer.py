@@ -4,9 +4,26 @@
 # This source code is licensed under the FAIR Noncommercial Research License
 # found in the LICENSE file in the root directory of this source tree.
 
+from unittest.mock import patch
+
+import numpy as np
 import pytest
+import torch
 import torchaudio
 from spiritlm.speech_tokenizer import spiritlm_base, spiritlm_expressive
+from spiritlm.speech_tokenizer.spiritlm_tokenizer import (
+    SpiritLMTokenizer,
+    string_to_units,
+    tokens_to_units,
+    units_to_string,
+    units_to_tokens,
+)
+from spiritlm.speech_tokenizer.units import Units
+from spiritlm.speech_tokenizer.wav_chunks import (
+    num_frames,
+    overlapping_chunks,
+    stitch_chunks,
+)
 
 
 @pytest.fixture
@@ -68,3 +85,394 @@ def test_base_tokenizer_encode_string(spiritlm_base_tokenizer):
     encoded_string = spiritlm_base_tokenizer.encode_string(audio)
     expected = "[Hu99][Hu49][Hu38][Hu149][Hu71][Hu423][Hu427][Hu492][Hu288][Hu315][Hu153][Hu389][Hu497][Hu412][Hu247][Hu354][Hu7][Hu96][Hu452][Hu176][Hu266][Hu77][Hu248][Hu336][Hu211][Hu166][Hu65][Hu94][Hu224][Hu148][Hu492][Hu191][Hu440][Hu41][Hu457][Hu79][Hu382][Hu451][Hu332][Hu216][Hu114][Hu340][Hu478][Hu74][Hu79][Hu370][Hu272][Hu370][Hu53][Hu477][Hu65][Hu171][Hu60][Hu258][Hu111][Hu338][Hu23][Hu338][Hu23][Hu338][Hu7][Hu338][Hu149][Hu406][Hu7][Hu361][Hu99][Hu209][Hu479][Hu50][Hu7][Hu149][Hu35][Hu130][Hu169][Hu72][Hu434][Hu119][Hu272][Hu4][Hu249][Hu245][Hu433][Hu159][Hu294][Hu139][Hu359][Hu343][Hu269][Hu302][Hu226][Hu370][Hu216][Hu459][Hu424][Hu226][Hu382][Hu7][Hu58][Hu138][Hu428][Hu397][Hu350][Hu306][Hu84][Hu11][Hu171][Hu60][Hu314][Hu227][Hu355][Hu9][Hu58][Hu138][Hu226][Hu370][Hu272][Hu382][Hu334][Hu330][Hu176][Hu307][Hu145][Hu248][Hu493][Hu64][Hu44][Hu388][Hu7][Hu111][Hu23][Hu481][Hu149][Hu80][Hu70][Hu431][Hu457][Hu79][Hu249][Hu245][Hu433][Hu316][Hu180][Hu458][Hu86][Hu225][Hu103][Hu60][Hu96][Hu119][Hu129][Hu356][Hu218][Hu4][Hu259][Hu392][Hu490][Hu75][Hu488][Hu166][Hu65][Hu171][Hu60][Hu7][Hu54][Hu85][Hu361]"
     assert encoded_string == expected
+
+
+@pytest.mark.parametrize(
+    "encoded_string",
+    [
+        "[St81][Hu78][Pi13][Hu42][Hu81][Hu159][Hu316][Pi3][Hu259]",
+        "[Hu78][Pi13][Hu42][St81][Hu81][Pi3][Pi5][Hu259][St2][Pi7][Pi9]",
+        "[Pi13][Hu78][Hu42]",
+        "[Hu78][Hu42][Hu42]",
+        "",
+    ],
+)
+@pytest.mark.parametrize("duplicate_hubert_for_multiple_pitch", [False, True])
+def test_tokens_to_units(encoded_string, duplicate_hubert_for_multiple_pitch):
+    tokens = [item[:-1] for item in encoded_string.split("[") if item]
+    tok_types = np.array([token[:2] for token in tokens], dtype="<U2")
+    tok_units = np.array([int(token[2:]) for token in tokens], dtype=np.int64)
+    expected = string_to_units(
+        encoded_string,
+        duplicate_hubert_for_multiple_pitch=duplicate_hubert_for_multiple_pitch,
+    )
+    units = tokens_to_units(
+        tok_types,
+        tok_units,
+        duplicate_hubert_for_multiple_pitch=duplicate_hubert_for_multiple_pitch,
+    )
+    assert expected.keys() == units.keys()
+    for token_key in expected:
+        if token_key == "style" and "[St" not in encoded_string:
+            # the missing style is a random common style
+            assert len(set(units[token_key])) <= 1
+            continue
+        assert expected[token_key] == " ".join(map(str, units[token_key]))
+
+
+def _fake_extractor(hop_size, num_units):
+    return lambda wav: (wav[::hop_size] * 1000).long().abs() % num_units
+
+
+def _fake_expressive_tokenizer(**kwargs):
+    # fake unit extractors at 25hz (hubert), 12.5hz (pitch) and 1hz (style)
+    return SpiritLMTokenizer(
+        hubert_model=_fake_extractor(640, 501),
+        pitch_model=_fake_extractor(1280, 64),
+        style_model=_fake_extractor(16_000, 100),
+        **kwargs,
+    )
+
+
+def test_concurrent_extraction():
+    tokenizer = _fake_expressive_tokenizer(max_wav_chunk=40_000)
+    wav = torch.rand(100_000)
+    expected = tokenizer.encode_units(wav)
+
+    tokenizer.enable_concurrent_extraction(num_threads=4)
+    assert tokenizer._component_num_threads == {"hubert": 2, "pitch": 1, "style": 1}
+    submit = tokenizer._executor.submit
+    with patch.object(tokenizer._executor, "submit", side_effect=submit) as mock_submit:
+        assert tokenizer.encode_units(wav) == expected
+    # a single job per component, running its 3 chunks in order
+    assert mock_submit.call_count == 3
+    tokenizer.disable_concurrent_extraction()
+    assert tokenizer.encode_units(wav) == expected
+
+
+def test_encode_units_arrays():
+    tokenizer = _fake_expressive_tokenizer(max_wav_chunk=40_000)
+    wav = torch.rand(100_000)
+    units = tokenizer.encode_units(wav)
+
+    assert isinstance(units, Units)
+    assert units.arrays["hubert"].dtype == np.int32
+    assert len(units.arrays["hubert"]) == 158 and len(units.arrays["style"]) == 8
+    # the string view matches the former dictionary of units strings
+    expected = {
+        key: " ".join(
+            str(i.item())
+            for start in range(0, len(wav), 40_000)
+            for i in model(wav[start : start + 40_000])
+        )
+        for key, model in tokenizer._get_components().items()
+    }
+    assert units.to_dict() == expected and units == expected
+    assert units_to_string(units, has_pitch=True, has_style=True) == units_to_string(
+        expected, has_pitch=True, has_style=True
+    )
+    assert units.timestamps("pitch")[:3].tolist() == [0.0, 0.08, 0.16]
+    assert units.duration("hubert") == pytest.approx(158 / 24.99)
+
+    assert Units(expected).arrays.keys() == units.arrays.keys()
+    assert all(
+        np.array_equal(Units(expected).arrays[key], units.arrays[key]) for key in units
+    )
+    string_units = tokenizer.string2units(tokenizer.encode_string(wav))
+    assert isinstance(string_units, Units)
+    assert string_units.arrays["hubert"].dtype == np.int32
+
+    # the units can be modified as the dictionary of units strings
+    edited_units = units.copy()
+    edited_units["style"] = "81 81"
+    edited_units.update(pitch=np.array([1, 2]))
+    del edited_units["hubert"]
+    assert edited_units.to_dict() == {"style": "81 81", "pitch": "1 2"}
+    assert edited_units.arrays["style"].dtype == np.int32
+    assert units == expected  # the copied units are unchanged
+
+
+def _sorted_units_to_string(units, rates, dedups):
+    # reference implementation: the former sort of the (token, position) pairs
+    combine_toks = []
+    for key, tok_type in [("style", "St"), ("pitch", "Pi"), ("hubert", "Hu")]:
+        prev_unit = None
+        for i, unit in enumerate(units[key].split()):
+            if not dedups[key] or unit != prev_unit:
+                combine_toks.append((f"[{tok_type}{unit}]", i / rates[key]))
+            prev_unit = unit
+    return "".join(tok for tok, _ in sorted(combine_toks, key=lambda x: x[1]))
+
+
+@pytest.mark.parametrize("rates", [(24.99, 12.5, 1), (25, 12.5, 1), (50, 50, 25)])
+def test_units_to_string_matches_sorted(rates):
+    rng = np.random.default_rng(0)
+    rates = dict(zip(["hubert", "pitch", "style"], rates))
+    dedups = {"hubert": True, "pitch": True, "style": False}
+    kwargs = {f"{key}_rate": rate for key, rate in rates.items()}
+    for length in [0, 1, 2, 13, 500]:
+        # few distinct units, so that the dedup merges runs of units
+        units = {
+            key: " ".join(map(str, rng.integers(0, 4, length * int(rate) // 25)))
+            for key, rate in rates.items()
+        }
+        expected = _sorted_units_to_string(units, rates, dedups)
+        string = units_to_string(units, has_pitch=True, has_style=True, **kwargs)
+        assert string == expected
+        tokens = units_to_tokens(units, has_pitch=True, has_style=True, **kwargs)
+        assert "".join(f"[{tok_type}{unit}]" for tok_type, unit in tokens) == expected
+
+
+def _split_string_to_units(gen, duplicate_hubert_for_multiple_pitch):
+    # reference implementation: the former parsing of the items split on "["
+    prev_hubert = first_hubert = prev_pitch = first_pitch = None
+    prev_style = first_style = None
+    prev_is_pitch = False
+    hubert, pitch, style = [], [], []
+    for item in gen.split("["):
+        if item and len(item) > 2:
+            if item.startswith("Hu") and item[2].isdigit():
+                hubert += [item[2:-1]]
+                pitch += [prev_pitch]
+                style += [prev_style]
+                prev_is_pitch = False
+                prev_hubert = item[2:-1]
+                if first_hubert is None:
+                    first_hubert = item[2:-1]
+            elif item.startswith("St") and item[2].isdigit():
+                if prev_style is None:
+                    first_style = item[2:-1]
+                prev_style = item[2:-1]
+            elif item.startswith("Pi") and item[2].isdigit():
+                if duplicate_hubert_for_multiple_pitch and prev_is_pitch:
+                    hubert += [prev_hubert]
+                    pitch += [item[2:-1]]
+                    style += [prev_style]
+                if prev_pitch is None:
+                    first_pitch = item[2:-1]
+                prev_pitch = item[2:-1]
+                prev_is_pitch = True
+    if first_pitch is not None and first_style is None:
+        first_style = "71"
+    hubert = [first_hubert if unit is None else unit for unit in hubert]
+    pitch = [first_pitch if unit is None else unit for unit in pitch]
+    style = [first_style if unit is None else unit for unit in style]
+    units = {"hubert": " ".join(hubert)}
+    if first_pitch is not None:
+        units["pitch"] = " ".join(pitch)
+    if first_style is not None:
+        units["style"] = " ".join(style)
+    return units
+
+
+@pytest.mark.parametrize("duplicate_hubert_for_multiple_pitch", [False, True])
+def test_string_to_units_matches_split(
+    monkeypatch, duplicate_hubert_for_multiple_pitch
+):
+    monkeypatch.setattr(
+        "spiritlm.speech_tokenizer.spiritlm_tokenizer.get_random_most_common_style",
+        lambda: 71,
+    )
+    rng = np.random.default_rng(0)
+    # speech tokens, and non-speech tokens which are ignored
+    vocab = ["Hu", "Pi", "St"] * 3 + ["[Speech]", "[Text]", "[Hu]", "[Pi]", "[Stx]"]
+    for _ in range(200):
+        tokens = [
+            token if token.startswith("[") else f"[{token}{rng.integers(0, 1000)}]"
+            for token in rng.choice(vocab, rng.integers(0, 30))
+        ]
+        if duplicate_hubert_for_multiple_pitch:
+            # the reference fails on the duplicated pitch without hubert units
+            tokens.insert(rng.integers(0, len(tokens) + 1), "[Hu0]")
+        gen = "".join(tokens)
+        units = string_to_units(
+            gen, duplicate_hubert_for_multiple_pitch=duplicate_hubert_for_multiple_pitch
+        )
+        expected = _split_string_to_units(gen, duplicate_hubert_for_multiple_pitch)
+        assert units == expected, gen
+        assert isinstance(units, Units)
+
+
+def test_encode_cache(tmp_path):
+    tokenizer = _fake_expressive_tokenizer(max_wav_chunk=40_000)
+    num_calls = []
+    hubert_model = tokenizer.hubert_model
+    tokenizer.hubert_model = lambda wav: num_calls.append(1) or hubert_model(wav)
+    wavs = [torch.rand(50_000) for _ in range(3)]
+    expected = [tokenizer.encode_units(wav) for wav in wavs]
+    num_calls.clear()
+
+    # the units of a wav take 4 * (79 + 40 + 4) bytes, 2 of them fit in the budget
+    tokenizer.enable_encode_cache(max_bytes=1_000, cache_dir=tmp_path / "cache")
+    assert tokenizer.encode_units(wavs[0]) == expected[0]
+    assert tokenizer.encode_units(wavs[0].clone()) == expected[0]
+    assert tokenizer.encode_units(wavs[1]) == expected[1]
+    assert tokenizer.encode_units(wavs[2]) == expected[2]  # evicts wavs[0]
+    cache = tokenizer.encode_cache
+    assert (cache.hits, cache.disk_hits, cache.misses) == (1, 0, 3)
+    assert len(cache) == 2 and cache.nbytes == 2 * 4 * (79 + 40 + 4)
+    assert len(num_calls) == 3 * 2  # 2 wav chunks per wav
+
+    assert tokenizer.encode_units(wavs[0]) == expected[0]
+    assert (cache.hits, cache.disk_hits, cache.misses) == (1, 1, 3)
+    assert len(num_calls) == 3 * 2
+    assert not tokenizer.encode_units(wavs[0]).arrays["hubert"].flags.writeable
+
+    # the cache keys depend on the tokenizer configuration
+    tokenizer.max_wav_chunk = 30_000
+    tokenizer.encode_units(wavs[0])
+    assert cache.misses == 4
+    tokenizer.max_wav_chunk = 40_000
+
+    tokenizer.disable_encode_cache()
+    assert tokenizer.encode_units(wavs[1]) == expected[1]
+
+
+
+@pytest.mark.parametrize("block_size", [320, 1_600, 16_000])
+@pytest.mark.parametrize("lookahead_seconds", [0.0, 0.5])
+def test_encode_stream(block_size, lookahead_seconds):
+    tokenizer = _fake_expressive_tokenizer()
+    wav = torch.rand(123_456)
+    expected = tokenizer.encode_units(wav)
+
+    stream = tokenizer.encode_stream(
+        context_seconds=1.0, lookahead_seconds=lookahead_seconds
+    )
+    chunks = [
+        stream.push(wav[start : start + block_size])
+        for start in range(0, len(wav), block_size)
+    ]
+    # the units are emitted once their lookahead is pushed
+    for num_blocks in range(1, len(chunks)):
+        num_samples = min(len(wav), num_blocks * block_size)
+        num_hubert_units = sum(
+            len(chunk.arrays["hubert"]) for chunk in chunks[:num_blocks]
+        )
+        num_final_samples = max(0, num_samples - int(lookahead_seconds * 16_000))
+        assert num_hubert_units <= num_final_samples // 640
+    assert sum(len(chunk.arrays["hubert"]) for chunk in chunks) > 0
+    # the units of these fake extractors don't depend on the context
+    chunks.append(stream.flush())
+    assert stream.audio_offset > 0 and len(stream.audio) <= 3 * 16_000
+    for key, units in expected.arrays.items():
+        stream_units = np.concatenate([chunk.arrays[key] for chunk in chunks])
+        np.testing.assert_array_equal(stream_units, units)
+
+
+class _FakeBatchedExtractor:
+    def __init__(self, hop_size, num_units):
+        self.extractor = _fake_extractor(hop_size, num_units)
+        self.batch_sizes = []
+
+    def __call__(self, wav):
+        return self.extractor(wav)
+
+    def forward_batch(self, wavs):
+        self.batch_sizes.append(len(wavs))
+        return [self.extractor(wav) for wav in wavs]
+
+
+@pytest.mark.parametrize("concurrent", [False, True])
+def test_long_audio_mode(concurrent):
+    tokenizer = _fake_expressive_tokenizer()
+    tokenizer.hubert_model = _FakeBatchedExtractor(640, 501)
+    # a last chunk shorter than min_wav_chunk, merged into the previous one
+    wav = torch.rand(9 * 16_000 + 1_000)
+    expected = tokenizer.encode_units(wav)
+
+    if concurrent:
+        tokenizer.enable_concurrent_extraction(num_threads=4)
+    tokenizer.enable_long_audio_mode(
+        chunk_seconds=1.5, overlap_seconds=0.3, batch_size=4
+    )
+    # the units of these fake extractors don't depend on the context,
+    # the stitched units of the chunks match the units of the whole audio
+    assert tokenizer.encode_units(wav) == expected
+    assert tokenizer.hubert_model.batch_sizes == [4, 2]
+    # encode_units_batch extracts each audio on its overlapping chunks
+    assert tokenizer.encode_units_batch([wav, wav]) == [expected, expected]
+    assert tokenizer.hubert_model.batch_sizes == [4, 2] * 3
+    assert tokenizer.encode_units(wav[:1_000]).arrays["hubert"].size == 0
+    tokenizer.disable_long_audio_mode()
+    tokenizer.disable_concurrent_extraction()
+
+    # the overlap covers the receptive field of the conv layers of the models
+    tokenizer.hubert_model.receptive_field = 720
+    with pytest.raises(AssertionError, match="receptive field"):
+        tokenizer.enable_long_audio_mode(overlap_seconds=0.04)
+    with pytest.raises(AssertionError):
+        tokenizer.enable_long_audio_mode(overlap_seconds=0)
+
+
+def test_overlapping_chunks():
+    chunks = overlapping_chunks(10_000, 3_000, 500, 640, min_chunk=1_280)
+    # the last 1_000 samples are merged into the previous chunk
+    assert chunks == [
+        (0, 3_500, 0, 5),
+        (1_920, 6_500, 5, 10),
+        (5_120, 10_000, 10, None),
+    ]
+    units = np.arange(16)  # ceil(10_000 / 640) units
+    window_units = [units[start // 640 : -(-end // 640)] for start, end, _, _ in chunks]
+    np.testing.assert_array_equal(
+        np.concatenate(stitch_chunks(window_units, chunks, 640)), units
+    )
+
+    # with a receptive field of 720 samples, the frame i covers [640 * i, 640 * i + 720)
+    assert num_frames(10_000, 640, 720) == 15
+    chunks = overlapping_chunks(
+        10_000, 3_000, 720, 640, receptive_field=720, min_chunk=1_280
+    )
+    assert chunks == [
+        (0, 3_720, 0, 5),
+        (1_920, 6_720, 5, 10),
+        (5_120, 10_000, 10, None),
+    ]
+    units = np.arange(15)
+    window_units = [
+        units[start // 640 : start // 640 + num_frames(end - start, 640, 720)]
+        for start, end, _, _ in chunks
+    ]
+    np.testing.assert_array_equal(
+        np.concatenate(stitch_chunks(window_units, chunks, 640)), units
+    )
+    with pytest.raises(AssertionError, match="receptive field"):
+        overlapping_chunks(10_000, 3_000, 500, 640, receptive_field=720)
+
+
+def test_encode_units_batch_batched_pitch():
+    tokenizer = _fake_expressive_tokenizer(max_wav_chunk=40_000)
+    tokenizer.hubert_model = _FakeBatchedExtractor(640, 501)
+    tokenizer.pitch_model = _FakeBatchedExtractor(1280, 64)
+    wavs = [torch.rand(length) for length in [50_000, 12_000, 90_000]]
+    units_batch = tokenizer.encode_units_batch(wavs, batch_size=4)
+    assert tokenizer.pitch_model.batch_sizes == [4, 2]
+    for wav, units in zip(wavs, units_batch):
+        assert units == tokenizer.encode_units(wav)
+
+
+def test_encode_units_batch_encode_cache():
+    tokenizer = _fake_expressive_tokenizer(max_wav_chunk=40_000)
+    tokenizer.hubert_model = _FakeBatchedExtractor(640, 501)
+    num_calls = []
+    extractor = tokenizer.hubert_model.extractor
+    tokenizer.hubert_model.extractor = lambda wav: num_calls.append(1) or extractor(
+        wav
+    )
+    wavs = [torch.rand(50_000) for _ in range(3)]
+    expected = tokenizer.encode_units_batch(wavs)
+    num_calls.clear()
+
+    tokenizer.enable_encode_cache()
+    assert tokenizer.encode_units(wavs[0]) == expected[0]
+    # the units of wavs[0] are cached, only the other wavs are extracted
+    assert tokenizer.encode_units_batch(wavs, batch_size=2) == expected
+    assert len(num_calls) == 2 + 2 * 2  # 2 wav chunks per wav
+    cache = tokenizer.encode_cache
+    assert (cache.hits, cache.misses) == (1, 3)
+    # the units extracted by batch are cached
+    assert tokenizer.encode_units(wavs[2]) == expected[2]
+    assert tokenizer.encode_units_batch(wavs[1:]) == expected[1:]
+    assert len(num_calls) == 2 + 2 * 2
+    tokenizer.disable_encode_cache()
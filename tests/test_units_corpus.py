@@ -0,0 +1,104 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the FAIR Noncommercial Research License
+# found in the LICENSE file in the root directory of this source tree.
+
+import numpy as np
+import pyarrow.parquet as pq
+import pytest
+from spiritlm.speech_tokenizer.spiritlm_tokenizer import units_to_string
+from spiritlm.speech_tokenizer.units import Units
+from spiritlm.speech_tokenizer.units_corpus import (
+    UnitsCorpus,
+    UnitsCorpusWriter,
+    write_units_corpus_from_shards,
+)
+from spiritlm.tokenize_manifest import units_table
+
+RATES = {"hubert": 24.99, "pitch": 12.5, "style": 1}
+
+
+def _random_units(rng, num_utterances):
+    units = {}
+    for i in range(num_utterances):
+        length = int(rng.integers(0, 200))
+        units[f"utt{i}"] = Units(
+            {
+                "hubert": rng.integers(0, 501, length),
+                "pitch": rng.integers(0, 64, length // 2),
+                "style": rng.integers(0, 100, length // 25),
+            },
+            rates=RATES,
+        )
+    return units
+
+
+def test_units_corpus(tmp_path):
+    rng = np.random.default_rng(0)
+    units = _random_units(rng, 50)
+    with UnitsCorpusWriter(tmp_path / "corpus", keys=list(RATES), rates=RATES) as writer:
+        for utterance_id, utterance_units in units.items():
+            writer.add(utterance_id, utterance_units)
+
+    corpus = UnitsCorpus(tmp_path / "corpus")
+    assert len(corpus) == 50 and list(corpus) == list(units)
+    for index, (utterance_id, expected) in enumerate(units.items()):
+        utterance_units = corpus[utterance_id]
+        assert utterance_units == expected
+        assert corpus.get_units(index) == expected
+        assert utterance_units.rates == RATES
+        # zero-copy views of the memory-mapped units
+        hubert = utterance_units.arrays["hubert"]
+        assert hubert.dtype == np.uint16 and not hubert.flags.writeable
+        assert units_to_string(
+            utterance_units, has_pitch=True, has_style=True
+        ) == units_to_string(expected, has_pitch=True, has_style=True)
+
+    assert "utt7" in corpus and "utt50" not in corpus
+    with pytest.raises(KeyError):
+        corpus["missing"]
+    with pytest.raises(IndexError):
+        corpus.get_units(50)
+
+
+def test_units_corpus_errors(tmp_path):
+    writer = UnitsCorpusWriter(tmp_path / "duplicated", keys=["hubert"])
+    writer.add("utt", {"hubert": "1 2 3"})
+    writer.add("utt", {"hubert": "4"})
+    with pytest.raises(ValueError):
+        writer.close()
+
+    writer = UnitsCorpusWriter(tmp_path / "overflow", keys=["hubert"])
+    with pytest.raises(ValueError):
+        writer.add("utt", {"hubert": np.array([70_000])})
+
+
+def test_write_units_corpus_from_shards(tmp_path):
+    rng = np.random.default_rng(1)
+    units = _random_units(rng, 30)
+    utterance_ids = list(units)
+    shard_paths = []
+    for shard_index, start in enumerate(range(0, 30, 8)):
+        shard_ids = utterance_ids[start : start + 8]
+        table = units_table(
+            [{"id": utterance_id, "audio": ""} for utterance_id in shard_ids],
+            [units[utterance_id] for utterance_id in shard_ids],
+            [0.0] * len(shard_ids),
+        )
+        shard_paths.append(tmp_path / f"shard-{shard_index:05d}.parquet")
+        pq.write_table(table, shard_paths[-1])
+
+    # the rates are read from the schema metadata of the shards
+    write_units_corpus_from_shards(shard_paths, tmp_path / "corpus")
+    corpus = UnitsCorpus(tmp_path / "corpus")
+    assert corpus.rates == RATES
+    assert list(corpus) == utterance_ids
+    for utterance_id, expected in units.items():
+        assert corpus[utterance_id] == expected
+        assert corpus[utterance_id].duration("hubert") == expected.duration("hubert")
+
+    write_units_corpus_from_shards(
+        shard_paths, tmp_path / "corpus_rates", rates={"hubert": 50, "pitch": 12.5}
+    )
+    assert UnitsCorpus(tmp_path / "corpus_rates").rates == {"hubert": 50, "pitch": 12.5}
@@ -0,0 +1,47 @@
+# Copyright (c) Meta Platforms, Inc. and affiliates.
+# All rights reserved.
+#
+# This source code is licensed under the FAIR Noncommercial Research License
+# found in the LICENSE file in the root directory of this source tree.
+
+import torch
+from spiritlm.speech_tokenizer.f0 import f0_tokenizer
+
+
+def test_vqvae_encode_codes(tiny_vqvae):
+    model, _ = tiny_vqvae
+    torch.manual_seed(1)
+    x = torch.randn(3, 2, 64)
+    codes = model(x)
+    for level in range(2):
+        assert torch.equal(model.encode_codes(x, level=level), codes[level])
+
+    # padded batch, with lengths which are not multiples of the downsampling
+    xs = [torch.randn(2, length) for length in [64, 37, 101, 12]]
+    lengths = [x.size(-1) for x in xs]
+    batch = torch.zeros(len(xs), 2, max(lengths))
+    for i, x in enumerate(xs):
+        batch[i, :, : x.size(-1)] = x
+    for level in range(2):
+        batch_codes = model.encode_codes(batch, lengths=lengths, level=level)
+        for x, x_codes in zip(xs, batch_codes):
+            assert torch.equal(x_codes, model(x.unsqueeze(0))[level][0])
+
+
+def test_f0_tokenizer_quantize_vqvae_batch(tiny_vqvae, monkeypatch):
+    monkeypatch.setattr(f0_tokenizer, "load_f0_extractor", lambda **kwargs: None)
+    monkeypatch.setattr(f0_tokenizer, "load_vqvae", lambda path: tiny_vqvae)
+    tokenizer = f0_tokenizer.F0Tokenizer(
+        f0_extractor_method="fcpe", quantizer_path="vqvae.pt", device="cpu"
+    )
+    torch.manual_seed(2)
+    vuvs = [(torch.rand(length) > 0.3).float() for length in [80, 33, 120]]
+    f0s = [vuv * (100 + 100 * torch.rand(len(vuv))) for vuv in vuvs]
+
+    batch_codes = tokenizer.quantize_vqvae_batch([f0.clone() for f0 in f0s], vuvs)
+    for f0, vuv, codes in zip(f0s, vuvs, batch_codes):
+        expected = tiny_vqvae[0](
+            tokenizer._vqvae_input(f0.clone(), vuv).unsqueeze(0)
+        )[0][0]
+        assert torch.equal(codes, expected)
+        assert torch.equal(tokenizer.quantize_vqvae(f0.clone(), vuv), expected)